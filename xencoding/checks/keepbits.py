@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Created on Sun Oct 20 10:41:17 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+from xencoding.precision.bitround import MANTISSA_BITS
+
+
+def _get_float_variables(ds):
+    """Return the data variables with a float dtype supporting bit-rounding."""
+    return [var for var in ds.data_vars if ds[var].dtype.name in MANTISSA_BITS]
+
+
+def _check_variable_keepbits(ds, var, keepbits):
+    """Check the keepbits of a variable is valid for its dtype."""
+    if not isinstance(keepbits, (int, np.integer)) or isinstance(keepbits, bool):
+        raise ValueError(f"The keepbits of '{var}' must be an integer (or None).")
+    dtype_name = ds[var].dtype.name
+    if dtype_name not in MANTISSA_BITS:
+        raise ValueError(f"'{var}' has dtype {dtype_name} and can not be bit-rounded.")
+    if not 0 <= keepbits <= MANTISSA_BITS[dtype_name]:
+        raise ValueError(
+            f"The keepbits of '{var}' ({dtype_name}) must be between 0 and "
+            f"{MANTISSA_BITS[dtype_name]}."
+        )
+
+
+def _is_inflevel(value):
+    """Check if a keepbits value is an information level (a float)."""
+    return isinstance(value, float)
+
+
+def check_keepbits(keepbits, ds, chunks=None):
+    """Check keepbits validity.
+
+    keepbits = None --> No bit-rounding.
+    keepbits = int --> All float variables keep the specified number of mantissa bits.
+    keepbits = float --> All float variables keep the mantissa bits preserving the specified
+      fraction of information (i.e. 0.99). See get_keepbits().
+    keepbits = dict --> Specify the number of mantissa bits (or the fraction of information)
+      for specific variables.
+
+    The information content is computed on a sample of chunks (with the specified chunks).
+    Returns a dictionary with format {<variable>: <keepbits>} (or None).
+    """
+    if keepbits is None:
+        return None
+    if not isinstance(keepbits, (int, float, dict)) or isinstance(keepbits, bool):
+        raise TypeError("'keepbits' must be a dictionary, integer, float or None.")
+    ##------------------------------------------------------------------------.
+    # If an integer or float, apply the same keepbits to all float variables
+    if isinstance(keepbits, (int, float)):
+        keepbits = {var: keepbits for var in _get_float_variables(ds)}
+    ##------------------------------------------------------------------------.
+    # Check valid keys
+    variable_names = list(ds.data_vars)
+    if not np.all(np.isin(list(keepbits.keys()), variable_names)):
+        raise ValueError(f"The 'keepbits' dictionary keys must be within {variable_names}.")
+    keepbits = {var: value for var, value in keepbits.items() if value is not None}
+    ##------------------------------------------------------------------------.
+    # Define the keepbits of the variables specified with an information level
+    inflevels = {var: value for var, value in keepbits.items() if _is_inflevel(value)}
+    if len(inflevels) > 0:
+        from xencoding.precision.information import get_keepbits
+
+        for var, inflevel in inflevels.items():
+            if not 0 < inflevel <= 1:
+                raise ValueError(f"The information level of '{var}' must be between 0 and 1.")
+            if ds[var].dtype.name not in MANTISSA_BITS:
+                raise ValueError(
+                    f"'{var}' has dtype {ds[var].dtype.name} and can not be bit-rounded."
+                )
+        keepbits.update(get_keepbits(ds, inflevel=inflevels, chunks=chunks))
+    ##------------------------------------------------------------------------.
+    # Check valid keepbits
+    for var, value in keepbits.items():
+        _check_variable_keepbits(ds, var, value)
+    return keepbits
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 22 09:42:18 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+# netCDF4 encodings defining the compression of a variable
+_COMPRESSION_KEYS = ["compression", "complevel", "shuffle", "blosc_shuffle", "zlib"]
+
+
+def _is_compression_encoding(compression):
+    """Check if a dictionary is a netCDF4 compression encoding."""
+    return isinstance(compression, dict) and all(key in _COMPRESSION_KEYS for key in compression)
+
+
+def _check_compression_encoding(compression):
+    """Check a netCDF4 compression encoding validity."""
+    from xencoding.netcdf.compression import check_netcdf_compression_name
+
+    if compression is None:
+        return None
+    if not _is_compression_encoding(compression):
+        raise ValueError(
+            f"A netCDF compression must be a dictionary with keys within {_COMPRESSION_KEYS}."
+        )
+    if "compression" in compression:
+        check_netcdf_compression_name(compression["compression"])
+    return compression
+
+
+def check_netcdf_compression(ds, compression, default_compression=None):
+    """Check compression validity for netCDF writing.
+
+    compression = None --> No compression.
+    compression = "auto" --> Use default_compression if specified.
+      Otherwise it uses zlib compression with complevel 4 and shuffle.
+    compression = {"compression": .., "complevel": .., "shuffle": ..} --> Specify the
+      same compression to all Dataset variables (see get_netcdf_compression()).
+    compression = {<var>: {..}} --> A dictionary specifying the compression of each Dataset variable.
+
+    Returns a dictionary with format {<variable>: <compression encoding>}.
+    """
+    from xencoding.netcdf.compression import DEFAULT_NETCDF_COMPRESSION
+
+    variable_names = list(ds.data_vars)
+    if not isinstance(compression, (str, dict, type(None))):
+        raise TypeError("'compression' must be a dictionary, 'auto' or None.")
+    if isinstance(compression, str):
+        if compression != "auto":
+            raise ValueError("If 'compression' is specified as string, must be 'auto'.")
+        compression = default_compression
+        if compression is None:
+            compression = DEFAULT_NETCDF_COMPRESSION
+    ##------------------------------------------------------------------------.
+    # Define the compression of each variable
+    if compression is None or _is_compression_encoding(compression):
+        compression = {var: compression for var in variable_names}
+    elif not np.all(np.isin(list(compression.keys()), variable_names)):
+        raise ValueError(f"The 'compression' dictionary keys must be within {variable_names}.")
+    ##------------------------------------------------------------------------.
+    # Check the compression of each variable
+    for var, var_compression in compression.items():
+        compression[var] = _check_compression_encoding(var_compression)
+    return compression
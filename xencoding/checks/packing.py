@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Created on Mon Oct 21 11:20:33 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+
+def check_packing(packing, variable_names):
+    """Check packing validity.
+
+    packing = None --> No packing.
+    packing = float --> All float variables are packed with the specified precision.
+    packing = dict --> Specify the packing precision of specific variables.
+    """
+    if not isinstance(packing, (int, float, dict, type(None))) or isinstance(packing, bool):
+        raise TypeError("'packing' must be a dictionary, float or None.")
+    ##------------------------------------------------------------------------.
+    # If a dictionary, check valid keys and valid precisions
+    if isinstance(packing, dict):
+        if not np.all(np.isin(list(packing.keys()), variable_names)):
+            raise ValueError(f"The 'packing' dictionary keys must be within {variable_names}.")
+        packing = {var: precision for var, precision in packing.items() if precision is not None}
+        if not all(isinstance(v, (int, float)) and v > 0 for v in packing.values()):
+            raise ValueError(
+                "The precisions specified in the 'packing' dictionary must be positive numbers."
+            )
+    ##------------------------------------------------------------------------.
+    # If a number, check it is positive
+    if isinstance(packing, (int, float)):
+        if packing <= 0:
+            raise ValueError("'packing' precision must be larger than 0.")
+    ##------------------------------------------------------------------------.
+    return packing
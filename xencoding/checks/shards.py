@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Created on Wed Oct 23 10:12:45 2024
+
+@author: ghiggi
+"""
+import copy
+
+from xencoding.checks.chunks import _check_chunks_dict, sanitize_chunks_dict
+
+
+def check_shards(ds, shards, chunks):
+    """Check shards validity.
+
+    shards = None --> No sharding.
+    shards = "auto" --> Shards of ~256MB are defined for each variable. See get_shards().
+    shards = dict --> 'Per variable' or 'per dimension' shards dictionary (as for chunks).
+      Unspecified dimensions and -1 values span the entire dimension.
+
+    Shards must be multiples of the inner chunks of each variable.
+    Shards larger than a dimension are clipped to the smallest multiple of
+    the inner chunk spanning the entire dimension.
+
+    Returns a 'per variable' shards dictionary with format: {<var>: {<dim>: <shard_value>}}.
+    """
+    from xencoding.zarr.sharding import get_shards
+
+    if not isinstance(shards, (str, dict, type(None))):
+        raise TypeError("'shards' must be a dictionary, 'auto' or None.")
+    if shards is None:
+        return None
+    if isinstance(shards, str):
+        if shards != "auto":
+            raise ValueError("If 'shards' is specified as string, must be 'auto'.")
+        return get_shards(ds, chunks=chunks)
+    # Check shards dictionary (as chunks dictionary)
+    shards = _check_chunks_dict(chunks=copy.deepcopy(shards), ds=ds)
+    shards = sanitize_chunks_dict(shards, ds)
+    # Check shards are multiples of the inner chunks
+    for var, var_shards in shards.items():
+        if chunks[var] is None:
+            raise ValueError(f"The inner chunks of '{var}' must be specified to shard it.")
+        for dim, shard in var_shards.items():
+            chunk = chunks[var][dim]
+            if shard >= ds[var].sizes[dim]:
+                shard = -(-ds[var].sizes[dim] // chunk) * chunk
+                var_shards[dim] = shard
+            if shard % chunk != 0:
+                raise ValueError(
+                    f"The '{dim}' shard of '{var}' ({shard}) is not a multiple of its chunk ({chunk})."
+                )
+    return shards
@@ -18,11 +18,13 @@ def _check_compressor_type(compressor, variable_names):
     """Check compressor type."""
     if not (isinstance(compressor, (str, dict, type(None))) or is_numcodecs(compressor)):
         raise TypeError(
-            "'compressor' must be a dictionary, numcodecs compressor, 'auto' string or None."
+            "'compressor' must be a dictionary, numcodecs compressor, 'auto' or 'optimize' string or None."
         )
     if isinstance(compressor, str):
-        if not compressor == "auto":
-            raise ValueError("If 'compressor' is specified as string, must be 'auto'.")
+        if compressor not in ["auto", "optimize"]:
+            raise ValueError(
+                "If 'compressor' is specified as string, must be 'auto' or 'optimize'."
+            )
     if isinstance(compressor, dict):
         if not np.all(np.isin(list(compressor.keys()), variable_names)):
             raise ValueError(f"The 'compressor' dictionary must contain the keys {variable_names}")
@@ -51,16 +53,45 @@ def _check_compressor_dict(compressor):
     return compressor
 
 
-def check_compressor(ds, compressor, default_compressor=None):
+def _expand_default_compressor(default_compressor, keys):
+    """Return a compressor dictionary from the default_compressor.
+
+    If default_compressor is None, an empty dictionary is returned so that
+    ds.to_zarr() default compressor is used.
+    """
+    if isinstance(default_compressor, type(None)):
+        return {}
+    if isinstance(default_compressor, dict):
+        return _check_compressor_dict(default_compressor)
+    return {key: default_compressor for key in keys}
+
+
+def check_compressor(
+    ds,
+    compressor,
+    default_compressor=None,
+    objective="size",
+    chunks=None,
+    cache=None,
+    filters=None,
+):
     """Check compressor validity for zarr writing.
 
     compressor = None --> No compression.
     compressor = "auto" --> Use default_compressor if specified.
       Otherwise will default to ds.to_zarr() default compressor.
+    compressor = "optimize" --> Select the best compressor of each numeric Dataset variable
+      according to the objective with a sample benchmark (see select_compressors()).
+      The other variables and coordinates use the default_compressor.
     compressor = <numcodecs class> --> Specify the same compressor to all Dataset variables
     compressor = {..} --> A dictionary specifying a compressor for each Dataset variable.
 
     default_compressor: None or numcodecs compressor. None will default to ds.to_zarr() default compressor.
+    objective: objective of compressor='optimize'. See check_objective().
+    chunks: chunks used to sample the Dataset when compressor='optimize'. See check_chunks().
+    cache: cache of the sample benchmark results when compressor='optimize'. See check_cache().
+    filters: filters chain of the variables, applied before the compressors in the
+      sample benchmark when compressor='optimize'. See check_filters().
     """
     keys = list(ds.data_vars) + list(ds.coords)
     compressor = _check_compressor_type(compressor, keys)
@@ -68,8 +99,19 @@ def check_compressor(ds, compressor, default_compressor=None):
 
     # If a string --> "Auto" --> Apply default_compressor (if specified)
     if isinstance(compressor, str):
+        default_compressor_dict = _expand_default_compressor(default_compressor, keys)
         if compressor == "auto":
-            compressor = default_compressor
+            compressor = dict(default_compressor_dict)
+        else:  # compressor == "optimize"
+            from xencoding.zarr.selection import select_compressors
+
+            # - Copy to not modify the default_compressor dictionary of the caller
+            compressor = dict(default_compressor_dict)
+            compressor.update(
+                select_compressors(
+                    ds, objective=objective, chunks=chunks, cache=cache, filters=filters
+                )
+            )
 
     # If a unique compressor, create a dictionary with the same compressor for all variables
     elif is_numcodecs(compressor) or isinstance(compressor, type(None)):
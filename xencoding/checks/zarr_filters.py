@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 31 10:02:41 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+from xencoding.checks.zarr_compressor import is_numcodecs
+
+
+def _check_filters_chain(filters, key):
+    """Check a filters chain validity and return it as a list (or None)."""
+    if filters is None:
+        return None
+    if is_numcodecs(filters):
+        filters = [filters]
+    if not isinstance(filters, (list, tuple)) or not all(is_numcodecs(f) for f in filters):
+        raise ValueError(
+            f"The filters of '{key}' must be a numcodecs filter, a list of numcodecs filters or None."
+        )
+    filters = list(filters)
+    return filters if len(filters) > 0 else None
+
+
+def check_filters(ds, filters):
+    """Check filters validity for zarr writing.
+
+    filters = None --> The current filters encodings are kept.
+    filters = <numcodecs filter> or [<numcodecs filters>] --> The same filters chain
+      is applied to all Dataset data variables.
+    filters = {<var>: <filters chain>} --> A dictionary specifying the filters chain of
+      specific Dataset variables or coordinates. A None chain removes the filters.
+
+    Returns a dictionary with format {<variable>: <list of numcodecs filters> or None}.
+    """
+    if filters is None:
+        return {}
+    keys = list(ds.data_vars) + list(ds.coords)
+    if isinstance(filters, dict):
+        if not np.all(np.isin(list(filters.keys()), keys)):
+            raise ValueError(f"The 'filters' dictionary keys must be within {keys}.")
+        return {key: _check_filters_chain(chain, key) for key, chain in filters.items()}
+    chain = _check_filters_chain(filters, "all variables")
+    return {var: chain for var in ds.data_vars}
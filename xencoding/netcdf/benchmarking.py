@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 22 14:12:09 2024
+
+@author: ghiggi
+"""
+import os
+import time
+import warnings
+
+import numpy as np
+import xarray as xr
+
+from xencoding.netcdf.compression import (
+    get_netcdf_compression,
+    get_valid_netcdf_compressions,
+    is_shuffle_supported,
+)
+from xencoding.netcdf.writer import set_compression
+from xencoding.utils.timing import evict_file_cache
+
+
+def _get_compression_acronym(compression, complevel, shuffle, prefix="", suffix=""):
+    """Return the acronym identifying a benchmarked netCDF compression."""
+    compression_acronym = f"{compression}_c{complevel}"
+    if shuffle:
+        compression_acronym = f"{compression_acronym}_shuffle"
+    if prefix != "":
+        compression_acronym = f"{prefix}_{compression_acronym}"
+    if suffix != "":
+        compression_acronym = f"{compression_acronym}_{suffix}"
+    return compression_acronym
+
+
+def _get_netcdf_benchmark_candidates(compressions, complevels, shuffles, prefix="", suffix=""):
+    """Return a dictionary with the netCDF compression encoding of each benchmark candidate."""
+    candidates = {}
+    for compression in compressions:
+        for complevel in complevels:
+            # - Shuffle is benchmarked only for compressions supporting it
+            if is_shuffle_supported(compression):
+                compression_shuffles = shuffles
+            else:
+                compression_shuffles = [False]
+            for shuffle in compression_shuffles:
+                compression_acronym = _get_compression_acronym(
+                    compression, complevel=complevel, shuffle=shuffle, prefix=prefix, suffix=suffix
+                )
+                candidates[compression_acronym] = get_netcdf_compression(
+                    compression, complevel=complevel, shuffle=shuffle
+                )
+    return candidates
+
+
+def _benchmark_netcdf_compression(ds, compression, fpath, fletcher32=False, cold_cache=True):
+    """Return the writing time, file size and reading time of a Dataset with a given compression.
+
+    If cold_cache=True, the file is evicted from the page cache before the reading.
+    """
+    compression_dict = {var: compression for var in ds.data_vars}
+    ds = set_compression(ds.copy(), compression_dict=compression_dict, fletcher32=fletcher32)
+
+    # Writing
+    t_i = time.time()
+    ds.to_netcdf(fpath, mode="w", format="NETCDF4", engine="netcdf4")
+    t_f = time.time()
+    writing = round(t_f - t_i, 1)
+
+    # Measure file size
+    filesize = round(os.path.getsize(fpath) / (1024**2), 2)
+
+    # Reading
+    if cold_cache:
+        evict_file_cache(fpath)
+    t_i = time.time()
+    with xr.open_dataset(fpath, engine="netcdf4", decode_cf=True, mask_and_scale=True) as ds_read:
+        ds_read.load()
+    t_f = time.time()
+    reading = round(t_f - t_i, 1)
+    return writing, filesize, reading
+
+
+def benchmark_netcdf_compressions(
+    ds,
+    compressions=None,
+    complevels=[1, 4, 9],
+    shuffles=[True, False],
+    dst_dir="/tmp/",
+    prefix="",
+    suffix="",
+    fletcher32=False,
+    cold_cache=True,
+):
+    """Benchmark the writing time, reading time and file size of a Dataset with various netCDF compressions.
+
+    It is the netCDF counterpart of benchmark_compressors().
+    A candidate is defined for each compression/complevel/shuffle combination.
+    Each candidate is written to a netCDF4 file in dst_dir, using the current
+    HDF5 chunking of the Dataset (see write_netcdf()).
+    If the HDF5 filter of a candidate fails (i.e. the blosc filter on uncompressible
+    chunks), a warning is raised, its results are set to NaN and its file is removed.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    compressions : list, optional
+        Names of the compressions to benchmark. See get_valid_netcdf_compressions().
+        If None (the default), all compressions supported by the netCDF4 library.
+    complevels : list, optional
+        Compression levels to benchmark. The default is [1, 4, 9].
+    shuffles : list, optional
+        Whether to apply the shuffle filter. The default is [True, False].
+        Shuffle is benchmarked only for zlib and blosc compressions (see get_netcdf_compression()).
+    dst_dir : str, optional
+        Directory where to write the netCDF files. The default is "/tmp/".
+    prefix : str, optional
+        Prefix to add to the compression acronyms. The default is "".
+    suffix : str, optional
+        Suffix to add to the compression acronyms. The default is "".
+    fletcher32 : bool, optional
+        Whether to store the checksum of each HDF5 chunk. The default is False.
+    cold_cache : bool, optional
+        If True (the default), each file is evicted from the page cache before the reading,
+        so that the reading time includes the disk reads of the file just written.
+        It requires os.posix_fadvise (i.e. Linux). See evict_file_cache().
+
+    Returns
+    -------
+    benchmark_dict : dict
+        Dictionary with the "writing" and "reading" times (in seconds) and
+        the "filesize" (in MB) of each candidate (NaN for the failed candidates).
+
+    """
+    if compressions is None:
+        compressions = get_valid_netcdf_compressions()
+    candidates = _get_netcdf_benchmark_candidates(
+        compressions=compressions,
+        complevels=complevels,
+        shuffles=shuffles,
+        prefix=prefix,
+        suffix=suffix,
+    )
+    benchmark_dict = {}
+    benchmark_dict["writing"] = {}
+    benchmark_dict["reading"] = {}
+    benchmark_dict["filesize"] = {}
+    for compression_acronym, compression in candidates.items():
+        fpath = os.path.join(dst_dir, f"{compression_acronym}.nc")
+        try:
+            writing, filesize, reading = _benchmark_netcdf_compression(
+                ds,
+                compression=compression,
+                fpath=fpath,
+                fletcher32=fletcher32,
+                cold_cache=cold_cache,
+            )
+        except (RuntimeError, OSError) as e:
+            warnings.warn(f"The {compression_acronym} candidate failed: {e}", stacklevel=2)
+            writing, filesize, reading = np.nan, np.nan, np.nan
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        benchmark_dict["writing"][compression_acronym] = writing
+        benchmark_dict["filesize"][compression_acronym] = filesize
+        benchmark_dict["reading"][compression_acronym] = reading
+    return benchmark_dict
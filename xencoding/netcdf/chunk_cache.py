@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 22 10:31:52 2024
+
+@author: ghiggi
+"""
+from contextlib import contextmanager
+
+import numpy as np
+
+from xencoding.optimization.chunks import check_access_patterns
+
+
+def _next_prime(n):
+    """Return the smallest prime number larger or equal to n."""
+    n = max(int(n), 2)
+    while True:
+        if all(n % d != 0 for d in range(2, int(np.sqrt(n)) + 1)):
+            return n
+        n += 1
+
+
+def _get_n_chunks_touched(read_lengths, chunks, shape):
+    """Return the maximum number of chunks touched by a request, for each dimension.
+
+    A read of length values starting within a chunk spans at most ceil((length - 1) / chunk) + 1
+    chunks (i.e. 1 chunk for a single index, 2 chunks for an unaligned read of a chunk length).
+    """
+    return [
+        min(int(np.ceil((length - 1) / chunk)) + 1, int(np.ceil(size / chunk)))
+        for length, chunk, size in zip(read_lengths, chunks, shape)
+    ]
+
+
+def _is_aligned_read(length, chunk, size):
+    """Check if a request (at a random position) reads whole chunks along a dimension."""
+    return length == size or chunk == 1
+
+
+def get_chunk_cache_params(ds, chunks, access_patterns, max_size="1GB"):
+    """Return the HDF5 chunk cache parameters suited to the expected access patterns.
+
+    The cache size is defined to hold all the chunks of a variable touched by a request,
+    so that chunks partially read by a request are decompressed only once.
+    The number of hash slots is a prime number ~100 times the number of chunks in the cache.
+    If all requests read whole chunks (i.e. the entire dimensions, since requests can start
+    anywhere within a chunk), chunks are never reused and fully read chunks are evicted
+    first (preemption=1). Otherwise the HDF5 default preemption (0.75) is used.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    chunks : dict
+        'Per variable' chunks dictionary. See check_chunks().
+    access_patterns : list
+        Expected access patterns. See check_access_patterns().
+    max_size : (int, str), optional
+        Maximum size of the cache (in bytes). A string (e.g. 1GB) can also be used.
+        The default is "1GB".
+
+    Returns
+    -------
+    cache_params : dict
+        Dictionary with the cache 'size' (in bytes), the number of hash slots 'nelems'
+        and the 'preemption'.
+
+    """
+    from dask.utils import parse_bytes
+
+    if isinstance(max_size, str):
+        max_size = parse_bytes(max_size)
+    access_patterns = check_access_patterns(access_patterns, ds)
+    size = 0
+    n_chunks_cache = 1
+    whole_chunks = True
+    for var, var_chunks in chunks.items():
+        if var_chunks is None or var not in ds.data_vars:
+            continue
+        dims = ds[var].dims
+        chunk_shape = [var_chunks[dim] for dim in dims]
+        chunk_nbytes = int(np.prod(chunk_shape)) * ds[var].dtype.itemsize
+        for pattern, _ in access_patterns:
+            read_lengths = [pattern[dim] for dim in dims]
+            n_chunks_touched = _get_n_chunks_touched(read_lengths, chunk_shape, ds[var].shape)
+            n_chunks = int(np.prod(n_chunks_touched))
+            if n_chunks * chunk_nbytes > size:
+                size = n_chunks * chunk_nbytes
+                n_chunks_cache = n_chunks
+            whole_chunks = whole_chunks and all(
+                _is_aligned_read(length, chunk, ds.sizes[dim])
+                for length, chunk, dim in zip(read_lengths, chunk_shape, dims)
+            )
+    size = int(min(size, max_size))
+    return {
+        "size": size,
+        "nelems": _next_prime(min(100 * n_chunks_cache, 1_000_000)),
+        "preemption": 1.0 if whole_chunks else 0.75,
+    }
+
+
+@contextmanager
+def netcdf_chunk_cache(size, nelems, preemption):
+    """Context manager setting the default HDF5 chunk cache of the netCDF4 library.
+
+    The cache settings apply to the variables of the files opened within the context.
+    The previous settings are restored on exit.
+    """
+    import netCDF4
+
+    previous = netCDF4.get_chunk_cache()
+    netCDF4.set_chunk_cache(size=size, nelems=nelems, preemption=preemption)
+    try:
+        yield
+    finally:
+        netCDF4.set_chunk_cache(*previous)
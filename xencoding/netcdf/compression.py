@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 22 09:15:40 2024
+
+@author: ghiggi
+"""
+# netCDF4 compression filters and the netCDF4 flag reporting their availability
+_COMPRESSIONS_SUPPORT = {
+    "zlib": None,
+    "zstd": "__has_zstandard_support__",
+    "bzip2": "__has_bzip2_support__",
+    "blosc_lz": "__has_blosc_support__",
+    "blosc_lz4": "__has_blosc_support__",
+    "blosc_lz4hc": "__has_blosc_support__",
+    "blosc_zlib": "__has_blosc_support__",
+    "blosc_zstd": "__has_blosc_support__",
+}
+
+DEFAULT_NETCDF_COMPRESSION = {"compression": "zlib", "complevel": 4, "shuffle": True}
+
+
+def get_valid_netcdf_compressions():
+    """Return the compressions supported by the installed netCDF4 library."""
+    import netCDF4
+
+    return [
+        compression
+        for compression, flag in _COMPRESSIONS_SUPPORT.items()
+        if flag is None or getattr(netCDF4, flag, False)
+    ]
+
+
+def check_netcdf_compression_name(compression):
+    """Check the netCDF compression name validity."""
+    valid_compressions = get_valid_netcdf_compressions()
+    if compression not in valid_compressions:
+        raise ValueError(f"Valid netCDF compressions are {valid_compressions}.")
+
+
+def get_netcdf_compression(compression="zlib", complevel=4, shuffle=True):
+    """Return the netCDF4 encoding of a compression.
+
+    The netCDF4 library applies the HDF5 shuffle filter only with zlib compression.
+    With blosc compressions, shuffle defines the blosc byte shuffle ('blosc_shuffle').
+    With other compressions, shuffle is not applied.
+    """
+    check_netcdf_compression_name(compression)
+    if not isinstance(complevel, int) or not 0 <= complevel <= 9:
+        raise ValueError("'complevel' must be an integer between 0 and 9.")
+    encoding = {"compression": compression, "complevel": complevel}
+    if compression == "zlib":
+        encoding["shuffle"] = bool(shuffle)
+    elif compression.startswith("blosc"):
+        encoding["blosc_shuffle"] = int(bool(shuffle))
+    else:
+        encoding["shuffle"] = False
+    return encoding
+
+
+def is_shuffle_supported(compression):
+    """Check if the shuffle filter can be applied with a netCDF compression."""
+    return compression == "zlib" or compression.startswith("blosc")
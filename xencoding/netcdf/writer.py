@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 22 11:05:27 2024
+
+@author: ghiggi
+"""
+import os
+from contextlib import nullcontext
+
+from xencoding.checks.chunks import check_chunks
+from xencoding.checks.keepbits import check_keepbits
+from xencoding.checks.netcdf_compression import check_netcdf_compression
+from xencoding.checks.packing import check_packing
+from xencoding.checks.rounding import check_rounding
+from xencoding.netcdf.chunk_cache import get_chunk_cache_params, netcdf_chunk_cache
+from xencoding.precision.packing import get_packing_encoding
+from xencoding.zarr.writer import set_chunks, set_keepbits, set_packing, set_rounding
+
+# netCDF4 encodings which are not valid in the zarr encodings (and vice versa)
+_ZARR_ENCODINGS = ["compressor", "filters", "preferred_chunks", "chunks"]
+
+
+def remove_zarr_encodings(ds):
+    # - Remove encodings specific to zarr (i.e. of Datasets opened from zarr stores)
+    for var in list(ds.variables):
+        for key in _ZARR_ENCODINGS:
+            ds[var].encoding.pop(key, None)
+    return ds
+
+
+def set_chunksizes(ds, chunks_dict):
+    # - HDF5 chunks are defined by the 'chunksizes' encoding (in the variable dimensions order)
+    for var, chunks in chunks_dict.items():
+        if chunks is not None:
+            ds[var].encoding["chunksizes"] = tuple(
+                min(chunks[dim], ds[var].sizes[dim]) for dim in ds[var].dims
+            )
+            ds[var].encoding["contiguous"] = False
+    return ds
+
+
+def set_compression(ds, compression_dict, fletcher32=False):
+    for var, compression in compression_dict.items():
+        if compression is None:
+            ds[var].encoding.update({"zlib": False, "compression": None})
+        else:
+            ds[var].encoding.update(compression)
+        ds[var].encoding["fletcher32"] = fletcher32
+    return ds
+
+
+def write_netcdf(
+    fpath,
+    ds,
+    chunks="auto",
+    default_chunks=None,
+    compression="auto",
+    default_compression=None,
+    rounding=None,
+    keepbits=None,
+    packing=None,
+    fletcher32=False,
+    access_patterns=None,
+    max_cache_size="1GB",
+    format="NETCDF4",
+    show_progress=True,
+):
+    """Write Xarray Dataset to netCDF4/HDF5 with custom chunks and compression per Dataset variable.
+
+    It is the netCDF counterpart of write_zarr(): chunks, rounding, keepbits and packing
+    are checked and applied as in write_zarr(). See check_chunks(), check_rounding(),
+    check_keepbits() and check_packing().
+
+    The compression of each variable is specified with netCDF4 encodings
+    (i.e. {"compression": "zlib", "complevel": 4, "shuffle": True}).
+    See check_netcdf_compression() and get_netcdf_compression().
+    If fletcher32=True, a checksum of each HDF5 chunk is stored.
+
+    If access_patterns is specified, the HDF5 chunk cache used to write the file
+    is sized to hold the chunks touched by the expected requests.
+    See get_chunk_cache_params(). The same parameters can be used with
+    netcdf_chunk_cache() when reading the file.
+    """
+    from dask.diagnostics import ProgressBar
+
+    ### Check fpath
+    if not fpath.endswith(".nc"):
+        fpath = fpath + ".nc"
+    if os.path.exists(fpath):
+        raise ValueError(fpath + " already exists!")
+    if format not in ["NETCDF4", "NETCDF4_CLASSIC"]:
+        raise ValueError("'format' must be either 'NETCDF4' or 'NETCDF4_CLASSIC'.")
+    if not isinstance(fletcher32, bool):
+        raise TypeError("'fletcher32' must be either True or False.")
+
+    ##------------------------------------------------------------------------.
+    # Checks
+    chunks = check_chunks(ds, chunks=chunks, default_chunks=default_chunks)
+    rounding = check_rounding(rounding=rounding, variable_names=list(ds.data_vars.keys()))
+    keepbits = check_keepbits(keepbits=keepbits, ds=ds, chunks=chunks)
+    packing = check_packing(packing=packing, variable_names=list(ds.data_vars.keys()))
+    compression = check_netcdf_compression(
+        ds, compression=compression, default_compression=default_compression
+    )
+
+    # Preprocessing
+    ds = remove_zarr_encodings(ds)
+    ds = set_rounding(ds, rounding=rounding)
+    ds = set_keepbits(ds, keepbits=keepbits)
+    ds = set_chunks(ds, chunks_dict=chunks)
+    ds = set_chunksizes(ds, chunks_dict=chunks)
+    if packing is not None:
+        packing_encoding = get_packing_encoding(ds, precision=packing, chunks=chunks)
+        ds = set_packing(ds, packing_encoding=packing_encoding)
+    ds = set_compression(ds, compression_dict=compression, fletcher32=fletcher32)
+
+    ##------------------------------------------------------------------------.
+    # Define the HDF5 chunk cache
+    if access_patterns is not None:
+        cache_params = get_chunk_cache_params(
+            ds, chunks=chunks, access_patterns=access_patterns, max_size=max_cache_size
+        )
+        cache_context = netcdf_chunk_cache(**cache_params)
+    else:
+        cache_context = nullcontext()
+
+    ##------------------------------------------------------------------------.
+    ### - Write netCDF file
+    with cache_context:
+        r = ds.to_netcdf(fpath, mode="w", format=format, engine="netcdf4", compute=False)
+        with ProgressBar() if show_progress else nullcontext():
+            r.compute()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Created on Wed Oct 16 09:31:47 2024
+
+@author: ghiggi
+"""
+import itertools
+
+import numpy as np
+import xarray as xr
+
+
+def _parse_bytes(size):
+    """Return the number of bytes of an integer or a string (e.g. '10MB')."""
+    from dask.utils import parse_bytes
+
+    if isinstance(size, str):
+        return parse_bytes(size)
+    return int(size)
+
+
+def check_access_patterns(access_patterns, ds):
+    """Check access patterns validity.
+
+    access_patterns = [{..}, ...] --> A list of dictionaries {<dim>: <read length>}.
+      All patterns have the same weight.
+    access_patterns = [({..}, <weight>), ...] --> A list of (dictionary, weight) tuples.
+
+    In each dictionary, a read length of -1 or None corresponds to the entire dimension,
+    and unspecified dimensions are read at a single index.
+    For example, {"time": -1} describes a time-series at one pixel,
+    and {"lat": -1, "lon": -1} a full spatial slice at one time.
+
+    Returns a list of (dictionary, weight) tuples with the read length of every Dataset dimension.
+    """
+    if not isinstance(access_patterns, list) or len(access_patterns) == 0:
+        raise TypeError("'access_patterns' must be a non-empty list.")
+    dims_dict = dict(ds.sizes)
+    new_patterns = []
+    for pattern in access_patterns:
+        if isinstance(pattern, dict):
+            pattern, weight = pattern, 1
+        elif isinstance(pattern, tuple) and len(pattern) == 2:
+            pattern, weight = pattern
+        else:
+            raise TypeError(
+                "Each access pattern must be a dictionary or a (dictionary, weight) tuple."
+            )
+        if not isinstance(weight, (int, float)) or weight < 0:
+            raise ValueError("The access patterns weights must be positive numbers.")
+        invalid_dims = [dim for dim in pattern if dim not in dims_dict]
+        if len(invalid_dims) > 0:
+            raise ValueError(
+                f"The access pattern {pattern} contains invalid dimensions {invalid_dims}."
+            )
+        read_lengths = {}
+        for dim, size in dims_dict.items():
+            length = pattern.get(dim, 1)
+            if length is None or length == -1:
+                length = size
+            if not isinstance(length, (int, np.integer)) or not 0 < length <= size:
+                raise ValueError(f"Invalid read length {length} for dimension '{dim}'.")
+            read_lengths[dim] = int(length)
+        new_patterns.append((read_lengths, weight))
+    return new_patterns
+
+
+def _get_candidate_chunks(size):
+    """Return the candidate chunk values of a dimension.
+
+    Candidates are the powers of 2 and the values splitting the dimension in few equal chunks.
+    """
+    candidates = {2**i for i in range(int(np.log2(size)) + 1)}
+    candidates.update(int(np.ceil(size / k)) for k in range(1, min(size, 8) + 1))
+    return np.array(sorted(candidates))
+
+
+def _get_chunks_grid(sizes, max_candidates=1_000_000):
+    """Return an array (n_candidates, n_dims) with the candidate chunk shapes."""
+    candidates = [_get_candidate_chunks(size) for size in sizes]
+    if np.prod([len(c) for c in candidates], dtype=float) > max_candidates:
+        candidates = [c[(c & (c - 1) == 0) | (c == size)] for c, size in zip(candidates, sizes)]
+    if len(candidates) == 0:
+        return np.ones((1, 0), dtype=int)
+    return np.array(list(itertools.product(*candidates)), dtype=int)
+
+
+def _get_expected_cost(chunks_grid, sizes, itemsize, access_patterns, request_cost):
+    """Return the expected bytes read, number of chunk requests and cost of each candidate.
+
+    For a read of r consecutive elements starting at a random position, the expected
+    number of chunks touched along a dimension is 1 + (r - 1) / chunk.
+    """
+    sizes = np.array(sizes)
+    expected_nbytes = np.zeros(len(chunks_grid))
+    expected_requests = np.zeros(len(chunks_grid))
+    total_weight = sum(weight for _, weight in access_patterns)
+    for read_lengths, weight in access_patterns:
+        lengths = np.array(read_lengths)
+        n_chunks = np.minimum(np.ceil(sizes / chunks_grid), 1 + (lengths - 1) / chunks_grid)
+        n_requests = np.prod(n_chunks, axis=1)
+        nbytes = n_requests * np.prod(chunks_grid, axis=1) * itemsize
+        expected_nbytes += weight / total_weight * nbytes
+        expected_requests += weight / total_weight * n_requests
+    cost = expected_nbytes + request_cost * expected_requests
+    return expected_nbytes, expected_requests, cost
+
+
+def _optimize_variable_chunks(da, access_patterns, target_nbytes, request_cost, min_fill):
+    """Return the chunks dictionary of a DataArray minimizing the expected access cost."""
+    dims = list(da.dims)
+    sizes = [da.sizes[dim] for dim in dims]
+    itemsize = da.dtype.itemsize
+    chunks_grid = _get_chunks_grid(sizes)
+    chunk_nbytes = np.prod(chunks_grid, axis=1) * itemsize
+    # Select the candidates with a size close to the target chunk size
+    max_nbytes = max(target_nbytes, itemsize)
+    min_nbytes = min(min_fill * target_nbytes, int(np.prod(sizes)) * itemsize)
+    is_valid = (chunk_nbytes <= max_nbytes) & (chunk_nbytes >= min_nbytes)
+    if not np.any(is_valid):
+        is_valid = chunk_nbytes <= max_nbytes
+    chunks_grid = chunks_grid[is_valid]
+    chunk_nbytes = chunk_nbytes[is_valid]
+    # Compute the expected cost of the access patterns
+    patterns = [
+        ([read_lengths[dim] for dim in dims], weight) for read_lengths, weight in access_patterns
+    ]
+    _, _, cost = _get_expected_cost(
+        chunks_grid,
+        sizes=sizes,
+        itemsize=itemsize,
+        access_patterns=patterns,
+        request_cost=request_cost,
+    )
+    # Select the cheapest candidate (the largest chunk if equal cost)
+    idx = np.lexsort((-chunk_nbytes, cost))[0]
+    return {dim: int(chunk) for dim, chunk in zip(dims, chunks_grid[idx])}
+
+
+def optimize_chunks(
+    ds,
+    access_patterns,
+    target_chunk_size="10MB",
+    request_cost="1MB",
+    min_fill=0.5,
+):
+    """Define the chunks of each Dataset variable given the expected access patterns.
+
+    For each variable, the chunk shapes with a size between min_fill * target_chunk_size
+    and target_chunk_size are evaluated, and the one minimizing the weighted
+    expected cost of the access patterns is selected.
+    The cost of an access is the number of bytes read plus request_cost for each chunk touched.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    access_patterns : list
+        Expected read patterns. See check_access_patterns().
+    target_chunk_size : (int, str), optional
+        Maximum chunk size in bytes. A string (e.g. 10MB) can also be used.
+        The default is "10MB".
+    request_cost : (int, str), optional
+        Cost of a chunk request, expressed in bytes read. A string (e.g. 1MB) can also be used.
+        The larger, the more the number of chunk requests is penalized.
+        The default is "1MB".
+    min_fill : float, optional
+        Minimum chunk size as a fraction of target_chunk_size. The default is 0.5.
+
+    Returns
+    -------
+    chunks : dict
+       A 'per variable' chunks dictionary with format: {<var>: {<dim>: <chunk_value>}}.
+       It can be passed to write_zarr(chunks=...) and rechunk_dataset(target_chunks=...).
+
+    """
+    if not isinstance(ds, xr.Dataset):
+        raise TypeError("'ds' must be an xarray Dataset.")
+    if not 0 <= min_fill <= 1:
+        raise ValueError("'min_fill' must be between 0 and 1.")
+    access_patterns = check_access_patterns(access_patterns, ds)
+    target_nbytes = _parse_bytes(target_chunk_size)
+    request_cost = _parse_bytes(request_cost)
+    chunks = {}
+    for var in list(ds.data_vars):
+        chunks[var] = _optimize_variable_chunks(
+            ds[var],
+            access_patterns=access_patterns,
+            target_nbytes=target_nbytes,
+            request_cost=request_cost,
+            min_fill=min_fill,
+        )
+    return chunks
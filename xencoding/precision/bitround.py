@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Created on Sun Oct 20 09:12:36 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+# Number of mantissa bits of each float dtype
+MANTISSA_BITS = {"float16": 10, "float32": 23, "float64": 52}
+
+# Number of sign and exponent bits of each float dtype
+EXPONENT_BITS = {"float16": 1 + 5, "float32": 1 + 8, "float64": 1 + 11}
+
+
+def get_mantissa_bits(dtype):
+    """Return the number of mantissa bits of a float dtype."""
+    dtype = np.dtype(dtype)
+    if dtype.name not in MANTISSA_BITS:
+        raise TypeError(f"Bit-rounding is only available for {list(MANTISSA_BITS)} arrays.")
+    return MANTISSA_BITS[dtype.name]
+
+
+def bitround(x, keepbits, inplace=False):
+    """Round the mantissa of a float array to keepbits bits (round to nearest, ties to even).
+
+    The discarded mantissa bits are set to 0, so that the array is much more compressible.
+    The rounding is performed with vectorized integer operations on a view of the array.
+    If inplace=False (the default), the array is copied once before rounding.
+    NaN values are preserved.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Float array.
+    keepbits : int
+        Number of mantissa bits to keep.
+    inplace : bool, optional
+        Whether to round the array in place. The default is False.
+
+    Returns
+    -------
+    numpy.ndarray
+        The bit-rounded array.
+
+    """
+    mantissa_bits = get_mantissa_bits(x.dtype)
+    if not isinstance(keepbits, (int, np.integer)) or not 0 <= keepbits <= mantissa_bits:
+        raise ValueError(f"'keepbits' must be an integer between 0 and {mantissa_bits}.")
+    if not inplace:
+        x = x.copy()
+    if keepbits == mantissa_bits:
+        return x
+    is_nan = np.isnan(x)
+    has_nan = bool(is_nan.any())
+    bits = x.view(np.dtype(f"u{x.dtype.itemsize}"))
+    maskbits = mantissa_bits - int(keepbits)
+    mask = bits.dtype.type(~((1 << maskbits) - 1) & np.iinfo(bits.dtype).max)
+    half_quantum = bits.dtype.type((1 << (maskbits - 1)) - 1)
+    # Round to nearest (ties to even): add the last kept bit and half a quantum minus one
+    lsb = np.right_shift(bits, bits.dtype.type(maskbits))
+    np.bitwise_and(lsb, bits.dtype.type(1), out=lsb)
+    np.add(lsb, half_quantum, out=lsb)
+    np.add(bits, lsb, out=bits)
+    np.bitwise_and(bits, mask, out=bits)
+    if has_nan:
+        x[is_nan] = np.nan
+    return x
+
+
+def bitround_dataarray(da, keepbits):
+    """Bit-round a float DataArray. Dask arrays are bit-rounded lazily, chunk by chunk."""
+    if keepbits is None:
+        return da
+    get_mantissa_bits(da.dtype)
+    da = da.copy(deep=False)
+    if da.chunks is not None:
+        da.data = da.data.map_blocks(bitround, keepbits=keepbits, dtype=da.dtype)
+    else:
+        da.data = bitround(da.data, keepbits=keepbits)
+    return da
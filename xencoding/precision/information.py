@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Created on Sun Oct 20 11:05:48 2024
+
+@author: ghiggi
+"""
+from statistics import NormalDist
+
+import numpy as np
+
+from xencoding.precision.bitround import EXPONENT_BITS, MANTISSA_BITS, get_mantissa_bits
+
+
+def _get_significance_threshold(n, confidence):
+    """Return the mutual information of two independent bits that is not significant.
+
+    The threshold is the information of a binomial proportion at the upper bound
+    of its confidence interval around 0.5, given n samples.
+    """
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = min(0.5 + 0.5 * z / np.sqrt(n), 1)
+    entropy = -p * np.log2(p) - (1 - p) * np.log2(1 - p) if p < 1 else 0
+    return 1 - entropy
+
+
+def _get_bit_sums(u, batch_size):
+    """Return the number of set bits at each bit position of an unsigned integer array.
+
+    Bit positions are ordered from the most significant bit (sign bit) to the least significant.
+    """
+    itemsize = u.dtype.itemsize
+    sums = np.zeros(8 * itemsize, dtype=np.int64)
+    # Values are processed by batches to bound the memory of the unpacked bits
+    for i in range(0, u.size, batch_size):
+        u_bytes = u[i : i + batch_size].astype(u.dtype.newbyteorder(">"), copy=False)
+        bits = np.unpackbits(u_bytes.view(np.uint8).reshape(-1, itemsize), axis=1)
+        sums += bits.sum(axis=0, dtype=np.int64)
+    return sums
+
+
+def _get_bit_pair_counts(x, axis=0, batch_size=1_000_000):
+    """Return the counts of the bit pairs (00, 01, 10, 11) of adjacent values along an axis.
+
+    Returns an array (n_bits, 4), from the sign bit to the last mantissa bit.
+    Pairs of adjacent values including NaN are discarded.
+    """
+    x = np.moveaxis(np.asarray(x), axis, 0)
+    a = x[:-1].ravel()
+    b = x[1:].ravel()
+    is_valid = ~(np.isnan(a) | np.isnan(b))
+    uint_dtype = np.dtype(f"u{x.dtype.itemsize}")
+    a = a[is_valid].view(uint_dtype)
+    b = b[is_valid].view(uint_dtype)
+    n11 = _get_bit_sums(a & b, batch_size=batch_size)
+    n10 = _get_bit_sums(a, batch_size=batch_size) - n11
+    n01 = _get_bit_sums(b, batch_size=batch_size) - n11
+    n00 = a.size - n11 - n10 - n01
+    return np.stack([n00, n01, n10, n11], axis=1)
+
+
+def _get_mutual_information(counts, confidence=0.99):
+    """Return the mutual information of each bit from the bit pair counts.
+
+    Bits whose information is not significant at the given confidence level are set to 0.
+    """
+    n = counts[0].sum()
+    if n == 0:
+        return np.zeros(counts.shape[0])
+    p = counts.reshape(-1, 2, 2) / n
+    p_a = p.sum(axis=2, keepdims=True)
+    p_b = p.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = p * np.log2(p / (p_a * p_b))
+    bitinfo = np.nansum(terms, axis=(1, 2))
+    bitinfo[bitinfo <= _get_significance_threshold(n, confidence=confidence)] = 0
+    return bitinfo
+
+
+def get_bitinformation(x, axis=0, confidence=0.99):
+    """Return the information content of each bit of a float array.
+
+    The information of each bit is the mutual information between the bit of
+    adjacent values along an axis. Bits whose information is not significant
+    at the given confidence level are set to 0.
+    Pairs of adjacent values including NaN are discarded.
+
+    Parameters
+    ----------
+    x : (numpy.ndarray, list)
+        Float array, or a list of float arrays (i.e. a sample of chunks)
+        whose bit pairs are pooled.
+    axis : int, optional
+        Axis along which adjacent values are compared. The default is 0.
+    confidence : float, optional
+        Confidence level used to discard the non-significant information. The default is 0.99.
+
+    Returns
+    -------
+    numpy.ndarray
+        The information (in bits) of each bit, from the sign bit to the last mantissa bit.
+
+    """
+    arrays = x if isinstance(x, list) else [x]
+    for arr in arrays:
+        get_mantissa_bits(arr.dtype)
+    counts = sum(_get_bit_pair_counts(arr, axis=axis) for arr in arrays)
+    return _get_mutual_information(counts, confidence=confidence)
+
+
+def get_keepbits_from_bitinformation(bitinfo, dtype, inflevel=0.99):
+    """Return the number of mantissa bits required to preserve a fraction of the information.
+
+    The keepbits is the smallest number of mantissa bits such that the bits
+    from the sign bit to the last kept mantissa bit hold inflevel of the total information.
+    """
+    if not 0 < inflevel <= 1:
+        raise ValueError("'inflevel' must be between 0 and 1.")
+    dtype = np.dtype(dtype)
+    mantissa_bits = get_mantissa_bits(dtype)
+    total = bitinfo.sum()
+    if total == 0:
+        return 0
+    cum_fraction = np.cumsum(bitinfo) / total
+    nbits = int(np.argmax(cum_fraction >= inflevel - 1e-12)) + 1
+    return int(np.clip(nbits - EXPONENT_BITS[dtype.name], 0, mantissa_bits))
+
+
+def _get_float_variables(ds):
+    """Return the float data variables supporting bit-rounding."""
+    return [var for var in ds.data_vars if ds[var].dtype.name in MANTISSA_BITS]
+
+
+def get_information_content(
+    ds,
+    variables=None,
+    dims=None,
+    chunks=None,
+    n_samples=10,
+    confidence=0.99,
+    seed=0,
+):
+    """Return the information content of each bit of the float variables along each dimension.
+
+    The information is computed on a random sample of chunks (see sample_chunks()),
+    pooling the adjacent values within the sampled chunks.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    variables : list, optional
+        Variables to analyze. If None (the default), all float data variables.
+    dims : list, optional
+        Dimensions along which the information is computed.
+        If None (the default), all the dimensions of each variable.
+    chunks : (None, dict), optional
+        Chunks used to sample the Dataset. See check_chunks().
+        If None (the default), the current Dataset chunks are used.
+    n_samples : int, optional
+        Number of chunks sampled for each variable. The default is 10.
+    confidence : float, optional
+        Confidence level used to discard the non-significant information. The default is 0.99.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    bitinfo : dict
+        Dictionary with format {<variable>: {<dim>: <information of each bit>}}.
+
+    """
+    from xencoding.zarr.estimation import _get_sampling_chunks, sample_chunks
+
+    if variables is None:
+        variables = _get_float_variables(ds)
+    sampling_chunks = _get_sampling_chunks(ds, chunks=chunks)
+    bitinfo = {}
+    for var in variables:
+        da = ds[var]
+        samples = sample_chunks(da, chunks=sampling_chunks[var], n_samples=n_samples, seed=seed)
+        var_dims = [dim for dim in da.dims if dims is None or dim in dims]
+        bitinfo[var] = {
+            dim: get_bitinformation(samples, axis=da.dims.index(dim), confidence=confidence)
+            for dim in var_dims
+            if da.sizes[dim] > 1
+        }
+    return bitinfo
+
+
+def get_keepbits(
+    ds,
+    inflevel=0.99,
+    variables=None,
+    dims=None,
+    chunks=None,
+    n_samples=10,
+    confidence=0.99,
+    seed=0,
+):
+    """Return the keepbits of each float variable preserving a fraction of the information.
+
+    The information is computed along each dimension on a sample of chunks
+    (see get_information_content()), and the largest keepbits across the dimensions is retained.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    inflevel : (float, dict), optional
+        Fraction of the information to preserve. The default is 0.99.
+        A dictionary {<variable>: <inflevel>} can be used to specify it per variable.
+    variables : list, optional
+        Variables for which to compute the keepbits.
+        If None (the default), all float data variables (or the inflevel dictionary keys).
+    dims : list, optional
+        Dimensions along which the information is computed.
+        If None (the default), all the dimensions of each variable.
+    chunks : (None, dict), optional
+        Chunks used to sample the Dataset. See check_chunks().
+        If None (the default), the current Dataset chunks are used.
+    n_samples : int, optional
+        Number of chunks sampled for each variable. The default is 10.
+    confidence : float, optional
+        Confidence level used to discard the non-significant information. The default is 0.99.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    keepbits : dict
+        Dictionary with format {<variable>: <keepbits>}.
+        It can be passed to the keepbits argument of write_zarr().
+
+    """
+    if variables is None:
+        variables = list(inflevel) if isinstance(inflevel, dict) else _get_float_variables(ds)
+    inflevels = inflevel if isinstance(inflevel, dict) else {var: inflevel for var in variables}
+    bitinfo = get_information_content(
+        ds,
+        variables=variables,
+        dims=dims,
+        chunks=chunks,
+        n_samples=n_samples,
+        confidence=confidence,
+        seed=seed,
+    )
+    keepbits = {}
+    for var in variables:
+        dtype = ds[var].dtype
+        list_keepbits = [
+            get_keepbits_from_bitinformation(dim_bitinfo, dtype=dtype, inflevel=inflevels[var])
+            for dim_bitinfo in bitinfo[var].values()
+        ]
+        keepbits[var] = max(list_keepbits) if len(list_keepbits) > 0 else get_mantissa_bits(dtype)
+    return keepbits
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Created on Mon Oct 21 09:48:02 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+DEFAULT_PACKING_DTYPES = ["int8", "int16", "int32"]
+
+
+def _get_variables_min_max(ds, variables):
+    """Return the minimum and maximum of each variable, computed in a single dask reduction.
+
+    The min and max reductions of all variables share the same graph, so that each chunk is read once.
+    """
+    import dask
+
+    reductions = []
+    for var in variables:
+        reductions.extend([ds[var].min(), ds[var].max()])
+    values = dask.compute(*reductions)
+    return {
+        var: (float(values[2 * i]), float(values[2 * i + 1])) for i, var in enumerate(variables)
+    }
+
+
+def _get_packed_range(dtype):
+    """Return the fill value and the minimum and maximum packed values of an integer dtype.
+
+    The fill value is the minimum of signed dtypes and the maximum of unsigned dtypes.
+    """
+    info = np.iinfo(dtype)
+    if info.min < 0:
+        return info.min, info.min + 1, info.max
+    return info.max, info.min, info.max - 1
+
+
+def get_packing_params(vmin, vmax, precision, dtype, dtypes=DEFAULT_PACKING_DTYPES):
+    """Return the CF packing parameters of a variable with a required precision.
+
+    The scale_factor is twice the precision, reduced by the floating point rounding error
+    of the float dtype, so that the packing error is at most the precision.
+    The add_offset is the centre of the range [vmin, vmax], so that the packed values are
+    symmetric around the centre of the integer range (0 for signed dtypes) and the add_offset
+    magnitude does not depend on the integer dtype.
+    The smallest integer dtype within dtypes able to represent the range [vmin, vmax] is selected.
+    One value of the integer dtype is reserved for the _FillValue.
+
+    Parameters
+    ----------
+    vmin, vmax : float
+        Minimum and maximum of the variable.
+    precision : float
+        Maximum absolute error allowed by the packing.
+    dtype : numpy.dtype
+        Float dtype of the variable. It defines the dtype of scale_factor and add_offset.
+    dtypes : list, optional
+        Candidate integer dtypes, ordered by preference. The default is ["int8", "int16", "int32"].
+
+    Returns
+    -------
+    encoding : dict
+        The 'dtype', 'scale_factor', 'add_offset' and '_FillValue' encodings (or None if
+        the range can not be represented by the candidate dtypes with the required precision).
+
+    """
+    if precision <= 0:
+        raise ValueError("The packing precision must be a positive number.")
+    float_type = np.dtype(dtype).type
+    # Floating point rounding error of the packing and unpacking at the magnitude of the values
+    rounding_error = 4 * np.finfo(dtype).eps * max(abs(vmin), abs(vmax), 1)
+    if rounding_error >= precision:
+        return None
+    scale_factor = 2 * (precision - rounding_error)
+    add_offset = (vmin + vmax) / 2
+    half_levels = int(np.ceil((vmax - vmin) / 2 / scale_factor))
+    for int_dtype in dtypes:
+        fill_value, packed_min, packed_max = _get_packed_range(int_dtype)
+        packed_centre = (packed_min + packed_max) // 2
+        if half_levels <= min(packed_centre - packed_min, packed_max - packed_centre):
+            return {
+                "dtype": np.dtype(int_dtype),
+                "scale_factor": float_type(scale_factor),
+                "add_offset": float_type(add_offset - scale_factor * packed_centre),
+                "_FillValue": np.dtype(int_dtype).type(fill_value),
+            }
+    return None
+
+
+def _check_packed_range(min_max, encoding):
+    """Raise an error if the variables range exceeds the values representable by their packing.
+
+    Values outside the packed range would silently wrap around when cast to the integer dtype.
+    """
+    for var, var_encoding in encoding.items():
+        vmin, vmax = min_max[var]
+        if np.isnan(vmin):
+            continue
+        scale_factor = var_encoding.get("scale_factor", 1)
+        add_offset = var_encoding.get("add_offset", 0)
+        _, packed_min, packed_max = _get_packed_range(var_encoding["dtype"])
+        packed_values = np.round((np.array([vmin, vmax]) - add_offset) / scale_factor)
+        if packed_values.min() < packed_min or packed_values.max() > packed_max:
+            valid_min, valid_max = sorted(
+                [packed_min * scale_factor + add_offset, packed_max * scale_factor + add_offset]
+            )
+            raise ValueError(
+                f"The '{var}' values range [{vmin}, {vmax}] exceeds the range "
+                f"[{valid_min}, {valid_max}] representable by its packing encoding."
+            )
+
+
+def check_packing_range(ds, encoding):
+    """Check that the Dataset values fit the range of a packing encoding (i.e. of an existing store).
+
+    The minimum and maximum of all variables are computed in a single dask reduction.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    encoding : dict
+        Dictionary with format {<variable>: <encoding>}, with the 'dtype', 'scale_factor'
+        and 'add_offset' encodings of each variable.
+
+    """
+    if len(encoding) == 0:
+        return
+    min_max = _get_variables_min_max(ds, list(encoding))
+    _check_packed_range(min_max, encoding)
+
+
+def _pack(x, encoding):
+    """Pack a float array with CF packing parameters (NaN are set to the _FillValue)."""
+    packed = np.round((x - encoding["add_offset"]) / encoding["scale_factor"])
+    packed = np.where(np.isnan(x), encoding["_FillValue"], packed)
+    return packed.astype(encoding["dtype"])
+
+
+def _unpack(packed, encoding):
+    """Unpack an integer array with CF packing parameters (the _FillValue is set to NaN)."""
+    x = packed * encoding["scale_factor"] + encoding["add_offset"]
+    return np.where(packed == encoding["_FillValue"], np.nan, x)
+
+
+def get_packing_error(x, encoding):
+    """Return the maximum absolute error of the packing round-trip of an array."""
+    error = np.abs(_unpack(_pack(x, encoding), encoding) - x)
+    if np.all(np.isnan(error)):
+        return 0.0
+    return float(np.nanmax(error))
+
+
+def get_packing_encoding(
+    ds,
+    precision,
+    variables=None,
+    dtypes=DEFAULT_PACKING_DTYPES,
+    validate=True,
+    chunks=None,
+    n_samples=10,
+    seed=0,
+):
+    """Return the CF packing encoding of the float variables given the required precision.
+
+    The minimum and maximum of all variables are computed in a single dask reduction.
+    If validate=True, the packing round-trip error is checked on a random sample of chunks.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    precision : (float, dict)
+        Maximum absolute error allowed by the packing.
+        A dictionary {<variable>: <precision>} can be used to specify it per variable.
+    variables : list, optional
+        Variables to pack. If None (the default), all float data variables
+        (or the precision dictionary keys).
+    dtypes : list, optional
+        Candidate integer dtypes, ordered by preference. The default is ["int8", "int16", "int32"].
+    validate : bool, optional
+        Whether to check the packing round-trip error on a sample of chunks. The default is True.
+    chunks : (None, dict), optional
+        Chunks used to sample the Dataset. See check_chunks().
+        If None (the default), the current Dataset chunks are used.
+    n_samples : int, optional
+        Number of chunks sampled for each variable. The default is 10.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    encoding : dict
+        Dictionary with format {<variable>: <encoding>}.
+        Variables that can not be packed with the candidate dtypes (or only NaN) are not included.
+
+    """
+    from xencoding.zarr.estimation import _get_sampling_chunks, sample_chunks
+
+    if variables is None:
+        if isinstance(precision, dict):
+            variables = list(precision)
+        else:
+            variables = [var for var in ds.data_vars if ds[var].dtype.kind == "f"]
+    precisions = precision if isinstance(precision, dict) else {var: precision for var in variables}
+    min_max = _get_variables_min_max(ds, variables)
+    encoding = {}
+    for var in variables:
+        vmin, vmax = min_max[var]
+        if np.isnan(vmin):
+            continue
+        var_encoding = get_packing_params(
+            vmin, vmax, precision=precisions[var], dtype=ds[var].dtype, dtypes=dtypes
+        )
+        if var_encoding is not None:
+            encoding[var] = var_encoding
+    if validate:
+        _check_packed_range(min_max, encoding)
+        sampling_chunks = _get_sampling_chunks(ds, chunks=chunks)
+        for var, var_encoding in encoding.items():
+            samples = sample_chunks(
+                ds[var], chunks=sampling_chunks[var], n_samples=n_samples, seed=seed
+            )
+            error = max(get_packing_error(x, var_encoding) for x in samples)
+            if error > precisions[var]:
+                raise ValueError(
+                    f"The packing of '{var}' has a round-trip error of {error}, "
+                    f"larger than the required precision {precisions[var]}."
+                )
+    return encoding
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Created on Sat Oct 26 10:12:31 2024
+
+@author: ghiggi
+"""
+import os
+
+
+def list_files(path):
+    """Return the filepaths of a file or of all files within a directory."""
+    if os.path.isfile(path):
+        return [path]
+    fpaths = []
+    for root, _, files in os.walk(path):
+        fpaths.extend(os.path.join(root, file) for file in files)
+    return fpaths
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 17 11:02:15 2024
+
+@author: ghiggi
+"""
+import json
+import os
+
+
+def read_manifest(fpath):
+    """Read a JSON manifest. Return an empty dictionary if it does not exist."""
+    if not os.path.exists(fpath):
+        return {}
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def write_manifest(fpath, manifest):
+    """Write a JSON manifest atomically.
+
+    The manifest is first written to a temporary file which then replaces the
+    existing manifest, so that an interruption never leaves a corrupted manifest.
+    """
+    tmp_fpath = fpath + ".tmp"
+    with open(tmp_fpath, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Created on Mon Oct 28 09:47:15 2024
+
+@author: ghiggi
+"""
+import hashlib
+import json
+import os
+import pickle
+import platform
+import sqlite3
+import time
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError, version
+
+import numpy as np
+
+# Libraries affecting the benchmark results
+_LIBRARIES = ["numpy", "numcodecs", "zarr", "xarray", "dask", "netCDF4"]
+
+
+def get_default_cache_path():
+    """Return the default path of the result cache.
+
+    The cache directory can be specified with the XENCODING_CACHE_DIR environment variable.
+    """
+    cache_dir = os.environ.get(
+        "XENCODING_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "xencoding")
+    )
+    return os.path.join(cache_dir, "results.sqlite")
+
+
+def get_library_versions():
+    """Return the versions of the libraries affecting the benchmark results."""
+    versions = {}
+    for library in _LIBRARIES:
+        try:
+            versions[library] = version(library)
+        except PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+
+def get_environment_fingerprint():
+    """Return the library versions and the machine characteristics affecting the timings."""
+    return {
+        "versions": get_library_versions(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def get_arrays_fingerprint(arrays):
+    """Return a fast content fingerprint of a list of numpy arrays (i.e. sampled chunks)."""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.dtype.str}{arr.shape}".encode())
+        if arr.dtype.hasobject:
+            h.update(pickle.dumps(arr.tolist()))
+        else:
+            # - Bytes view, since datetime arrays do not export a buffer
+            h.update(arr.reshape(-1).view(np.uint8).data)
+    return h.hexdigest()
+
+
+def get_dataset_fingerprint(ds, chunks=None, n_samples=3, seed=0):
+    """Return a content fingerprint of a Dataset from a sample of chunks of each variable.
+
+    The variables names, dims, shapes and dtypes are included in the fingerprint.
+    See sample_chunks().
+    """
+    from xencoding.zarr.estimation import _get_sampling_chunks, sample_chunks
+
+    chunks = _get_sampling_chunks(ds, chunks=chunks)
+    h = hashlib.blake2b(digest_size=16)
+    for var in sorted(ds.data_vars):
+        da = ds[var]
+        h.update(f"{var}{da.dims}{da.shape}{da.dtype.str}".encode())
+        samples = sample_chunks(da, chunks=chunks[var], n_samples=n_samples, seed=seed)
+        h.update(get_arrays_fingerprint(samples).encode())
+    return h.hexdigest()
+
+
+def get_coords_fingerprint(ds):
+    """Return a content fingerprint of the coordinates of a Dataset (or DataArray).
+
+    Coordinates are usually small, so that all their values are fingerprinted.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for coord in sorted(ds.coords):
+        da = ds[coord]
+        h.update(f"{coord}{da.dims}{da.shape}{da.dtype.str}".encode())
+        h.update(get_arrays_fingerprint([da.values]).encode())
+    return h.hexdigest()
+
+
+def _to_serializable(obj):
+    """Convert the components of a cache key to JSON serializable objects."""
+    if hasattr(obj, "get_config"):  # i.e. numcodecs codecs
+        return obj.get_config()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (tuple, set)):
+        return list(obj)
+    return str(obj)
+
+
+def get_cache_key(**components):
+    """Return the cache key of a result from its components.
+
+    Components can be any JSON serializable objects or numcodecs codecs (hashed with get_config()).
+    """
+    text = json.dumps(components, sort_keys=True, default=_to_serializable)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    """Persistent cache of benchmark results stored in a local SQLite database.
+
+    Results are pickled and indexed by a cache key (see get_cache_key()).
+    When the cache exceeds max_size bytes or max_entries results, the least
+    recently used results are evicted.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path of the SQLite database. If None (the default), get_default_cache_path().
+    max_size : (int, str), optional
+        Maximum size (in bytes) of the cached results. A string (e.g. 100MB) can also be used.
+        The default is "100MB".
+    max_entries : int, optional
+        Maximum number of cached results. If None (the default), no limit.
+
+    """
+
+    def __init__(self, path=None, max_size="100MB", max_entries=None):
+        from dask.utils import parse_bytes
+
+        if path is None:
+            path = get_default_cache_path()
+        if isinstance(max_size, str):
+            max_size = parse_bytes(max_size)
+        if max_entries is not None and (not isinstance(max_entries, int) or max_entries < 1):
+            raise ValueError("'max_entries' must be a positive integer or None.")
+        self.path = path
+        self.max_size = max_size
+        self.max_entries = max_entries
+        dir_path = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    @contextmanager
+    def _connect(self):
+        """Open a connection committing the transaction on exit."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key, default=None):
+        """Return the cached result of a key (or default if not cached)."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        """Cache the result of a key and evict the least recently used results if required."""
+        blob = pickle.dumps(value)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """Evict the least recently used results exceeding max_size or max_entries."""
+        n_entries, size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        if size <= self.max_size and (self.max_entries is None or n_entries <= self.max_entries):
+            return
+        rows = conn.execute("SELECT key, size FROM results ORDER BY accessed ASC").fetchall()
+        evicted = []
+        for key, key_size in rows[:-1]:  # The most recent result is never evicted
+            if size <= self.max_size and (
+                self.max_entries is None or n_entries <= self.max_entries
+            ):
+                break
+            evicted.append((key,))
+            size -= key_size
+            n_entries -= 1
+        conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def __contains__(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self):
+        """Remove all cached results."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM results")
+
+    def get_size(self):
+        """Return the size (in bytes) of the cached results."""
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+
+def check_cache(cache):
+    """Check cache validity.
+
+    cache = None or False --> No cache.
+    cache = True --> Use the default ResultCache (see get_default_cache_path()).
+    cache = str --> Path of the ResultCache SQLite database.
+    cache = ResultCache --> Use the specified cache.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ResultCache()
+    if isinstance(cache, str):
+        return ResultCache(path=cache)
+    if not isinstance(cache, ResultCache):
+        raise TypeError("'cache' must be a ResultCache, a path, a boolean or None.")
+    return cache
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Created on Fri Oct 18 14:02:47 2024
+
+@author: ghiggi
+"""
+import os
+import time
+
+import numpy as np
+
+from xencoding.utils.files import list_files
+
+
+def evict_file_cache(path):
+    """Evict the files of a path (i.e. a zarr store) from the OS page cache.
+
+    Dirty pages are first flushed to disk, then the kernel is advised to drop the
+    cached pages with posix_fadvise(POSIX_FADV_DONTNEED).
+    Only available on platforms supporting posix_fadvise (i.e. Linux).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        raise NotImplementedError("Cold cache timing requires os.posix_fadvise (i.e. Linux).")
+    for fpath in list_files(path):
+        fd = os.open(fpath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def time_function(func, n_repetitions=5, n_warmup=1, setup=None):
+    """Return the execution times (in seconds) of a function.
+
+    The function is first executed n_warmup times without being timed.
+    The setup function (i.e. to evict the page cache or remove a store) is called
+    before each execution and is not timed.
+    """
+    if not isinstance(n_repetitions, int) or n_repetitions < 1:
+        raise ValueError("'n_repetitions' must be a positive integer.")
+    if not isinstance(n_warmup, int) or n_warmup < 0:
+        raise ValueError("'n_warmup' must be a non-negative integer.")
+    times = []
+    for i in range(n_warmup + n_repetitions):
+        if setup is not None:
+            setup()
+        t_i = time.perf_counter_ns()
+        func()
+        elapsed = (time.perf_counter_ns() - t_i) / 1e9
+        if i >= n_warmup:
+            times.append(elapsed)
+    return times
+
+
+def summarize_times(times, confidence=0.95, n_bootstrap=1000, seed=0):
+    """Summarize repeated measurements with robust statistics.
+
+    Returns the median, the interquartile range (IQR), the bootstrap percentile
+    confidence interval of the median, the min, the mean and the number of measurements.
+    """
+    if not 0 < confidence < 1:
+        raise ValueError("'confidence' must be between 0 and 1.")
+    times = np.asarray(times, dtype=float)
+    q25, median, q75 = np.quantile(times, [0.25, 0.5, 0.75])
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, times.size, size=(n_bootstrap, times.size))
+    medians = np.median(times[indices], axis=1)
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(medians, [alpha, 1 - alpha])
+    return {
+        "median": float(median),
+        "iqr": float(q75 - q25),
+        "q25": float(q25),
+        "q75": float(q75),
+        "median_ci": (float(lower), float(upper)),
+        "min": float(times.min()),
+        "mean": float(times.mean()),
+        "n": int(times.size),
+    }
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Created on Sat Oct 19 15:47:12 2024
+
+@author: ghiggi
+"""
+import time
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from xencoding.optimization.chunks import check_access_patterns
+from xencoding.utils.timing import evict_file_cache
+from xencoding.zarr.profiling import _InstrumentedStore, _running_profile
+
+
+def get_default_access_patterns(ds, time_dim="time", patch_fraction=0.1):
+    """Return the standard access patterns of a Dataset.
+
+    - 'timeseries': the full time-series at a random point.
+    - 'spatial': the full spatial field at a random time.
+    - 'patch': a spatio-temporal patch spanning patch_fraction of each dimension.
+    - 'full_scan': the entire Dataset.
+
+    Returns a dictionary with format {<pattern>: {<dim>: <read length>}}.
+    """
+    if time_dim not in ds.dims:
+        raise ValueError(f"'time_dim' {time_dim} is not a Dataset dimension.")
+    spatial_dims = [dim for dim in ds.dims if dim != time_dim]
+    return {
+        "timeseries": {time_dim: -1},
+        "spatial": {dim: -1 for dim in spatial_dims},
+        "patch": {dim: max(1, int(size * patch_fraction)) for dim, size in ds.sizes.items()},
+        "full_scan": {dim: -1 for dim in ds.dims},
+    }
+
+
+def _get_random_isel_dict(sizes, read_lengths, rng):
+    """Return the isel dictionary of a random request with the given read lengths."""
+    isel_dict = {}
+    for dim, length in read_lengths.items():
+        if length == sizes[dim]:
+            continue
+        start = int(rng.integers(0, sizes[dim] - length + 1))
+        isel_dict[dim] = slice(start, start + length)
+    return isel_dict
+
+
+def _get_returned_nbytes(ds):
+    """Return the size in bytes of the dask-backed variables of a Dataset."""
+    return sum(ds[var].nbytes for var in list(ds.variables) if ds[var].chunks is not None)
+
+
+def _summarize_requests(latencies, nbytes_returned, nbytes_decoded, nbytes_fetched):
+    """Summarize the latencies and the bytes of the requests of an access pattern."""
+    latencies = np.asarray(latencies)
+    p50, p90, p99 = np.quantile(latencies, [0.5, 0.9, 0.99])
+    total_returned = sum(nbytes_returned)
+    return {
+        "n_requests": int(latencies.size),
+        "latency_p50": float(p50),
+        "latency_p90": float(p90),
+        "latency_p99": float(p99),
+        "latency_mean": float(latencies.mean()),
+        "throughput": float(total_returned / 1024 / 1024 / latencies.sum()),
+        "nbytes_returned": int(total_returned),
+        "nbytes_decoded": int(sum(nbytes_decoded)),
+        "nbytes_fetched": int(sum(nbytes_fetched)),
+        "read_amplification": float(sum(nbytes_decoded) / total_returned),
+    }
+
+
+def benchmark_access_patterns(
+    fpath,
+    patterns=None,
+    variables=None,
+    time_dim="time",
+    n_requests=20,
+    n_full_scans=1,
+    n_warmup=1,
+    cold_cache=False,
+    seed=0,
+):
+    """Benchmark the reading of a zarr store with standard access patterns.
+
+    Each access pattern is read with random requests (i.e. at random positions).
+    The store is instrumented to count the bytes fetched and decompressed by each request.
+
+    Parameters
+    ----------
+    fpath : str
+        Filepath of the zarr store.
+    patterns : dict, optional
+        Access patterns with format {<pattern>: {<dim>: <read length>}}.
+        A read length of -1 or None corresponds to the entire dimension,
+        and unspecified dimensions are read at a single index. See check_access_patterns().
+        If None (the default), the patterns of get_default_access_patterns() are used.
+    variables : list, optional
+        Variables to read. If None (the default), all data variables.
+    time_dim : str, optional
+        Time dimension used to define the default patterns. The default is "time".
+    n_requests : int, optional
+        Number of random requests of each pattern. The default is 20.
+    n_full_scans : int, optional
+        Number of requests of patterns spanning the entire Dataset. The default is 1.
+    n_warmup : int, optional
+        Number of requests of each pattern executed before timing. The default is 1.
+    cold_cache : bool, optional
+        If True, the store files are evicted from the page cache before each request.
+        The default is False.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    benchmark_dict : dict
+        Dictionary with format {<pattern>: <summary>}.
+        Each summary includes the latency percentiles ('latency_p50', 'latency_p90',
+        'latency_p99', in seconds), the effective 'throughput' (MB/s of returned data),
+        the bytes returned, decompressed and fetched, and the 'read_amplification'
+        (bytes decompressed divided by bytes returned).
+
+    """
+    rng = np.random.default_rng(seed)
+    with _running_profile() as (profile_id, profile_counters):
+        store = _InstrumentedStore(zarr.DirectoryStore(fpath), profile_id=profile_id)
+        ds = xr.open_zarr(store)
+        if variables is not None:
+            ds = ds[variables]
+        if patterns is None:
+            patterns = get_default_access_patterns(ds, time_dim=time_dim)
+        sizes = dict(ds.sizes)
+        benchmark_dict = {}
+        for name, pattern in patterns.items():
+            read_lengths = check_access_patterns([pattern], ds)[0][0]
+            is_full_scan = read_lengths == sizes
+            n = n_full_scans if is_full_scan else n_requests
+            latencies, nbytes_returned, nbytes_decoded, nbytes_fetched = [], [], [], []
+            for i in range(n_warmup + n):
+                ds_request = ds.isel(_get_random_isel_dict(sizes, read_lengths, rng))
+                returned = _get_returned_nbytes(ds_request)
+                if cold_cache:
+                    evict_file_cache(fpath)
+                decoded_i = profile_counters.total("nbytes_decoded")
+                fetched_i = profile_counters.total("nbytes_fetched")
+                t_i = time.perf_counter_ns()
+                ds_request.compute()
+                elapsed = (time.perf_counter_ns() - t_i) / 1e9
+                if i < n_warmup:
+                    continue
+                latencies.append(elapsed)
+                nbytes_returned.append(returned)
+                nbytes_decoded.append(profile_counters.total("nbytes_decoded") - decoded_i)
+                nbytes_fetched.append(profile_counters.total("nbytes_fetched") - fetched_i)
+            benchmark_dict[name] = _summarize_requests(
+                latencies,
+                nbytes_returned=nbytes_returned,
+                nbytes_decoded=nbytes_decoded,
+                nbytes_fetched=nbytes_fetched,
+            )
+    return benchmark_dict
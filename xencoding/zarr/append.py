@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 17 11:15:40 2024
+
+@author: ghiggi
+"""
+import hashlib
+import os
+import warnings
+
+import numpy as np
+import xarray as xr
+import zarr
+
+from xencoding.precision.packing import check_packing_range
+from xencoding.utils.manifest import read_manifest, write_manifest
+from xencoding.zarr.regions import (
+    _get_region_slices,
+    _get_stream_block_size,
+    _get_stream_variables,
+    _get_variables_subset,
+    _write_zarr_region,
+    _write_zarr_regions,
+)
+
+MANIFEST_FILENAME = ".xencoding_manifest.json"
+
+
+def _get_manifest_path(zarr_fpath):
+    """Return the path of the appends manifest of a zarr store."""
+    return os.path.join(zarr_fpath, MANIFEST_FILENAME)
+
+
+def _get_values_fingerprint(values):
+    """Return a fingerprint of the coordinate values."""
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+def _define_manifest_entry(ds, append_dim, start, block_size=None):
+    """Define the manifest entry of a Dataset written at index start along append_dim."""
+    values = ds[append_dim].values
+    return {
+        "append_dim": append_dim,
+        "start": int(start),
+        "stop": int(start + values.size),
+        "first": str(values[0]),
+        "last": str(values[-1]),
+        "fingerprint": _get_values_fingerprint(values),
+        "block_size": block_size,
+        "completed_blocks": [],
+        "status": "pending",
+    }
+
+
+def _get_zarr_array_axis(arr, dim):
+    """Return the axis of a dimension in a zarr array written by xarray (or None)."""
+    dims = arr.attrs.get("_ARRAY_DIMENSIONS", [])
+    if dim not in dims:
+        return None
+    return dims.index(dim)
+
+
+def _get_store_chunks(group, ds, append_dim):
+    """Return the chunks of the store arrays of the Dataset variables with append_dim."""
+    store_chunks = {}
+    for var in list(ds.variables):
+        if var in group and append_dim in ds[var].dims:
+            store_chunks[var] = dict(zip(ds[var].dims, group[var].chunks))
+    return store_chunks
+
+
+def _align_chunks(size, chunk, start):
+    """Return the dask chunks of an array appended at index start of a store with the given chunk."""
+    first = min(chunk - start % chunk, size)
+    n_full, remainder = divmod(size - first, chunk)
+    chunks = (first,) + (chunk,) * n_full
+    if remainder > 0:
+        chunks = chunks + (remainder,)
+    return chunks
+
+
+def _align_to_store_chunks(ds, store_chunks, append_dim, start):
+    """Rechunk the dask variables to the store chunks, given the appending position.
+
+    Each dask chunk is then written to distinct store chunks.
+    """
+    for var, chunks in store_chunks.items():
+        if ds[var].chunks is None:
+            continue
+        new_chunks = {dim: chunk for dim, chunk in chunks.items() if dim != append_dim}
+        new_chunks[append_dim] = _align_chunks(ds.sizes[append_dim], chunks[append_dim], start)
+        ds[var] = ds[var].chunk(new_chunks)
+    return ds
+
+
+def _get_store_packing_encoding(group, variables):
+    """Return the CF packing encoding of the store arrays of the specified variables.
+
+    Only the integer arrays with a 'scale_factor' or 'add_offset' attribute are included.
+    """
+    encoding = {}
+    for var in variables:
+        if var not in group:
+            continue
+        arr = group[var]
+        attrs = arr.attrs
+        if arr.dtype.kind in ["i", "u"] and ("scale_factor" in attrs or "add_offset" in attrs):
+            encoding[var] = {
+                "dtype": arr.dtype,
+                "scale_factor": attrs.get("scale_factor", 1),
+                "add_offset": attrs.get("add_offset", 0),
+            }
+    return encoding
+
+
+def _resize_zarr_arrays(group, append_dim, size):
+    """Resize the store arrays along append_dim (to recover an interrupted append)."""
+    for _, arr in group.arrays():
+        axis = _get_zarr_array_axis(arr, append_dim)
+        if axis is not None and arr.shape[axis] != size:
+            shape = list(arr.shape)
+            shape[axis] = size
+            arr.resize(*shape)
+
+
+def _get_committed_values(zarr_fpath, append_dim, size):
+    """Return the coordinate values already written in the store."""
+    ds = xr.open_zarr(zarr_fpath, consolidated=False)
+    return ds[append_dim].values[:size]
+
+
+def _get_pending_entry(manifest):
+    """Return the interrupted append recorded in the manifest (or None)."""
+    for entry in manifest.get("appends", []):
+        if entry["status"] == "pending":
+            return entry
+    return None
+
+
+def _is_committed(manifest, ds, append_dim):
+    """Check if the Dataset has already been written in the store."""
+    fingerprint = _get_values_fingerprint(ds[append_dim].values)
+    for entry in manifest.get("appends", []):
+        if entry["status"] == "committed" and entry["fingerprint"] == fingerprint:
+            return True
+    return False
+
+
+def record_initial_write(zarr_fpath, ds, append_dim):
+    """Record in the manifest the pending write of the Dataset creating the store.
+
+    It must be called once the store metadata are created, before writing the data.
+    If the write is interrupted, the next append of the same Dataset resumes it.
+    See commit_initial_write() and append_zarr().
+    """
+    group = zarr.open_group(zarr_fpath, mode="r")
+    stream_vars, _ = _get_stream_variables(ds, append_dim)
+    chunk_sizes = [group[var].chunks[ds[var].dims.index(append_dim)] for var in stream_vars]
+    chunk_sizes = chunk_sizes if len(chunk_sizes) > 0 else [ds.sizes[append_dim]]
+    block_size = _get_stream_block_size(
+        ds, stream_dim=append_dim, stream_vars=stream_vars, chunk_sizes=chunk_sizes
+    )
+    entry = _define_manifest_entry(ds, append_dim, start=0, block_size=block_size)
+    write_manifest(_get_manifest_path(zarr_fpath), {"appends": [entry]})
+
+
+def commit_initial_write(zarr_fpath):
+    """Record in the manifest the completion of the write of the Dataset creating the store."""
+    manifest_path = _get_manifest_path(zarr_fpath)
+    manifest = read_manifest(manifest_path)
+    entry = manifest["appends"][0]
+    entry["status"] = "committed"
+    entry.pop("completed_blocks")
+    write_manifest(manifest_path, manifest)
+
+
+def append_zarr(zarr_fpath, ds, append_dim, max_mem=None, n_workers=1, consolidated=True):
+    """Append a Dataset to an existing zarr store with chunk-level completion tracking.
+
+    The appended ranges and the blocks of chunks already written are recorded in a manifest
+    inside the store. If the Dataset has already been appended, nothing is written.
+    If a previous append of the same Dataset was interrupted, only the missing blocks are written.
+    An error is raised if the coordinate values along append_dim are already present in the store,
+    or if the values of packed variables exceed the range of the store packing encoding.
+
+    Parameters
+    ----------
+    zarr_fpath : str
+        Filepath of the zarr store.
+    ds : xarray.Dataset
+        Dataset to append.
+    append_dim : str
+        Dimension along which to append.
+    max_mem : (int, str), optional
+        The amount of memory (in bytes) of the blocks written concurrently.
+        A string (e.g. 1GB) can also be used.
+        If None (the default), each block spans a single chunk along append_dim.
+    n_workers : int, optional
+        Number of blocks written concurrently. The default is 1.
+    consolidated : bool, optional
+        Whether to consolidate the store metadata. The default is True.
+
+    Returns
+    -------
+    bool
+        True if data have been written, False if the Dataset was already appended.
+
+    """
+    if append_dim not in ds.coords:
+        raise ValueError(f"'append_dim' {append_dim} must be a Dataset dimension coordinate.")
+    manifest_path = _get_manifest_path(zarr_fpath)
+    manifest = read_manifest(manifest_path)
+    manifest.setdefault("appends", [])
+
+    # Skip if the Dataset has already been appended
+    if _is_committed(manifest, ds, append_dim):
+        values = ds[append_dim].values
+        warnings.warn(
+            f"The {append_dim} range {values[0]} - {values[-1]} is already written.", stacklevel=2
+        )
+        return False
+
+    group = zarr.open_group(zarr_fpath, mode="r+")
+    # Check the values fit the packing of the store (otherwise they would wrap around)
+    check_packing_range(ds, _get_store_packing_encoding(group, variables=list(ds.data_vars)))
+    pending_entry = _get_pending_entry(manifest)
+    if pending_entry is not None:
+        # Resume an interrupted append
+        entry = pending_entry
+        if entry["fingerprint"] != _get_values_fingerprint(ds[append_dim].values):
+            raise ValueError(
+                f"The append of the {entry['append_dim']} range {entry['first']} - {entry['last']} "
+                "has been interrupted. Append the same Dataset to resume it before appending new data."
+            )
+        start = entry["start"]
+        _resize_zarr_arrays(group, append_dim=append_dim, size=entry["stop"])
+        ds = _align_to_store_chunks(
+            ds, _get_store_chunks(group, ds, append_dim), append_dim=append_dim, start=start
+        )
+        # Rewrite the dask-backed variables without append_dim of an interrupted store creation
+        if start == 0:
+            _, static_vars = _get_stream_variables(ds, append_dim)
+            for var in static_vars:
+                region = {dim: slice(0, size) for dim, size in ds[var].sizes.items()}
+                _write_zarr_region(_get_variables_subset(ds, [var]), zarr_fpath, region=region)
+        # Rewrite the variables not backed by dask (i.e. coordinates)
+        non_dask_vars = [
+            var
+            for var in list(ds.variables)
+            if ds[var].chunks is None and append_dim in ds[var].dims
+        ]
+        ds[non_dask_vars].to_zarr(
+            store=zarr_fpath,
+            region={append_dim: slice(start, entry["stop"])},
+            mode="a",
+            consolidated=False,
+        )
+    else:
+        # Check coordinate values are not already in the store
+        start = group[append_dim].shape[0]
+        committed_values = _get_committed_values(zarr_fpath, append_dim, size=start)
+        is_overlapping = np.isin(ds[append_dim].values, committed_values)
+        if np.any(is_overlapping):
+            raise ValueError(
+                f"{int(is_overlapping.sum())} {append_dim} values are already present in the store."
+            )
+        ds = _align_to_store_chunks(
+            ds, _get_store_chunks(group, ds, append_dim), append_dim=append_dim, start=start
+        )
+        stream_vars, _ = _get_stream_variables(ds, append_dim)
+        chunk_sizes = [group[var].chunks[ds[var].dims.index(append_dim)] for var in stream_vars]
+        chunk_sizes = chunk_sizes if len(chunk_sizes) > 0 else [ds.sizes[append_dim]]
+        block_size = _get_stream_block_size(
+            ds,
+            stream_dim=append_dim,
+            stream_vars=stream_vars,
+            chunk_sizes=chunk_sizes,
+            max_mem=max_mem,
+            n_workers=n_workers,
+        )
+        # Record the append before modifying the store
+        entry = _define_manifest_entry(ds, append_dim, start=start, block_size=block_size)
+        manifest["appends"].append(entry)
+        write_manifest(manifest_path, manifest)
+        # Resize the arrays and write the variables not backed by dask
+        ds.to_zarr(
+            store=zarr_fpath,
+            mode="a",
+            append_dim=append_dim,
+            synchronizer=None,
+            group=None,
+            consolidated=False,
+            compute=False,
+        )
+
+    # Write the remaining blocks of chunks
+    completed_blocks = [tuple(block) for block in entry["completed_blocks"]]
+    slices = _get_region_slices(entry["stop"], block_size=entry["block_size"], start=start)
+    slices = [slc for slc in slices if (slc.start, slc.stop) not in completed_blocks]
+
+    def _record_block(slc):
+        entry["completed_blocks"].append([slc.start, slc.stop])
+        write_manifest(manifest_path, manifest)
+
+    _write_zarr_regions(
+        ds,
+        zarr_store=zarr_fpath,
+        stream_dim=append_dim,
+        slices=slices,
+        offset=start,
+        n_workers=n_workers,
+        mode="a",
+        callback=_record_block,
+    )
+
+    # Commit the append
+    entry["status"] = "committed"
+    entry.pop("completed_blocks")
+    write_manifest(manifest_path, manifest)
+    if consolidated:
+        zarr.consolidate_metadata(zarr_fpath)
+    return True
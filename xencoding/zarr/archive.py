@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 24 09:21:36 2024
+
+@author: ghiggi
+"""
+import mmap
+import os
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import zarr
+
+from xencoding.utils.files import list_files
+
+# Size and format of the zip local file header (followed by the file name and the extra field)
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_FORMAT = "<4s5H3L2H"
+
+_METADATA_KEYS = [".zarray", ".zgroup", ".zattrs"]
+
+
+def _get_store_keys(dir_path):
+    """Return the keys of all the files of a zarr DirectoryStore."""
+    return sorted(
+        os.path.relpath(fpath, dir_path).replace(os.sep, "/") for fpath in list_files(dir_path)
+    )
+
+
+def _read_file(fpath):
+    with open(fpath, "rb") as f:
+        return f.read()
+
+
+def _get_consolidated_metadata(dir_path, keys):
+    """Return the consolidated metadata (.zmetadata) of a DirectoryStore without modifying it."""
+    metadata_store = {
+        key: _read_file(os.path.join(dir_path, key))
+        for key in keys
+        if os.path.basename(key) in _METADATA_KEYS
+    }
+    zarr.consolidate_metadata(metadata_store)
+    return metadata_store[".zmetadata"]
+
+
+def _iter_batches(keys, batch_size):
+    for i in range(0, len(keys), batch_size):
+        yield keys[i : i + batch_size]
+
+
+def pack_zarr_store(src_path, dst_path, n_workers=8, batch_size=None, consolidated=True):
+    """Pack a zarr DirectoryStore into a single uncompressed zip file (readable as a ZipStore).
+
+    Files are read in parallel by n_workers threads and written sequentially
+    as uncompressed (ZIP_STORED) entries, so that each entry can be read
+    with a single (memory-mapped) read. See MmapZipStore.
+    The zip central directory acts as the index of the store keys.
+
+    Parameters
+    ----------
+    src_path : str
+        Path of the zarr DirectoryStore.
+    dst_path : str
+        Path of the zip file.
+    n_workers : int, optional
+        Number of threads reading the store files. The default is 8.
+    batch_size : int, optional
+        Number of files read concurrently before being written.
+        It bounds the memory usage. If None (the default), 16 files per thread.
+    consolidated : bool, optional
+        Whether to add the consolidated metadata (.zmetadata) if the store does not include it.
+        The source store is not modified. The default is True.
+
+    Returns
+    -------
+    n_files : int
+        Number of packed files.
+
+    """
+    if not os.path.isdir(src_path):
+        raise ValueError(f"{src_path} is not a zarr DirectoryStore.")
+    if os.path.exists(dst_path):
+        raise ValueError(dst_path + " already exists!")
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("'n_workers' must be a positive integer.")
+    if batch_size is None:
+        batch_size = 16 * n_workers
+    keys = _get_store_keys(src_path)
+    with zipfile.ZipFile(dst_path, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        # - Metadata first, so that they are located at the start of the file
+        if consolidated and ".zmetadata" not in keys:
+            zf.writestr(".zmetadata", _get_consolidated_metadata(src_path, keys))
+        keys = sorted(keys, key=lambda key: os.path.basename(key) not in _METADATA_KEYS)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for batch_keys in _iter_batches(keys, batch_size):
+                fpaths = [os.path.join(src_path, key) for key in batch_keys]
+                for key, data in zip(batch_keys, executor.map(_read_file, fpaths)):
+                    zf.writestr(key, data)
+    return len(keys)
+
+
+def _write_file(fpath, data):
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath, "wb") as f:
+        f.write(data)
+
+
+def unpack_zarr_store(src_path, dst_path, n_workers=8):
+    """Unpack a zip file (i.e. packed with pack_zarr_store) into a zarr DirectoryStore.
+
+    Entries are read from the memory-mapped zip file and written in parallel by n_workers threads.
+
+    Returns
+    -------
+    n_files : int
+        Number of unpacked files.
+
+    """
+    if os.path.exists(dst_path):
+        raise ValueError(dst_path + " already exists!")
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("'n_workers' must be a positive integer.")
+    store = MmapZipStore(src_path)
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    _write_file, os.path.join(dst_path, *key.split("/")), store._get_buffer(key)
+                )
+                for key in store
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        store.close()
+    return len(futures)
+
+
+def _get_zip_index(fpath, zf):
+    """Return the (offset, size) of the data of each entry of an uncompressed zip file.
+
+    The data offset is read from the local header of each entry, since its
+    extra field can differ from the one of the central directory.
+    """
+    index = {}
+    with open(fpath, "rb") as f:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    f"The zip entry {info.filename} is compressed. "
+                    "Memory-mapped reading requires uncompressed entries (see pack_zarr_store)."
+                )
+            f.seek(info.header_offset)
+            header = struct.unpack(_LOCAL_HEADER_FORMAT, f.read(_LOCAL_HEADER_SIZE))
+            filename_length, extra_length = header[-2:]
+            offset = info.header_offset + _LOCAL_HEADER_SIZE + filename_length + extra_length
+            index[info.filename] = (offset, info.file_size)
+    return index
+
+
+class MmapZipStore(zarr.storage.BaseStore):
+    """Read-only zarr store reading the entries of an uncompressed zip file from a memory map.
+
+    The zip index is built once when the store is opened, and each key is returned as a
+    zero-copy view of the memory-mapped file. Only the pages of the requested chunks are read.
+    """
+
+    _writeable = False
+    _erasable = False
+    _listable = True
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path, mode="r") as zf:
+            self._index = _get_zip_index(path, zf)
+        self._file = open(path, "rb")
+        if os.path.getsize(path) > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b""
+        self._buffer = memoryview(self._mmap)
+
+    def _get_buffer(self, key):
+        offset, size = self._index[key]
+        return self._buffer[offset : offset + size]
+
+    def __getitem__(self, key):
+        return self._get_buffer(key)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("MmapZipStore is read-only.")
+
+    def __delitem__(self, key):
+        raise PermissionError("MmapZipStore is read-only.")
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def listdir(self, path=None):
+        """Return the names of the keys and sub-directories directly under a path."""
+        prefix = "" if not path else path.rstrip("/") + "/"
+        children = {
+            key[len(prefix) :].split("/")[0] for key in self._index if key.startswith(prefix)
+        }
+        return sorted(children)
+
+    def getsize(self, path=None):
+        """Return the size (in bytes) of a key or of all the keys under a path."""
+        if path in self._index:
+            return self._index[path][1]
+        prefix = "" if not path else path.rstrip("/") + "/"
+        return sum(size for key, (_, size) in self._index.items() if key.startswith(prefix))
+
+    def close(self):
+        """Close the memory map.
+
+        If views of the store keys are still in use, the references to the memory map
+        are dropped and the file is unmapped by the garbage collector once the views are released.
+        """
+        if self._buffer is None:
+            return
+        try:
+            self._buffer.release()
+            if isinstance(self._mmap, mmap.mmap):
+                self._mmap.close()
+        except BufferError:
+            pass
+        self._buffer = None
+        self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+def open_packed_zarr(fpath, use_mmap=True, **kwargs):
+    """Open a packed zarr store (zip file) as xarray Dataset.
+
+    If use_mmap=True, the store is read with MmapZipStore, otherwise with zarr.ZipStore.
+    The store is closed when the Dataset is closed (i.e. with ds.close()).
+    kwargs are passed to xarray.open_zarr.
+    """
+    import xarray as xr
+
+    store = MmapZipStore(fpath) if use_mmap else zarr.ZipStore(fpath, mode="r")
+    kwargs.setdefault("consolidated", ".zmetadata" in store)
+    ds = xr.open_zarr(store, **kwargs)
+    ds.set_close(store.close)
+    return ds
@@ -5,28 +5,46 @@ Created on Thu Aug  3 09:02:52 2023
 @author: ghiggi
 """
 import itertools
+import os
 import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 
 import numcodecs
 import numpy as np
 import xarray as xr
 import zarr
 
-from xencoding.zarr.writer import write_zarr
+from xencoding.checks.zarr_compressor import check_compressor
+from xencoding.checks.zarr_filters import check_filters
+from xencoding.utils.chunks import get_dataset_chunks
+from xencoding.utils.result_cache import (
+    check_cache,
+    get_cache_key,
+    get_coords_fingerprint,
+    get_dataset_fingerprint,
+    get_environment_fingerprint,
+)
+from xencoding.utils.timing import evict_file_cache, summarize_times, time_function
+from xencoding.zarr.mmap_store import open_zarr_mmap
+from xencoding.zarr.numcodecs import get_compressor, get_valid_blosc_algorithms
+from xencoding.zarr.profiling import profile_zarr_reading
+from xencoding.zarr.storage import (
+    _get_zarr_array_stats,
+    _open_zarr_group,
+    get_zarr_storage_stats,
+    get_zarr_storage_summary,
+)
+from xencoding.zarr.writer import set_compressor, set_filters, write_zarr
 
 
 ###############################################
 #### Utils for zarr io profiling and optim ####
 ###############################################
 #### Storage
-def _get_zarr_array_info_dict(arr):
-    return {k: v for k, v in arr.info_items()}
-
-
 def _get_zarr_array_storage_ratio(arr):
-    # arr.info.obj.nbytes/arr.info.obj.nbytes_stored
-    return float(_get_zarr_array_info_dict(arr)["Storage ratio"])
+    return _get_zarr_array_stats(arr)["storage_ratio"]
 
 
 def _get_zarr_nbytes_stored(arr):
@@ -37,38 +55,41 @@ def _get_zarr_nbytes(arr):
     return round(arr.info.obj.nbytes / 1024 / 1024, 3)
 
 
+def _get_zarr_coordinates_names(group):
+    """Return the name of the coordinates of a zarr store written by xarray."""
+    coords = set(group.attrs.get("coordinates", "").split())
+    for name, arr in group.arrays():
+        if arr.attrs.get("_ARRAY_DIMENSIONS", []) == [name]:
+            coords.add(name)
+        coords.update(arr.attrs.get("coordinates", "").split())
+    return coords
+
+
+def _get_nbytes_stored_zarr(fpath, coordinates):
+    """Return the nbytes stored (in MB) of the coordinates or the data variables."""
+    stats = get_zarr_storage_stats(fpath)
+    coords = _get_zarr_coordinates_names(_open_zarr_group(fpath))
+    return {
+        name: round(arr_stats["nbytes_stored"] / 1024 / 1024, 3)
+        for name, arr_stats in stats.items()
+        if (name in coords) == coordinates
+    }
+
+
 def get_nbytes_stored_zarr_variables(fpath):
     """Return nbytes stored each variable."""
-    ds = xr.open_zarr(fpath)
-    source_group = zarr.open(fpath)
-    variables = list(ds.data_vars.keys())
-    nbytes_stored = {}
-    for variable in variables:
-        nbytes_stored[variable] = _get_zarr_nbytes_stored(source_group[variable])
-    return nbytes_stored
+    return _get_nbytes_stored_zarr(fpath, coordinates=False)
 
 
 def get_nbytes_stored_zarr_coordinates(fpath):
-    """Return storage ratio for each variable."""
-    ds = xr.open_zarr(fpath)
-    source_group = zarr.open(fpath)
-    coords = list(ds.coords.keys())
-    nbytes_stored = {}
-    for coord in coords:
-        nbytes_stored[coord] = _get_zarr_nbytes_stored(source_group[coord])
-    return nbytes_stored
+    """Return nbytes stored each coordinate."""
+    return _get_nbytes_stored_zarr(fpath, coordinates=True)
 
 
 def get_storage_ratio_zarr(fpath):
     """Return storage ratio for the entire store."""
-    stored_nbytes_coords = get_nbytes_stored_zarr_coordinates(fpath)
-    stored_nbytes_variables = get_nbytes_stored_zarr_variables(fpath)
-    stored_nbytes = sum(stored_nbytes_coords.values()) + sum(stored_nbytes_variables.values())
-    ds = xr.open_zarr(fpath)
-    nbytes = ds.nbytes / 1024 / 1024
-    storage_ratio = nbytes / stored_nbytes
-    storage_ratio = round(storage_ratio, 3)
-    return storage_ratio
+    stats = get_zarr_storage_stats(fpath)
+    return get_zarr_storage_summary(stats)["storage_ratio"]
 
 
 ##----------------------------------------------------------------------------.
@@ -145,98 +166,630 @@ def get_memory_size_chunk(x):
 
 # -----------------------------------------------------------------------------.
 #### IO Timing
-import os
-from xencoding.zarr.numcodecs import (
-    get_valid_blosc_algorithms,
-    get_compressor,
-)
-from xencoding.checks.zarr_compressor import check_compressor
-from xencoding.zarr.writer import set_compressor
 
 
-def benchmark_compressors(ds, compressors_names, clevels, dst_dir="/tmp/", prefix="", suffix=""):
-    benchmark_dict = {} 
-    benchmark_dict["writing"] = {} 
-    benchmark_dict["reading"] = {}
-    benchmark_dict["filesize"] = {}
+def _get_compressor_acronym(compressor_name, clevel, algorithm="", prefix="", suffix=""):
+    """Return the acronym identifying a benchmarked compressor."""
+    if algorithm == "":
+        compressor_acronym = f"{compressor_name}_c{clevel}"
+    else:
+        compressor_acronym = f"{compressor_name}_{algorithm}_c{clevel}"
+    if prefix != "":
+        compressor_acronym = f"{prefix}_{compressor_acronym}"
+    if suffix != "":
+        compressor_acronym = f"{compressor_acronym}_{suffix}"
+    return compressor_acronym
+
+
+def _get_benchmark_candidates(compressors_names, clevels, prefix="", suffix="", filters=None):
+    """Return a dictionary with the compressor name, kwargs and filters of each benchmark candidate.
+
+    If filters is specified, a candidate is defined for each filters chain and
+    the filters name is appended to the compressor acronym.
+    A None filters chain (i.e. 'nofilter') removes the current filters.
+    """
+    if filters is None:
+        filters_chains = {"": None}  # keep the current filters
+    else:
+        filters_chains = {name: [] if chain is None else chain for name, chain in filters.items()}
+    candidates = {}
     for compressor_name in compressors_names:
         for clevel in clevels:
             if compressor_name == "blosc":
                 algorithms = get_valid_blosc_algorithms()
             else:
                 algorithms = [""]
-    
             for algorithm in algorithms:
                 # Define compressor kwargs
                 if compressor_name == "blosc":
                     kwargs = {"clevel": clevel, "algorithm": algorithm}
                 else:
                     kwargs = {"clevel": clevel}
-                # Define compressor name 
-                if algorithm == "":
-                    compressor_acronym = f"{compressor_name}_c{clevel}"
-                else:
-                    compressor_acronym = f"{compressor_name}_{algorithm}_c{clevel}"
-                if prefix != "": 
-                    compressor_acronym = f"{prefix}_{compressor_acronym}"
-                if suffix != "": 
-                    compressor_acronym = f"{compressor_acronym}_{suffix}"
-                # Define ZarrStore path
+                # Define compressor name
+                compressor_acronym = _get_compressor_acronym(
+                    compressor_name,
+                    clevel=clevel,
+                    algorithm=algorithm,
+                    prefix=prefix,
+                    suffix=suffix,
+                )
+                for filters_name, filters_chain in filters_chains.items():
+                    acronym = (
+                        compressor_acronym
+                        if filters_name == ""
+                        else (f"{compressor_acronym}_{filters_name}")
+                    )
+                    candidates[acronym] = (compressor_name, kwargs, filters_chain)
+    return candidates
+
+
+def _get_max_chunk_nbytes(ds):
+    """Return the size in bytes of the largest chunk across the Dataset variables."""
+    max_nbytes = 0
+    for var in list(ds.data_vars.keys()) + list(ds.coords.keys()):
+        da = ds[var]
+        if da.chunks is not None:
+            chunk_shape = [max(chunks) for chunks in da.chunks]
+        else:
+            chunk_shape = da.shape
+        max_nbytes = max(max_nbytes, int(np.prod(chunk_shape)) * da.dtype.itemsize)
+    return max_nbytes
+
+
+def _get_dask_num_workers(ds, max_mem):
+    """Return the number of dask threads that keeps the chunks in flight within max_mem.
+
+    Each dask thread is assumed to hold one decompressed and one compressed chunk.
+    """
+    from dask.utils import parse_bytes
+
+    if max_mem is None:
+        return None
+    if isinstance(max_mem, str):
+        max_mem = parse_bytes(max_mem)
+    chunk_nbytes = 2 * _get_max_chunk_nbytes(ds)
+    if chunk_nbytes > max_mem:
+        raise ValueError(
+            f"The largest Dataset chunk requires ~{chunk_nbytes / 1024 / 1024:.1f} MB, "
+            f"which exceeds 'max_mem'. Rechunk the Dataset or increase 'max_mem'."
+        )
+    return max(1, int(max_mem // chunk_nbytes))
+
+
+class _NullTarget:
+    """Dask store target discarding the data it receives."""
+
+    def __setitem__(self, key, value):
+        pass
+
+
+def _benchmark_compressor(
+    ds, compressor_name, compressor_kwargs, store_path, max_mem=None, filters=None
+):
+    """Return the writing time, file size and reading time of a Dataset with a given compressor.
+
+    If filters is specified, the filters chain is applied to the Dataset data variables.
+    If max_mem is specified, the number of dask threads is limited to keep the
+    memory usage within max_mem, and the data are not kept in memory when read back.
+    """
+    import dask
+    import dask.array
+
+    num_workers = _get_dask_num_workers(ds, max_mem=max_mem)
+    # - Within a benchmark worker, the dask threads are bounded by the cores of the worker
+    max_num_workers = dask.config.get("num_workers", None)
+    if num_workers is not None and max_num_workers is not None:
+        num_workers = min(num_workers, max_num_workers)
+    scheduler_kwargs = {} if num_workers is None else {"num_workers": num_workers}
+
+    # Set compressor
+    compressor = get_compressor(compressor_name=compressor_name, **compressor_kwargs)
+    compressor_dict = check_compressor(ds, compressor)
+    ds = set_compressor(ds, compressor_dict)
+    if filters is not None:
+        ds = set_filters(ds.copy(), filters_dict=check_filters(ds, filters=filters))
+
+    with dask.config.set(**scheduler_kwargs):
+        # Writing
+        t_i = time.time()
+        zarr_store = zarr.ZipStore(store_path, mode="w")
+        ds.to_zarr(store=zarr_store)
+        zarr_store.close()
+        t_f = time.time()
+        writing = round(t_f - t_i, 1)
+
+        # Measure file size
+        filesize = round(os.path.getsize(store_path) / (1024**2), 2)
+
+        # Reading
+        t_i = time.time()
+        ds_read = xr.open_zarr(store_path, chunks={}, decode_cf=True, mask_and_scale=True)
+        if max_mem is None:
+            ds_read = ds_read.compute()
+        else:
+            sources = [ds_read[var].data for var in list(ds_read.variables)]
+            sources = [arr for arr in sources if isinstance(arr, dask.array.Array)]
+            dask.array.store(sources, [_NullTarget()] * len(sources), lock=False)
+        t_f = time.time()
+        reading = round(t_f - t_i, 1)
+    return writing, filesize, reading
+
+
+# Dataset shared by the workers of the benchmark process pool
+_WORKER_DATASET = None
+
+
+def _write_benchmark_source(ds, source_path):
+    """Write the Dataset to an uncompressed zarr store read (lazily) by the benchmark workers.
+
+    The store chunks are the dask chunks, so that the workers open the Dataset with the same chunks.
+    Return the encodings of the Dataset variables, to be restored by the workers.
+    """
+    encodings = {var: ds[var].encoding.copy() for var in list(ds.variables)}
+    ds = ds.copy()
+    for var in list(ds.variables):
+        ds[var].encoding = {
+            key: value
+            for key, value in ds[var].encoding.items()
+            if key not in ["chunks", "preferred_chunks", "compressor"]
+        }
+        ds[var].encoding["compressor"] = None
+    ds.to_zarr(source_path, mode="w")
+    return encodings
+
+
+def _init_benchmark_worker(source_path, encodings, num_workers):
+    """Initialize a benchmark worker process.
+
+    The worker opens the Dataset lazily from the source store and restores its encodings.
+    The cores are divided among the workers: each worker uses num_workers dask threads,
+    and blosc internal threads are disabled.
+    """
+    import dask
+
+    global _WORKER_DATASET
+    _WORKER_DATASET = xr.open_zarr(source_path)
+    for var, encoding in encodings.items():
+        _WORKER_DATASET[var].encoding = encoding
+    dask.config.set(num_workers=num_workers)
+    numcodecs.blosc.use_threads = False
+
+
+def _run_benchmark_worker(compressor_name, compressor_kwargs, store_path, max_mem, filters):
+    """Benchmark a compressor on the Dataset of the worker process."""
+    return _benchmark_compressor(
+        _WORKER_DATASET,
+        compressor_name=compressor_name,
+        compressor_kwargs=compressor_kwargs,
+        store_path=store_path,
+        max_mem=max_mem,
+        filters=filters,
+    )
+
+
+# Encodings affecting the written data, besides the compressor and the chunks
+_BENCHMARK_ENCODING_KEYS = [
+    "dtype",
+    "scale_factor",
+    "add_offset",
+    "_FillValue",
+    "units",
+    "calendar",
+]
+
+
+def _get_variables_encodings(ds, filters=None):
+    """Return the encodings (besides the compressor) of each variable written by a candidate.
+
+    If filters is specified, the filters chain replaces the filters of the data variables.
+    """
+    filters_dict = {} if filters is None else check_filters(ds, filters=filters)
+    encodings = {}
+    for var in list(ds.variables):
+        encoding = ds[var].encoding
+        encodings[var] = {key: encoding[key] for key in _BENCHMARK_ENCODING_KEYS if key in encoding}
+        encodings[var]["filters"] = filters_dict.get(var, encoding.get("filters"))
+    return encodings
+
+
+def _get_benchmark_cache_keys(ds, candidates, max_mem, n_workers):
+    """Return the result cache key of each benchmark candidate.
+
+    The number of concurrent workers is included, since it affects the timings.
+    """
+    components = {
+        "task": "benchmark_compressors",
+        "fingerprint": get_dataset_fingerprint(ds),
+        "coords_fingerprint": get_coords_fingerprint(ds),
+        "chunks": get_dataset_chunks(ds),
+        "max_mem": max_mem,
+        "n_workers": n_workers,
+        "environment": get_environment_fingerprint(),
+    }
+    return {
+        compressor_acronym: get_cache_key(
+            compressor=get_compressor(compressor_name=compressor_name, **kwargs),
+            encodings=_get_variables_encodings(ds, filters=filters),
+            **components,
+        )
+        for compressor_acronym, (compressor_name, kwargs, filters) in candidates.items()
+    }
+
+
+def benchmark_compressors(
+    ds,
+    compressors_names,
+    clevels,
+    dst_dir="/tmp/",
+    prefix="",
+    suffix="",
+    n_workers=1,
+    max_mem=None,
+    cache=None,
+    filters=None,
+    show_progress=False,
+):
+    """Benchmark the writing time, reading time and file size of a Dataset with various compressors.
+
+    A candidate is defined for each compressor/clevel combination (and for each
+    algorithm if the compressor is 'blosc', and each filters chain if filters is specified).
+    Each candidate is written to a ZipStore in dst_dir.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    compressors_names : list
+        Names of the compressors to benchmark. See get_valid_compressors().
+    clevels : list
+        Compression levels to benchmark.
+    dst_dir : str, optional
+        Directory where to write the ZipStores. The default is "/tmp/".
+    prefix : str, optional
+        Prefix to add to the compressor acronyms. The default is "".
+    suffix : str, optional
+        Suffix to add to the compressor acronyms. The default is "".
+    n_workers : int, optional
+        Number of processes benchmarking the candidates concurrently.
+        If n_workers=1 (the default), candidates are benchmarked sequentially in the current process.
+        Otherwise, the Dataset is first written to an uncompressed zarr store in dst_dir,
+        which each worker opens lazily, and the cores are divided among the workers
+        (cpu_count // n_workers dask threads each, without blosc threads).
+        Concurrent candidates still compete for the disk and the memory bandwidth,
+        so that their timings are not comparable with the timings of n_workers=1.
+    max_mem : (int, str), optional
+        The amount of memory (in bytes) that each worker is allowed to use.
+        A string (e.g. 100MB) can also be used.
+        If specified, the number of dask threads of each worker is limited to keep
+        the chunks in flight within max_mem, and read data are not kept in memory.
+        The default is None.
+    cache : (None, bool, str, ResultCache), optional
+        Cache of the results. The results of each candidate are cached, keyed on the
+        content fingerprint of a sample of chunks and of the coordinates, the compressor
+        configuration, the filters and the other encodings of the variables,
+        the Dataset chunks, max_mem, n_workers and the library versions.
+        Only the candidates not cached are benchmarked. See check_cache().
+        The default is None (no cache).
+    filters : dict, optional
+        Filters chains to benchmark, with format {<filters_name>: <filters chain>}.
+        A None chain benchmarks the compressor without filters.
+        The filters chains are applied to all Dataset data variables.
+        See get_candidate_filters(). The default is None (the current filters encodings).
+    show_progress : bool, optional
+        Whether to display the progress bar of the dask writings and readings of each candidate.
+        Progress bars are not displayed when candidates are benchmarked concurrently.
+        The default is False.
+
+    Returns
+    -------
+    benchmark_dict : dict
+        Dictionary with the "writing" and "reading" times (in seconds) and
+        the "filesize" (in MB) of each candidate.
+
+    """
+    from dask.diagnostics import ProgressBar
+    from dask.system import CPU_COUNT
+
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("'n_workers' must be a positive integer.")
+    candidates = _get_benchmark_candidates(
+        compressors_names=compressors_names,
+        clevels=clevels,
+        prefix=prefix,
+        suffix=suffix,
+        filters=filters,
+    )
+    # Check the memory budget before launching the benchmark
+    _ = _get_dask_num_workers(ds, max_mem=max_mem)
+
+    # Retrieve the cached results
+    results = {}
+    cache = check_cache(cache)
+    if cache is not None:
+        cache_keys = _get_benchmark_cache_keys(
+            ds, candidates=candidates, max_mem=max_mem, n_workers=n_workers
+        )
+        for compressor_acronym, key in cache_keys.items():
+            cached = cache.get(key)
+            if cached is not None:
+                results[compressor_acronym] = cached
+    pending = {k: v for k, v in candidates.items() if k not in results}
+
+    if n_workers == 1 or len(pending) == 0:
+        for compressor_acronym, (compressor_name, kwargs, filters_chain) in pending.items():
+            store_path = os.path.join(dst_dir, f"example2_{compressor_acronym}.zarr.zip")
+            with ProgressBar() if show_progress else nullcontext():
+                results[compressor_acronym] = _benchmark_compressor(
+                    ds,
+                    compressor_name=compressor_name,
+                    compressor_kwargs=kwargs,
+                    store_path=store_path,
+                    max_mem=max_mem,
+                    filters=filters_chain,
+                )
+    else:
+        n_workers = min(n_workers, len(pending))
+        source_path = os.path.join(dst_dir, "benchmark_source.zarr")
+        encodings = _write_benchmark_source(ds, source_path=source_path)
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_benchmark_worker,
+            initargs=(source_path, encodings, max(CPU_COUNT // n_workers, 1)),
+        ) as executor:
+            futures = {}
+            for compressor_acronym, (compressor_name, kwargs, filters_chain) in pending.items():
                 store_path = os.path.join(dst_dir, f"example2_{compressor_acronym}.zarr.zip")
-                print(compressor_acronym)
-        
-                # Set compressor
-                compressor = get_compressor(compressor_name=compressor_name, **kwargs)
-                compressor_dict = check_compressor(ds, compressor)
-                ds = set_compressor(ds, compressor_dict)
-                
-                # Writing 
-                t_i = time.time()
-                zarr_store = zarr.ZipStore(store_path, mode="w")
-                ds.to_zarr(store=zarr_store)
-                zarr_store.close()
-                t_f = time.time()
-                benchmark_dict["writing"][compressor_acronym] = round(t_f - t_i, 1)
-                
-                # Measure file size 
-                benchmark_dict["filesize"][compressor_acronym] = round(os.path.getsize(store_path) / (1024 ** 2), 2)
-                
-                # Reading 
-                t_i = time.time()
-                ds_read = xr.open_zarr(
-                    store_path, chunks={}, decode_cf=True, mask_and_scale=True
+                future = executor.submit(
+                    _run_benchmark_worker,
+                    compressor_name,
+                    kwargs,
+                    store_path,
+                    max_mem,
+                    filters_chain,
                 )
-                ds_read = ds_read.compute()
-                t_f = time.time()
-                benchmark_dict["reading"][compressor_acronym] = round(t_f - t_i, 1)
-                
+                futures[future] = compressor_acronym
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        shutil.rmtree(source_path)
+
+    # Cache the new results
+    if cache is not None:
+        for compressor_acronym in pending:
+            cache.set(cache_keys[compressor_acronym], results[compressor_acronym])
+
+    # Define benchmark dictionary (following the candidates order)
+    benchmark_dict = {}
+    benchmark_dict["writing"] = {}
+    benchmark_dict["reading"] = {}
+    benchmark_dict["filesize"] = {}
+    for compressor_acronym in candidates:
+        writing, filesize, reading = results[compressor_acronym]
+        benchmark_dict["writing"][compressor_acronym] = writing
+        benchmark_dict["filesize"][compressor_acronym] = filesize
+        benchmark_dict["reading"][compressor_acronym] = reading
     return benchmark_dict
 
 
-def get_reading_time(fpath, isel_dict={}, n_repetitions=5):
-    """Return the reading time of a Dataset (subset)."""
+def _open_zarr(fpath, use_mmap=False):
+    """Open a zarr store (building the indexes of the dimension coordinates)."""
+    return open_zarr_mmap(fpath) if use_mmap else xr.open_zarr(fpath)
 
-    def _load(fpath, isel_dict):
-        ds = xr.open_zarr(fpath)
-        ds = ds.isel(isel_dict)
-        ds.load()
 
-    times = []
-    for i in range(1, n_repetitions):
-        t_i = time.time()
-        _load(fpath, isel_dict)
-        times.append(time.time() - t_i)
-    return times
+def _load_zarr(fpath, isel_dict, use_mmap=False):
+    """Open a zarr store and load a Dataset (subset) in memory."""
+    ds = _open_zarr(fpath, use_mmap=use_mmap)
+    ds.isel(isel_dict).load()
+    ds.close()
+
+
+def _open_close_zarr(fpath, use_mmap=False):
+    """Open a zarr store and close it."""
+    _open_zarr(fpath, use_mmap=use_mmap).close()
 
 
-def get_reading_throughput(fpath, isel_dict={}, n_repetitions=10):
+def _get_cache_setup(fpath, cold_cache):
+    """Return the setup function evicting the store from the page cache (or None)."""
+    if not cold_cache:
+        return None
+    return lambda: evict_file_cache(fpath)
+
+
+def get_reading_time(
+    fpath, isel_dict={}, n_repetitions=5, n_warmup=1, cold_cache=False, use_mmap=False
+):
+    """Return the reading times (in seconds) of a Dataset (subset).
+
+    If cold_cache=True, the store files are evicted from the page cache before each reading.
+    If use_mmap=True, the local store (or packed zip file) is read from memory-mapped
+    files without copying the chunks. See open_zarr_mmap().
+    The reading times include the store opening. See get_opening_time().
+    """
+    return time_function(
+        lambda: _load_zarr(fpath, isel_dict, use_mmap=use_mmap),
+        n_repetitions=n_repetitions,
+        n_warmup=n_warmup,
+        setup=_get_cache_setup(fpath, cold_cache),
+    )
+
+
+def get_opening_time(fpath, n_repetitions=5, n_warmup=1, cold_cache=False, use_mmap=False):
+    """Return the opening times (in seconds) of a zarr store.
+
+    The opening includes reading the store metadata and the dimension coordinates
+    to build the Dataset indexes, but not reading the data variables.
+    See the 'encode_coords' argument of write_zarr().
+    """
+    return time_function(
+        lambda: _open_close_zarr(fpath, use_mmap=use_mmap),
+        n_repetitions=n_repetitions,
+        n_warmup=n_warmup,
+        setup=_get_cache_setup(fpath, cold_cache),
+    )
+
+
+def get_reading_throughput(
+    fpath, isel_dict={}, n_repetitions=10, n_warmup=1, cold_cache=False, use_mmap=False
+):
     """Return the reading throughput (MB/s) of a Dataset (subset)."""
-    times = get_reading_time(fpath=fpath, isel_dict=isel_dict, n_repetitions=n_repetitions)
+    times = get_reading_time(
+        fpath=fpath,
+        isel_dict=isel_dict,
+        n_repetitions=n_repetitions,
+        n_warmup=n_warmup,
+        cold_cache=cold_cache,
+        use_mmap=use_mmap,
+    )
     size_dict = get_memory_size_zarr(fpath, isel_dict=isel_dict)
     throughput = sum(size_dict.values()) / np.array(times)
     return throughput.tolist()
 
 
+def _get_selected_chunk_keys(arr, isel_dict):
+    """Return the keys of the chunks of a zarr array intersecting a selection."""
+    dims = arr.attrs.get("_ARRAY_DIMENSIONS", [])
+    separator = arr._dimension_separator or "."
+    prefix = arr.path + "/" if arr.path else ""
+    if arr.ndim == 0:
+        return [prefix + "0"]
+    chunks_indices = []
+    for dim, size, chunk in zip(dims, arr.shape, arr.chunks):
+        indices = np.arange(size)
+        if dim in isel_dict:
+            indices = np.atleast_1d(indices[isel_dict[dim]])
+        chunks_indices.append(np.unique(indices // chunk))
+    return [
+        prefix + separator.join(str(i) for i in chunk_index)
+        for chunk_index in itertools.product(*chunks_indices)
+    ]
+
+
+def _time_chunks_decoding(store, arr, keys):
+    """Return the time (in seconds) to read the raw chunks and to decode them."""
+    read_time = 0
+    decode_time = 0
+    for key in keys:
+        t_i = time.perf_counter_ns()
+        try:
+            data = store[key]
+        except KeyError:
+            continue
+        t_r = time.perf_counter_ns()
+        if arr.compressor is not None:
+            data = arr.compressor.decode(data)
+        for f in reversed(arr.filters or []):
+            data = f.decode(data)
+        t_d = time.perf_counter_ns()
+        read_time += t_r - t_i
+        decode_time += t_d - t_r
+    return read_time / 1e9, decode_time / 1e9
+
+
+def _time_reading_phases(fpath, isel_dict, cold_cache):
+    """Return the time (in seconds) of each phase of the reading of a Dataset (subset).
+
+    The phases are:
+    - 'metadata': reading and parsing the store metadata.
+    - 'open': opening the Dataset with xr.open_zarr (excluding the metadata phase).
+    - 'read': reading the raw chunks from the store.
+    - 'decompression': decoding the chunks with the compressor and filters.
+    - 'assembly': dask scheduling, indexing, CF decoding and assembling the arrays.
+    The raw chunks are read and decoded in a separate pass, which is subtracted
+    from the Dataset loading time to obtain the 'assembly' time.
+    """
+    setup = _get_cache_setup(fpath, cold_cache)
+    if setup is not None:
+        setup()
+    t_i = time.perf_counter_ns()
+    store = zarr.DirectoryStore(fpath)
+    group = _open_zarr_group(store)
+    t_m = time.perf_counter_ns()
+    ds = xr.open_zarr(fpath)
+    t_o = time.perf_counter_ns()
+    ds.isel(isel_dict).load()
+    t_l = time.perf_counter_ns()
+    phases = {
+        "metadata": (t_m - t_i) / 1e9,
+        "open": max((t_o - t_m) - (t_m - t_i), 0) / 1e9,
+        "read": 0,
+        "decompression": 0,
+    }
+    load_time = (t_l - t_o) / 1e9
+    # Read and decode the raw chunks of the selection
+    if setup is not None:
+        setup()
+    for var in list(ds.variables):
+        arr = group[var]
+        dims = ds[var].dims
+        var_isel_dict = {dim: value for dim, value in isel_dict.items() if dim in dims}
+        keys = _get_selected_chunk_keys(arr, var_isel_dict)
+        read_time, decode_time = _time_chunks_decoding(store, arr, keys)
+        phases["read"] += read_time
+        phases["decompression"] += decode_time
+    phases["assembly"] = max(load_time - phases["read"] - phases["decompression"], 0)
+    phases["total"] = (t_l - t_i) / 1e9
+    return phases
+
+
+def benchmark_reading(
+    fpath,
+    isel_dict={},
+    n_repetitions=5,
+    n_warmup=1,
+    cold_cache=False,
+    confidence=0.95,
+    n_bootstrap=1000,
+    seed=0,
+):
+    """Benchmark the reading of a Dataset (subset) from a zarr DirectoryStore.
+
+    Each repetition is timed with perf_counter_ns and split into phases.
+    See _time_reading_phases().
+
+    Parameters
+    ----------
+    fpath : str
+        Filepath of the zarr store.
+    isel_dict : dict, optional
+        Selection of the Dataset subset to read. The default is {}.
+    n_repetitions : int, optional
+        Number of timed repetitions. The default is 5.
+    n_warmup : int, optional
+        Number of repetitions executed before timing. The default is 1.
+    cold_cache : bool, optional
+        If True, the store files are evicted from the page cache (with posix_fadvise)
+        before each repetition. The default is False.
+    confidence : float, optional
+        Confidence level of the median confidence intervals. The default is 0.95.
+    n_bootstrap : int, optional
+        Number of bootstrap resamples. The default is 1000.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    benchmark_dict : dict
+        Summary statistics (see summarize_times()) of the 'total' time, of each phase
+        ('metadata', 'open', 'read', 'decompression', 'assembly') and of the
+        'throughput' (in MB/s).
+
+    """
+    for _ in range(n_warmup):
+        _time_reading_phases(fpath, isel_dict=isel_dict, cold_cache=cold_cache)
+    list_phases = [
+        _time_reading_phases(fpath, isel_dict=isel_dict, cold_cache=cold_cache)
+        for _ in range(n_repetitions)
+    ]
+    nbytes = sum(get_memory_size_zarr(fpath, isel_dict=isel_dict).values())
+    summary_kwargs = {"confidence": confidence, "n_bootstrap": n_bootstrap, "seed": seed}
+    benchmark_dict = {}
+    for phase in list_phases[0]:
+        times = [phases[phase] for phases in list_phases]
+        benchmark_dict[phase] = summarize_times(times, **summary_kwargs)
+    throughput = [nbytes / phases["total"] for phases in list_phases]
+    benchmark_dict["throughput"] = summarize_times(throughput, **summary_kwargs)
+    return benchmark_dict
+
+
 def get_writing_time(
     ds,
     fpath,
@@ -245,11 +798,20 @@ def get_writing_time(
     consolidated=True,
     n_repetitions=5,
     remove_last=True,
+    n_warmup=1,
 ):
-    """Return the writing time of a Dataset."""
-    times = []
-    for i in range(1, n_repetitions):
-        t_i = time.time()
+    """Return the writing times (in seconds) of a Dataset.
+
+    The store is removed before each writing (and is not timed).
+    """
+    if not fpath.endswith(".zarr"):
+        fpath = fpath + ".zarr"
+
+    def _remove_store():
+        if os.path.exists(fpath):
+            shutil.rmtree(fpath)
+
+    def _write():
         write_zarr(
             zarr_fpath=fpath,
             ds=ds,
@@ -258,12 +820,12 @@ def get_writing_time(
             consolidated=consolidated,
             show_progress=False,
         )
-        times.append(time.time() - t_i)
-        if i < n_repetitions - 1:
-            # Remove store
-            shutil.rmtree(fpath)
+
+    times = time_function(
+        _write, n_repetitions=n_repetitions, n_warmup=n_warmup, setup=_remove_store
+    )
     if remove_last:
-        shutil.rmtree(fpath)
+        _remove_store()
     return times
 
 
@@ -275,6 +837,7 @@ def get_writing_throughput(
     consolidated=True,
     n_repetitions=5,
     remove_last=True,
+    n_warmup=1,
 ):
     """Return the writing throughput (MB/s) of a Dataset."""
     times = get_writing_time(
@@ -285,6 +848,7 @@ def get_writing_throughput(
         consolidated=consolidated,
         n_repetitions=n_repetitions,
         remove_last=remove_last,
+        n_warmup=n_warmup,
     )
     size_dict = get_memory_size_dataset(ds)
     throughput = sum(size_dict.values()) / np.array(times)
@@ -299,8 +863,33 @@ def profile_zarr_io(
     isel_dict={},
     consolidated=True,
     n_repetitions=5,
+    breakdown=False,
+    cache=None,
 ):
-    """Profile reading and writing of a Dataset."""
+    """Profile reading and writing of a Dataset.
+
+    If breakdown=True, the reading time of each variable is decomposed into
+    store, decoding and dask overhead times. See profile_zarr_reading().
+    If cache is specified, the profiling results are cached, keyed on the content
+    fingerprint of a sample of chunks, the compressor configuration, the chunks,
+    the profiling options and the library versions. See check_cache().
+    """
+    cache = check_cache(cache)
+    if cache is not None:
+        key = get_cache_key(
+            task="profile_zarr_io",
+            fingerprint=get_dataset_fingerprint(ds),
+            chunks=chunks if chunks is not None else get_dataset_chunks(ds),
+            compressor=compressor,
+            isel_dict=isel_dict,
+            consolidated=consolidated,
+            n_repetitions=n_repetitions,
+            breakdown=breakdown,
+            environment=get_environment_fingerprint(),
+        )
+        io_dict = cache.get(key)
+        if io_dict is not None:
+            return io_dict
     io_dict = {}
     io_dict["writing"] = get_writing_time(
         ds=ds,
@@ -318,7 +907,11 @@ def profile_zarr_io(
         fpath=fpath, isel_dict=isel_dict, n_repetitions=n_repetitions
     )
     io_dict["compression_ratio"] = get_storage_ratio_zarr(fpath=fpath)
+    if breakdown:
+        io_dict["reading_breakdown"] = profile_zarr_reading(fpath=fpath, isel_dict=isel_dict)
     shutil.rmtree(fpath)
+    if cache is not None:
+        cache.set(key, io_dict)
     return io_dict
 
 
@@ -346,7 +939,7 @@ def _get_lmza_compressors(clevels=[0, 1, 3, 5, 9]):
     """Get lmza compressors."""
     # - preset: compression level between 0 and 9
     # - dist: distance between bytes to be subtracted (default 1)
-    # Cannot specify filters except with FORMAT_RAW
+    # Cannot specify filters except with FORMAT_RAW (otherwise decoding fails)
     import lzma
 
     delta_dist = [None, 1, 2, 4]
@@ -359,7 +952,9 @@ def _get_lmza_compressors(clevels=[0, 1, 3, 5, 9]):
                 dict(id=lzma.FILTER_LZMA2, preset=clevel),
             ]
             k_name = "LZMA" + "_cl" + str(clevel) + "_delta" + str(delta_dist)
-            compressors[k_name] = numcodecs.LZMA(preset=None, filters=lzma_filters)
+            compressors[k_name] = numcodecs.LZMA(
+                format=lzma.FORMAT_RAW, preset=None, filters=lzma_filters
+            )
         else:
             k_name = "LZMA" + "_cl" + str(clevel) + "_nodelta"
             compressors[k_name] = numcodecs.LZMA(preset=clevel, filters=None)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Created on Fri Nov  1 09:41:18 2024
+
+@author: ghiggi
+"""
+import numcodecs
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+# Compressor of the encoded coordinates (favouring the decoding speed)
+COORDINATES_COMPRESSOR = numcodecs.Blosc(cname="lz4", clevel=5, shuffle=numcodecs.Blosc.NOSHUFFLE)
+
+# CF time units (in nanoseconds), from the coarsest to the finest
+_TIME_UNITS = {
+    "days": 86_400 * 10**9,
+    "hours": 3_600 * 10**9,
+    "minutes": 60 * 10**9,
+    "seconds": 10**9,
+    "milliseconds": 10**6,
+    "microseconds": 10**3,
+    "nanoseconds": 1,
+}
+
+
+def _get_compact_int_dtype(vmin, vmax):
+    """Return the smallest signed integer dtype representing the [vmin, vmax] range (or None)."""
+    for dtype in ["int8", "int16", "int32", "int64"]:
+        info = np.iinfo(dtype)
+        if info.min <= vmin and vmax <= info.max:
+            return np.dtype(dtype)
+    return None
+
+
+def is_monotonic_coordinate(values):
+    """Check if the values of a 1D coordinate are strictly increasing or decreasing."""
+    values = np.asarray(values)
+    if values.ndim != 1 or values.dtype.kind not in ["i", "u", "f", "M"]:
+        return False
+    if values.size < 2:
+        return True
+    if values.dtype.kind == "M":
+        if np.any(np.isnat(values)):
+            return False
+        values = values.astype("M8[ns]").astype("int64")
+    diff = np.diff(values)
+    return bool(np.all(diff > 0) or np.all(diff < 0))
+
+
+def get_coordinate_step(values, rtol=1e-6):
+    """Return the step of a regular 1D coordinate (or None if the coordinate is not regular).
+
+    The step of datetime coordinates is returned in nanoseconds.
+    """
+    if not is_monotonic_coordinate(values):
+        return None
+    values = np.asarray(values)
+    if values.size < 2:
+        return None
+    if values.dtype.kind == "M":
+        values = values.astype("M8[ns]").astype("int64")
+    diff = np.diff(values)
+    step = diff[0]
+    if values.dtype.kind == "f":
+        is_regular = np.allclose(diff, step, rtol=rtol, atol=0)
+    else:
+        is_regular = np.all(diff == step)
+    return step.item() if is_regular else None
+
+
+def _is_lossless_encoding(da, encoding):
+    """Check that a coordinate written with the encoding is read back exactly (dtype and values).
+
+    The round trip is performed with an in-memory zarr store.
+    """
+    var = da.variable.compute()
+    var.encoding = encoding.copy()
+    store = zarr.MemoryStore()
+    try:
+        xr.Dataset(coords={da.name: var}).to_zarr(store, consolidated=False)
+        decoded = xr.open_zarr(store, consolidated=False)[da.name].load()
+    except (ValueError, TypeError, OverflowError):
+        return False
+    return decoded.dtype == da.dtype and np.array_equal(decoded.values, da.values)
+
+
+def _get_time_encoding(values):
+    """Return the CF time encoding of datetime values with the coarsest exact units."""
+    values_ns = values.astype("M8[ns]").astype("int64")
+    offsets = values_ns - values_ns[0]
+    unit, unit_ns = next(
+        (unit, unit_ns) for unit, unit_ns in _TIME_UNITS.items() if np.all(offsets % unit_ns == 0)
+    )
+    offsets = offsets // unit_ns
+    reference = pd.Timestamp(values[0]).isoformat()
+    dtype = _get_compact_int_dtype(offsets.min(), offsets.max())
+    return {"units": f"{unit} since {reference}", "dtype": dtype}
+
+
+def _get_packing_encoding(values, step):
+    """Return the CF packing encoding of a regular float coordinate (values = offset + step * i)."""
+    dtype = _get_compact_int_dtype(0, values.size - 1)
+    return {
+        "dtype": dtype,
+        "scale_factor": values.dtype.type(step),
+        "add_offset": values.dtype.type(values[0]),
+    }
+
+
+def _get_delta_astype(values):
+    """Return the smallest integer dtype of the Delta encoding (first value and differences)."""
+    diff = np.diff(values)
+    vmin = min(values[0], diff.min(initial=0))
+    vmax = max(values[0], diff.max(initial=0))
+    return _get_compact_int_dtype(vmin, vmax) or values.dtype
+
+
+def get_coordinate_encoding(da, compressor=COORDINATES_COMPRESSOR):
+    """Return the zarr encoding of a regular or monotonic 1D coordinate (or None).
+
+    The coordinate is stored in a single chunk:
+    - datetime coordinates are encoded as integers in the coarsest exact CF time units,
+      with the smallest integer dtype and the Delta filter.
+    - integer coordinates keep their dtype and are stored with the Delta filter,
+      whose differences are stored with the smallest integer dtype.
+    - regular float coordinates are packed as integer indices (with CF scale_factor=step
+      and add_offset=first value) and the Delta filter, if the packing is exact.
+      Otherwise, they keep their dtype and are stored with the Shuffle filter.
+    The encoding round trip is validated, so that the coordinate values are preserved exactly.
+    Coordinates that are not monotonic (or not numeric/datetime) are not encoded.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        1D coordinate.
+    compressor : numcodecs compressor, optional
+        Compressor of the coordinate. The default is Blosc(cname="lz4", clevel=5).
+
+    Returns
+    -------
+    encoding : dict
+        Zarr encoding with the 'chunks', 'dtype', 'filters', 'compressor' and
+        CF ('units', 'scale_factor', 'add_offset', '_FillValue') keys.
+
+    """
+    values = np.asarray(da.values)
+    if not is_monotonic_coordinate(values):
+        return None
+    encoding = {"chunks": values.shape, "_FillValue": None, "compressor": compressor}
+    if values.dtype.kind == "M":
+        encoding.update(_get_time_encoding(values))
+        encoding["filters"] = [numcodecs.Delta(dtype=encoding["dtype"])]
+    elif values.dtype.kind in ["i", "u"]:
+        encoding["dtype"] = values.dtype
+        encoding["filters"] = [
+            numcodecs.Delta(dtype=values.dtype, astype=_get_delta_astype(values))
+        ]
+    else:
+        encoding["dtype"] = values.dtype
+        encoding["filters"] = [numcodecs.Shuffle(elementsize=values.dtype.itemsize)]
+        step = get_coordinate_step(values)
+        if step is not None:
+            packed_encoding = {**encoding, **_get_packing_encoding(values, step)}
+            packed_encoding["filters"] = [numcodecs.Delta(dtype=packed_encoding["dtype"])]
+            if _is_lossless_encoding(da, packed_encoding):
+                encoding = packed_encoding
+    if not _is_lossless_encoding(da, encoding):
+        return None
+    return encoding
+
+
+def get_coordinates_encoding(ds, coords=None, exclude_dims=None):
+    """Return the zarr encoding of the regular or monotonic 1D coordinates of a Dataset.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    coords : list, optional
+        Coordinates to encode. If None (the default), all 1D coordinates.
+    exclude_dims : list, optional
+        Coordinates along these dimensions are not encoded (i.e. the dimension of
+        future appends, whose values could not fit the encoding). The default is None.
+
+    Returns
+    -------
+    coords_encoding : dict
+        Dictionary with format {<coord>: <encoding>}. See get_coordinate_encoding().
+
+    """
+    if coords is None:
+        coords = [coord for coord in ds.coords if ds[coord].ndim == 1]
+    exclude_dims = [] if exclude_dims is None else exclude_dims
+    coords_encoding = {}
+    for coord in coords:
+        if ds[coord].ndim != 1 or ds[coord].dims[0] in exclude_dims:
+            continue
+        encoding = get_coordinate_encoding(ds[coord])
+        if encoding is not None:
+            coords_encoding[coord] = encoding
+    return coords_encoding
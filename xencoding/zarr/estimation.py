@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Created on Mon Oct 14 10:12:31 2024
+
+@author: ghiggi
+"""
+import time
+
+import numpy as np
+from numcodecs.compat import ensure_ndarray
+
+from xencoding.checks.chunks import check_chunks
+from xencoding.utils.chunks import get_dataset_chunks
+from xencoding.utils.result_cache import (
+    check_cache,
+    get_arrays_fingerprint,
+    get_cache_key,
+    get_environment_fingerprint,
+)
+
+
+####################
+#### Chunk sampling
+def _get_sampling_chunks(ds, chunks=None):
+    """Return the 'per variable' chunks dictionary used to sample the Dataset.
+
+    If chunks=None, the current Dataset chunks are used and
+    variables not chunked are considered as a single chunk.
+    """
+    if chunks is None:
+        chunks = get_dataset_chunks(ds)
+        for var, var_chunks in chunks.items():
+            if var_chunks is None:
+                chunks[var] = dict(ds[var].sizes)
+    return check_chunks(ds, chunks=chunks)
+
+
+def _get_chunks_slices(shape, chunk_shape, n_samples, rng):
+    """Return the slices of n_samples chunks drawn without replacement from the chunk grid."""
+    # - A 0-d array is a single chunk
+    if len(shape) == 0:
+        return [()]
+    grid_shape = tuple(int(np.ceil(size / chunk)) for size, chunk in zip(shape, chunk_shape))
+    n_chunks = int(np.prod(grid_shape))
+    n_samples = min(n_samples, n_chunks)
+    flat_indices = np.sort(rng.choice(n_chunks, size=n_samples, replace=False))
+    list_slices = []
+    for chunk_index in zip(*np.unravel_index(flat_indices, grid_shape)):
+        slices = tuple(
+            slice(int(i) * chunk, min((int(i) + 1) * chunk, size))
+            for i, chunk, size in zip(chunk_index, chunk_shape, shape)
+        )
+        list_slices.append(slices)
+    return list_slices
+
+
+def sample_chunks(da, chunks, n_samples=10, seed=0):
+    """Return a random sample of chunks of a DataArray as contiguous numpy arrays.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        xarray DataArray.
+    chunks : dict
+        Chunks dictionary with format {<dim>: <chunk_value>}.
+    n_samples : int, optional
+        Number of chunks to sample. The default is 10.
+        If the DataArray has less chunks, all chunks are returned.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    list
+        List of numpy arrays.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_shape = [chunks[dim] for dim in da.dims]
+    list_slices = _get_chunks_slices(da.shape, chunk_shape, n_samples=n_samples, rng=rng)
+    variable = da.variable
+    return [np.ascontiguousarray(variable[slices].values) for slices in list_slices]
+
+
+##----------------------------------------------------------------------------.
+####################
+#### Estimation
+def _bootstrap_ratio_ci(numerator, denominator, confidence, n_bootstrap, rng):
+    """Return the bootstrap percentile confidence interval of sum(numerator)/sum(denominator)."""
+    n = len(numerator)
+    indices = rng.integers(0, n, size=(n_bootstrap, n))
+    ratios = numerator[indices].sum(axis=1) / denominator[indices].sum(axis=1)
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(ratios, [alpha, 1 - alpha])
+    return round(float(lower), 3), round(float(upper), 3)
+
+
+def _measure_codec(codec, chunks):
+    """Return the encoded size and the encode/decode times (in seconds) of each chunk."""
+    n = len(chunks)
+    encoded_nbytes = np.zeros(n)
+    encode_times = np.zeros(n)
+    decode_times = np.zeros(n)
+    for i, chunk in enumerate(chunks):
+        t_i = time.perf_counter()
+        encoded = codec.encode(chunk)
+        t_e = time.perf_counter()
+        _ = codec.decode(encoded)
+        t_d = time.perf_counter()
+        encoded_nbytes[i] = ensure_ndarray(encoded).nbytes
+        encode_times[i] = t_e - t_i
+        decode_times[i] = t_d - t_e
+    return encoded_nbytes, encode_times, decode_times
+
+
+def _summarize_codec(
+    nbytes, encoded_nbytes, encode_times, decode_times, confidence, n_bootstrap, rng
+):
+    """Summarize the compression ratio and encode/decode throughput of a codec."""
+    nbytes_mb = nbytes / 1024 / 1024
+    # Avoid division by zero for chunks encoded faster than the timer resolution
+    encode_times = np.maximum(encode_times, 1e-9)
+    decode_times = np.maximum(decode_times, 1e-9)
+    summary = {}
+    summary["compression_ratio"] = round(float(nbytes.sum() / encoded_nbytes.sum()), 3)
+    summary["compression_ratio_ci"] = _bootstrap_ratio_ci(
+        nbytes, encoded_nbytes, confidence=confidence, n_bootstrap=n_bootstrap, rng=rng
+    )
+    summary["encode_MBs"] = round(float(nbytes_mb.sum() / encode_times.sum()), 3)
+    summary["encode_MBs_ci"] = _bootstrap_ratio_ci(
+        nbytes_mb, encode_times, confidence=confidence, n_bootstrap=n_bootstrap, rng=rng
+    )
+    summary["decode_MBs"] = round(float(nbytes_mb.sum() / decode_times.sum()), 3)
+    summary["decode_MBs_ci"] = _bootstrap_ratio_ci(
+        nbytes_mb, decode_times, confidence=confidence, n_bootstrap=n_bootstrap, rng=rng
+    )
+    summary["n_chunks"] = len(nbytes)
+    return summary
+
+
+def estimate_compression(
+    ds,
+    compressors,
+    chunks=None,
+    variables=None,
+    n_samples=10,
+    confidence=0.95,
+    n_bootstrap=1000,
+    seed=0,
+    cache=None,
+):
+    """Estimate the compression ratio and encode/decode throughput of compressors in memory.
+
+    A random sample of chunks is drawn for each variable and encoded/decoded
+    with each compressor, without writing any store to disk.
+    The estimates are computed over the sampled chunks, and the confidence intervals
+    are obtained by bootstrapping the sampled chunks.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    compressors : dict
+        Dictionary with format {<compressor_name>: <numcodecs compressor>}.
+        See for example _get_blosc_compressors().
+    chunks : (None, dict), optional
+        Chunks used to sample the Dataset. See check_chunks().
+        If None (the default), the current Dataset chunks are used.
+    variables : list, optional
+        Dataset variables to evaluate. If None (the default), all data variables.
+    n_samples : int, optional
+        Number of chunks sampled for each variable. The default is 10.
+    confidence : float, optional
+        Confidence level of the intervals. The default is 0.95.
+    n_bootstrap : int, optional
+        Number of bootstrap resamples. The default is 1000.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+    cache : (None, bool, str, ResultCache), optional
+        Cache of the results. The estimates are cached for each variable and compressor,
+        keyed on the content fingerprint of the sampled chunks, the compressor configuration,
+        the chunk shape, the estimation options and the library versions.
+        See check_cache(). The default is None (no cache).
+
+    Returns
+    -------
+    estimates : dict
+        Dictionary with format {<variable>: {<compressor_name>: <summary>}}.
+        Each summary includes the 'compression_ratio', 'encode_MBs' and 'decode_MBs'
+        estimates, their confidence intervals (with '_ci' suffix) and
+        the number of sampled chunks ('n_chunks').
+
+    """
+    if not isinstance(compressors, dict):
+        raise TypeError(
+            "'compressors' must be a dictionary {<compressor_name>: <numcodecs compressor>}."
+        )
+    if not 0 < confidence < 1:
+        raise ValueError("'confidence' must be between 0 and 1.")
+    chunks = _get_sampling_chunks(ds, chunks=chunks)
+    if variables is None:
+        variables = list(ds.data_vars.keys())
+    cache = check_cache(cache)
+    environment = get_environment_fingerprint() if cache is not None else None
+    rng = np.random.default_rng(seed)
+    estimates = {}
+    for var in variables:
+        list_chunks = sample_chunks(ds[var], chunks=chunks[var], n_samples=n_samples, seed=seed)
+        nbytes = np.array([chunk.nbytes for chunk in list_chunks], dtype=float)
+        fingerprint = get_arrays_fingerprint(list_chunks) if cache is not None else None
+        estimates[var] = {}
+        for compressor_name, compressor in compressors.items():
+            if cache is not None:
+                key = get_cache_key(
+                    task="estimate_compression",
+                    fingerprint=fingerprint,
+                    compressor=compressor,
+                    chunks=chunks[var],
+                    confidence=confidence,
+                    n_bootstrap=n_bootstrap,
+                    seed=seed,
+                    environment=environment,
+                )
+                summary = cache.get(key)
+                if summary is not None:
+                    estimates[var][compressor_name] = summary
+                    continue
+            encoded_nbytes, encode_times, decode_times = _measure_codec(compressor, list_chunks)
+            estimates[var][compressor_name] = _summarize_codec(
+                nbytes,
+                encoded_nbytes,
+                encode_times,
+                decode_times,
+                confidence=confidence,
+                n_bootstrap=n_bootstrap,
+                rng=rng,
+            )
+            if cache is not None:
+                cache.set(key, estimates[var][compressor_name])
+    return estimates
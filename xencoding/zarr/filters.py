@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 31 09:26:03 2024
+
+@author: ghiggi
+"""
+import numcodecs
+import numpy as np
+
+
+class CodecPipeline:
+    """Chain of numcodecs filters followed by a compressor, encoding as a zarr array chunk.
+
+    It is used to estimate the compression of filters and compressor combinations in memory.
+    See estimate_compression().
+    """
+
+    def __init__(self, filters=None, compressor=None):
+        self.filters = list(filters) if filters is not None else []
+        self.compressor = compressor
+
+    def encode(self, buf):
+        for f in self.filters:
+            buf = f.encode(buf)
+        if self.compressor is not None:
+            buf = self.compressor.encode(buf)
+        return buf
+
+    def decode(self, buf):
+        if self.compressor is not None:
+            buf = self.compressor.decode(buf)
+        for f in reversed(self.filters):
+            buf = f.decode(buf)
+        return buf
+
+    def get_config(self):
+        return {
+            "filters": [f.get_config() for f in self.filters],
+            "compressor": self.compressor.get_config() if self.compressor is not None else None,
+        }
+
+    def __repr__(self):
+        return f"CodecPipeline(filters={self.filters}, compressor={self.compressor})"
+
+
+def _get_scale_offset_astype(vmin, vmax, scale):
+    """Return the smallest unsigned integer dtype of the FixedScaleOffset values of a range."""
+    n_levels = int(np.round((vmax - vmin) * scale))
+    for dtype in ["uint8", "uint16", "uint32", "uint64"]:
+        if n_levels <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("The values range can not be represented with the specified precision.")
+
+
+def get_candidate_filters(dtype, precision=None, value_range=None, has_nan=True):
+    """Return candidate filter chains for a variable dtype.
+
+    The chains include no filters and a byte Shuffle of the dtype items.
+    Delta is included only for integer and datetime dtypes, for which it is exactly reversible.
+    Datetime variables are stored as int64 (CF encoding), to which the Delta filter is applied.
+    If precision is specified for a float dtype, lossy filters preserving the precision
+    are also included: Quantize and, if the value_range is specified and the variable
+    does not hold NaN values, FixedScaleOffset.
+    FixedScaleOffset stores (value - vmin) / precision in the smallest unsigned integer dtype
+    covering the value_range. It can not represent NaN, which would be decoded as vmin.
+    Bit shuffling is available with the Blosc compressor (shuffle=BITSHUFFLE).
+
+    Parameters
+    ----------
+    dtype : numpy.dtype
+        Dtype of the variable.
+    precision : float, optional
+        Maximum absolute error allowed by the lossy filters of float variables.
+        If None (the default), lossy filters are not included.
+    value_range : tuple, optional
+        (vmin, vmax) of the variable values. Required to include the FixedScaleOffset filter.
+    has_nan : bool, optional
+        Whether the variable can hold NaN values (i.e. masked values).
+        If True (the default), the FixedScaleOffset filter is not included.
+
+    Returns
+    -------
+    filters : dict
+        Dictionary with format {<filters_name>: <list of numcodecs filters> or None}.
+
+    """
+    dtype = np.dtype(dtype)
+    filters = {
+        "nofilter": None,
+        "shuffle": [numcodecs.Shuffle(elementsize=dtype.itemsize)],
+    }
+    if dtype.kind in ["i", "u"]:
+        filters["delta"] = [numcodecs.Delta(dtype=dtype)]
+    elif dtype.kind in ["M", "m"]:
+        filters["delta"] = [numcodecs.Delta(dtype="int64")]
+    if precision is not None and dtype.kind == "f":
+        if precision <= 0:
+            raise ValueError("'precision' must be a positive number.")
+        if value_range is not None and not has_nan:
+            vmin, vmax = value_range
+            # - A step equal to the precision bounds the rounding error to half the precision
+            scale = 1 / precision
+            filters["scaleoffset"] = [
+                numcodecs.FixedScaleOffset(
+                    offset=vmin,
+                    scale=scale,
+                    dtype=dtype,
+                    astype=_get_scale_offset_astype(vmin, vmax, scale),
+                )
+            ]
+        digits = int(np.ceil(-np.log10(precision)))
+        filters["quantize"] = [numcodecs.Quantize(digits=digits, dtype=dtype)]
+    return filters
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Created on Fri Oct 25 10:04:52 2024
+
+@author: ghiggi
+"""
+import mmap
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import zarr
+
+from xencoding.zarr.archive import MmapZipStore
+
+# Number of file descriptors left to the rest of the process
+_FD_MARGIN = 128
+
+
+def _get_max_open_files(max_open_files):
+    """Clamp the number of memory maps kept open to the file descriptors limit (minus a margin).
+
+    Before Python 3.13, each memory map keeps a duplicate of the file descriptor open.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return max_open_files
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return max_open_files
+    return max(min(max_open_files, soft_limit - _FD_MARGIN), 0)
+
+
+def _mmap_file(fpath):
+    """Return a read-only memory map of a file (or empty bytes for an empty file).
+
+    The file is closed right after the mapping, which stays valid.
+    On Python >= 3.13, the memory map does not keep a duplicate file descriptor.
+    """
+    kwargs = {"trackfd": False} if sys.version_info >= (3, 13) else {}
+    with open(fpath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ, **kwargs)
+
+
+def _close_mmap(mm):
+    """Close a memory map, unless chunk views are still exported (then unmapped by the GC)."""
+    if isinstance(mm, mmap.mmap):
+        try:
+            mm.close()
+        except BufferError:
+            pass
+
+
+class MmapDirectoryStore(zarr.DirectoryStore):
+    """Local zarr DirectoryStore returning the chunks as zero-copy views of memory-mapped files.
+
+    Chunk files are not read and copied into new bytes objects: zarr decodes the chunks
+    directly from the page cache. This is most effective for uncompressed arrays.
+    The memory maps of the last max_open_files read keys are kept open, so that
+    chunks read repeatedly are not re-opened. A key is re-mapped if its file was modified.
+    max_open_files is clamped to the process file descriptors limit (minus a margin).
+    Evicted memory maps are closed, unless chunk views are still in use.
+    """
+
+    def __init__(self, path, normalize_keys=False, dimension_separator=None, max_open_files=256):
+        super().__init__(
+            path, normalize_keys=normalize_keys, dimension_separator=dimension_separator
+        )
+        if not isinstance(max_open_files, int) or max_open_files < 0:
+            raise ValueError("'max_open_files' must be a non-negative integer.")
+        self.max_open_files = _get_max_open_files(max_open_files)
+        self._mmaps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fromfile(self, fn):
+        stat = os.stat(fn)
+        file_id = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._mmaps.get(fn)
+            if cached is not None and cached[0] == file_id:
+                self._mmaps.move_to_end(fn)
+                return memoryview(cached[1])
+        mm = _mmap_file(fn)
+        view = memoryview(mm)
+        if self.max_open_files > 0:
+            with self._lock:
+                # Stale memory map of a modified file and least recently used memory map
+                evicted = [self._mmaps.pop(fn, None)]
+                self._mmaps[fn] = (file_id, mm)
+                if len(self._mmaps) > self.max_open_files:
+                    evicted.append(self._mmaps.popitem(last=False)[1])
+            for cached in evicted:
+                if cached is not None:
+                    _close_mmap(cached[1])
+        return view
+
+    def _discard_mmap(self, key):
+        with self._lock:
+            cached = self._mmaps.pop(os.path.join(self.path, self._normalize_key(key)), None)
+        if cached is not None:
+            _close_mmap(cached[1])
+
+    def close(self):
+        """Close the memory maps not in use by chunk views."""
+        with self._lock:
+            mmaps = [mm for _, mm in self._mmaps.values()]
+            self._mmaps.clear()
+        for mm in mmaps:
+            _close_mmap(mm)
+
+    def __setitem__(self, key, value):
+        self._discard_mmap(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._discard_mmap(key)
+        super().__delitem__(key)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmaps"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def get_mmap_store(fpath, **kwargs):
+    """Return the memory-mapped store of a local zarr store or packed zip file."""
+    if os.path.isfile(fpath):
+        return MmapZipStore(fpath)
+    if not os.path.isdir(fpath):
+        raise ValueError(f"{fpath} is not a local zarr store.")
+    return MmapDirectoryStore(fpath, **kwargs)
+
+
+def open_zarr_mmap(fpath, **kwargs):
+    """Open a local zarr store (or packed zip file) as xarray Dataset with a memory-mapped store.
+
+    kwargs are passed to xarray.open_zarr.
+    The memory maps of the store are closed when the Dataset is closed.
+    """
+    import xarray as xr
+
+    store = get_mmap_store(fpath)
+    kwargs.setdefault("consolidated", ".zmetadata" in store)
+    ds = xr.open_zarr(store, **kwargs)
+    ds.set_close(store.close)
+    return ds
+
+
+def _check_uncompressed_array(arr):
+    if arr.compressor is not None or arr.filters:
+        raise ValueError("Zero-copy chunk views require arrays without compressor and filters.")
+    if arr.dtype.hasobject:
+        raise ValueError("Zero-copy chunk views are not available for object arrays.")
+
+
+def get_chunk_view(store, variable, chunk_index):
+    """Return a read-only numpy view of an uncompressed chunk, without copying it.
+
+    The view is backed by the memory-mapped chunk file (or packed zip entry).
+    Edge chunks have the full chunk shape, as stored by zarr.
+
+    Parameters
+    ----------
+    store : (str, MmapDirectoryStore, MmapZipStore)
+        Local zarr store (or its path).
+    variable : str
+        Name of the zarr array.
+    chunk_index : tuple
+        Index of the chunk within the chunk grid.
+
+    Returns
+    -------
+    chunk : numpy.ndarray
+        Read-only view of the chunk. Returns None if the chunk is not stored
+        (i.e. it only contains the fill value).
+
+    """
+    if isinstance(store, str):
+        store = get_mmap_store(store)
+    arr = zarr.open_array(store, path=variable, mode="r")
+    _check_uncompressed_array(arr)
+    if len(chunk_index) != arr.ndim:
+        raise ValueError(f"'chunk_index' must have {arr.ndim} values.")
+    key = arr._chunk_key(tuple(chunk_index))
+    try:
+        buffer = store[key]
+    except KeyError:
+        return None
+    return np.frombuffer(buffer, dtype=arr.dtype).reshape(arr.chunks, order=arr.order)
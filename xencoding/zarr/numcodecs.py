@@ -4,6 +4,8 @@ Created on Thu Aug  3 09:01:42 2023
 
 @author: ghiggi
 """
+from contextlib import contextmanager
+
 import numcodecs
 
 # TODO: utility with max clevel per algorithm !
@@ -27,6 +29,35 @@ def _get_blosc(algorithm="lz4", clevel=1, shuffle=1, blocksize=0):
     )
 
 
+@contextmanager
+def blosc_threads(nthreads=None, use_threads=None):
+    """Context manager setting the number of blosc internal threads.
+
+    nthreads: number of blosc threads. If None, the current setting is kept.
+    use_threads: whether blosc can use its internal threads. If None (the numcodecs default),
+      blosc threads are used only when called from the main thread (i.e. not by dask threads).
+      If True, blosc compresses with its single global context (of nthreads threads),
+      whose access is serialized by a mutex: a single dask thread compresses at a time.
+      If False, each call uses its own single-threaded blosc context, so that
+      dask threads compress concurrently.
+    The previous settings are restored on exit.
+    """
+    previous_use_threads = numcodecs.blosc.use_threads
+    previous_nthreads = numcodecs.blosc.get_nthreads()
+    if nthreads is not None:
+        if not isinstance(nthreads, int) or not 1 <= nthreads <= numcodecs.blosc.MAX_THREADS:
+            raise ValueError(
+                f"'nthreads' must be an integer between 1 and {numcodecs.blosc.MAX_THREADS}."
+            )
+        numcodecs.blosc.set_nthreads(nthreads)
+    numcodecs.blosc.use_threads = use_threads
+    try:
+        yield
+    finally:
+        numcodecs.blosc.use_threads = previous_use_threads
+        numcodecs.blosc.set_nthreads(previous_nthreads)
+
+
 def _get_bz2(clevel=1):
     """Get BZ2 compressor."""
     if clevel == 0:
@@ -124,11 +155,15 @@ def _get_lmza(clevel=1, filters=["delta", "lmza2"], delta_dist=None):
     """Get lmza compressors."""
     # - preset: compression level between 0 and 9
     # - dist: distance between bytes to be subtracted (default 1)
-    # Cannot specify filters except with FORMAT_RAW
+    # Cannot specify filters except with FORMAT_RAW (otherwise decoding fails)
+    import lzma
+
     if clevel == 0:
         clevel = None
     filters = _get_lmza_filters_dict(filters, delta_dist, clevel)
-    return numcodecs.LZMA(preset=None, filters=filters)
+    if filters is None:
+        return numcodecs.LZMA(preset=clevel, filters=None)
+    return numcodecs.LZMA(format=lzma.FORMAT_RAW, preset=None, filters=filters)
 
 
 def get_valid_compressors():
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 29 10:18:44 2024
+
+@author: ghiggi
+"""
+import numpy as np
+import xarray as xr
+
+# Metrics of the results Dataset (all to be maximized)
+METRICS = ["compression_ratio", "encode_MBs", "decode_MBs"]
+
+
+####################
+#### Results Dataset
+def estimates_to_dataset(estimates):
+    """Convert the estimates of estimate_compression() to a results Dataset.
+
+    Returns a Dataset with dimensions (variable, candidate) and the 'compression_ratio',
+    'encode_MBs' and 'decode_MBs' metrics. The confidence intervals are stored in
+    the '<metric>_ci' variables along the 'bound' dimension.
+    Candidates not estimated for a variable are set to NaN.
+    """
+    variables = list(estimates)
+    candidates = list(dict.fromkeys(c for var in variables for c in estimates[var]))
+    shape = (len(variables), len(candidates))
+    data_vars = {}
+    for metric in METRICS:
+        values = np.full(shape, np.nan)
+        ci = np.full((*shape, 2), np.nan)
+        for i, var in enumerate(variables):
+            for j, candidate in enumerate(candidates):
+                summary = estimates[var].get(candidate)
+                if summary is not None:
+                    values[i, j] = summary[metric]
+                    ci[i, j] = summary[f"{metric}_ci"]
+        data_vars[metric] = (("variable", "candidate"), values)
+        data_vars[f"{metric}_ci"] = (("variable", "candidate", "bound"), ci)
+    coords = {"variable": variables, "candidate": candidates, "bound": ["lower", "upper"]}
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def benchmark_to_dataset(benchmark_dict, ds):
+    """Convert the results of benchmark_compressors() to a results Dataset.
+
+    The compression ratio and the writing (encode) and reading (decode) throughputs
+    are derived from the in-memory size of the benchmarked Dataset.
+    The writing, reading times (in seconds) and file size (in MB) are also included.
+    Since benchmark_compressors() rounds the times to 0.1 s and the file sizes to 0.01 MB,
+    the metrics of the candidates with a time or file size rounded to 0 are set to NaN.
+    Returns a Dataset with the 'candidate' dimension.
+    """
+    from xencoding.zarr.benchmarking import get_memory_size_dataset
+
+    nbytes_mb = sum(get_memory_size_dataset(ds).values())
+    candidates = list(benchmark_dict["filesize"])
+    results = xr.Dataset(
+        {
+            name: ("candidate", np.array([benchmark_dict[name][c] for c in candidates], float))
+            for name in ["writing", "reading", "filesize"]
+        },
+        coords={"candidate": candidates},
+    )
+    # Times and file sizes rounded to 0 give non-finite metrics: set them to NaN,
+    # so that these candidates are not selected by get_pareto_front() and select_best_candidate()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results["compression_ratio"] = nbytes_mb / results["filesize"]
+        results["encode_MBs"] = nbytes_mb / results["writing"]
+        results["decode_MBs"] = nbytes_mb / results["reading"]
+    for metric in METRICS:
+        results[metric] = results[metric].where(np.isfinite(results[metric]))
+    return results
+
+
+def results_to_dataframe(results):
+    """Convert a results Dataset to a tidy pandas DataFrame (one row per variable and candidate)."""
+    results = results.drop_dims("bound", errors="ignore")
+    return results.to_dataframe().reset_index()
+
+
+####################
+#### Pareto front
+def _get_pareto_mask(values, block_size=1024):
+    """Return the mask of the non-dominated rows of a (n_candidates, n_metrics) array.
+
+    All metrics are maximized. A row is dominated if another row is larger or equal
+    for all metrics and larger for at least one metric. Rows with NaN are not optimal.
+    The dominance checks are vectorized by blocks of rows to bound the memory usage.
+    """
+    is_valid = ~np.any(np.isnan(values), axis=1)
+    valid_values = values[is_valid]
+    n = valid_values.shape[0]
+    is_dominated = np.zeros(n, dtype=bool)
+    for start in range(0, n, block_size):
+        block = valid_values[start : start + block_size]
+        # Shape (block, n, n_metrics): comparison of each block row to all rows
+        ge = np.all(valid_values[None, :, :] >= block[:, None, :], axis=2)
+        gt = np.any(valid_values[None, :, :] > block[:, None, :], axis=2)
+        is_dominated[start : start + block_size] = np.any(ge & gt, axis=1)
+    mask = np.zeros(values.shape[0], dtype=bool)
+    mask[np.flatnonzero(is_valid)[~is_dominated]] = True
+    return mask
+
+
+def _check_metrics(results, metrics):
+    if metrics is None:
+        metrics = METRICS
+    missing = [metric for metric in metrics if metric not in results]
+    if len(missing) > 0:
+        raise ValueError(f"The results Dataset does not include the metrics {missing}.")
+    return metrics
+
+
+def get_pareto_front(results, metrics=None, block_size=1024):
+    """Return the mask of the Pareto-optimal candidates across the metrics (all maximized).
+
+    Parameters
+    ----------
+    results : xarray.Dataset
+        Results Dataset. See estimates_to_dataset() and benchmark_to_dataset().
+    metrics : list, optional
+        Metrics to maximize. The default is ["compression_ratio", "encode_MBs", "decode_MBs"].
+        To minimize a metric, add its negative to the results Dataset.
+    block_size : int, optional
+        Number of candidates whose dominance is checked at once. The default is 1024.
+
+    Returns
+    -------
+    is_pareto : xarray.DataArray
+        Boolean DataArray along the 'candidate' dimension (and 'variable' if present).
+
+    """
+    metrics = _check_metrics(results, metrics)
+    values = xr.concat([results[metric] for metric in metrics], dim="metric")
+    return xr.apply_ufunc(
+        _get_pareto_mask,
+        values,
+        input_core_dims=[["candidate", "metric"]],
+        output_core_dims=[["candidate"]],
+        vectorize=True,
+        kwargs={"block_size": block_size},
+    ).rename("is_pareto")
+
+
+def _get_constraints_mask(results, constraints):
+    """Return the mask of the candidates satisfying the constraints.
+
+    Constraints have format {<metric>: <minimum>} or {<metric>: (<minimum>, <maximum>)}.
+    None bounds are not constrained.
+    """
+    mask = xr.ones_like(results[list(results.data_vars)[0]], dtype=bool)
+    for metric, bounds in constraints.items():
+        if metric not in results:
+            raise ValueError(f"The constraint metric '{metric}' is not in the results Dataset.")
+        vmin, vmax = bounds if isinstance(bounds, (tuple, list)) else (bounds, None)
+        if vmin is not None:
+            mask = mask & (results[metric] >= vmin)
+        if vmax is not None:
+            mask = mask & (results[metric] <= vmax)
+    return mask
+
+
+def select_best_candidate(results, objective="compression_ratio", constraints=None):
+    """Return the candidate maximizing the objective metric among those satisfying the constraints.
+
+    For example, the codec with the largest compression ratio and decoding at least at 500 MB/s
+    is selected with objective="compression_ratio" and constraints={"decode_MBs": 500}.
+
+    Parameters
+    ----------
+    results : xarray.Dataset
+        Results Dataset. See estimates_to_dataset() and benchmark_to_dataset().
+    objective : str, optional
+        Metric to maximize. The default is "compression_ratio".
+    constraints : dict, optional
+        Constraints with format {<metric>: <minimum>} or {<metric>: (<minimum>, <maximum>)}.
+        The default is None.
+
+    Returns
+    -------
+    best : (str, dict)
+        Name of the best candidate (or None if no candidate satisfies the constraints).
+        If the results Dataset has the 'variable' dimension, a dictionary with format
+        {<variable>: <candidate>}.
+
+    """
+    if objective not in results:
+        raise ValueError(f"The objective metric '{objective}' is not in the results Dataset.")
+    score = results[objective].where(results[objective].notnull(), -np.inf)
+    if constraints is not None:
+        score = score.where(_get_constraints_mask(results, constraints), -np.inf)
+
+    def _get_best(score):
+        if np.all(np.isneginf(score.values)):
+            return None
+        return str(score["candidate"].values[int(score.argmax("candidate"))])
+
+    if "variable" in score.dims:
+        return {str(var): _get_best(score.sel(variable=var)) for var in score["variable"].values}
+    return _get_best(score)
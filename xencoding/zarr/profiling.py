@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Created on Sat Oct 19 10:21:05 2024
+
+@author: ghiggi
+"""
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+import numcodecs
+import numpy as np
+import xarray as xr
+import zarr
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_ndarray
+
+####--------------------------------------------------------------------------.
+#### Counters
+# Counters of the running profiles (shared by the store wrappers and the timing codecs)
+_PROFILES = {}
+_PROFILE_IDS = itertools.count()
+
+
+class _ProfileCounters:
+    """Thread-safe counters of the store reads and codec decodes of each array."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(lambda: defaultdict(float))
+
+    def add(self, array, **values):
+        with self._lock:
+            for name, value in values.items():
+                self.counters[array][name] += value
+
+    def total(self, name):
+        """Return the sum of a counter across the arrays."""
+        with self._lock:
+            return sum(counters.get(name, 0) for counters in self.counters.values())
+
+
+@contextmanager
+def _running_profile():
+    """Register the counters of a new profile and yield its id and counters."""
+    profile_id = next(_PROFILE_IDS)
+    _PROFILES[profile_id] = _ProfileCounters()
+    try:
+        yield profile_id, _PROFILES[profile_id]
+    finally:
+        _PROFILES.pop(profile_id)
+
+
+def _record(profile_id, array, **values):
+    """Record values in the counters of a profile (if still running)."""
+    profile = _PROFILES.get(profile_id)
+    if profile is not None:
+        profile.add(array, **values)
+
+
+####--------------------------------------------------------------------------.
+#### Instrumented codec
+class _TimingCodec(Codec):
+    """Codec wrapper timing the decoding of the wrapped codec."""
+
+    codec_id = "xencoding_timing"
+
+    def __init__(self, codec, profile_id, array, is_compressor=False):
+        self.codec = numcodecs.get_codec(codec)
+        self.profile_id = profile_id
+        self.array = array
+        self.is_compressor = is_compressor
+
+    def encode(self, buf):
+        return self.codec.encode(buf)
+
+    def decode(self, buf, out=None):
+        t_i = time.perf_counter_ns()
+        decoded = self.codec.decode(buf, out=out)
+        elapsed = (time.perf_counter_ns() - t_i) / 1e9
+        values = {"decode_time": elapsed}
+        if self.is_compressor:
+            values["nbytes_decoded"] = ensure_ndarray(decoded).nbytes
+        _record(self.profile_id, self.array, **values)
+        return decoded
+
+    def get_config(self):
+        return {
+            "id": self.codec_id,
+            "codec": self.codec.get_config(),
+            "profile_id": self.profile_id,
+            "array": self.array,
+            "is_compressor": self.is_compressor,
+        }
+
+
+numcodecs.register_codec(_TimingCodec)
+
+
+def _wrap_codec_config(config, profile_id, array, is_compressor=False):
+    """Wrap a codec configuration into a timing codec configuration."""
+    return {
+        "id": _TimingCodec.codec_id,
+        "codec": config,
+        "profile_id": profile_id,
+        "array": array,
+        "is_compressor": is_compressor,
+    }
+
+
+def _get_chunk_nbytes(meta):
+    """Return the decoded size in bytes of a chunk of a .zarray metadata (or None)."""
+    try:
+        dtype = np.dtype(meta["dtype"])
+    except TypeError:  # structured dtypes
+        return None
+    return int(np.prod(meta["chunks"])) * dtype.itemsize
+
+
+def _instrument_array_metadata(meta, profile_id, array):
+    """Wrap the compressor and filters of a .zarray metadata into timing codecs."""
+    meta = dict(meta)
+    if meta.get("compressor") is not None:
+        meta["compressor"] = _wrap_codec_config(
+            meta["compressor"], profile_id, array=array, is_compressor=True
+        )
+    if meta.get("filters") is not None:
+        meta["filters"] = [
+            _wrap_codec_config(config, profile_id, array=array) for config in meta["filters"]
+        ]
+    return meta
+
+
+####--------------------------------------------------------------------------.
+#### Instrumented store
+def _get_array_name(key):
+    """Return the name of the array of a store key (of a store written by xarray)."""
+    return key.split("/")[0]
+
+
+class _InstrumentedStore(MutableMapping):
+    """Read-only store wrapper counting and timing the reads of each array.
+
+    The array metadata returned by the store are rewritten so that
+    the compressor and filters of each array are wrapped into timing codecs.
+    The decoded bytes of the arrays without compressor are recorded by the store
+    (as the decoded size of the fetched chunks), since no compressor decodes them.
+    """
+
+    def __init__(self, store, profile_id):
+        self._store = store
+        self._profile_id = profile_id
+        self._uncompressed_chunk_nbytes = {}
+
+    def _register_array(self, array, meta):
+        if meta.get("compressor") is None:
+            self._uncompressed_chunk_nbytes[array] = _get_chunk_nbytes(meta)
+
+    def _instrument_metadata(self, key, value):
+        if key.endswith(".zarray"):
+            array = _get_array_name(key)
+            meta = json.loads(value)
+            self._register_array(array, meta)
+            meta = _instrument_array_metadata(meta, self._profile_id, array=array)
+            return json.dumps(meta).encode()
+        if key.endswith(".zmetadata"):
+            consolidated = json.loads(value)
+            for meta_key, meta in consolidated["metadata"].items():
+                if meta_key.endswith(".zarray"):
+                    array = _get_array_name(meta_key)
+                    self._register_array(array, meta)
+                    consolidated["metadata"][meta_key] = _instrument_array_metadata(
+                        meta, self._profile_id, array=array
+                    )
+            return json.dumps(consolidated).encode()
+        return value
+
+    def __getitem__(self, key):
+        t_i = time.perf_counter_ns()
+        value = self._store[key]
+        elapsed = (time.perf_counter_ns() - t_i) / 1e9
+        if key.split("/")[-1].startswith("."):
+            _record(self._profile_id, "metadata", store_time=elapsed, n_reads=1, nbytes=len(value))
+            return self._instrument_metadata(key, value)
+        array = _get_array_name(key)
+        values = {"store_time": elapsed, "n_chunks": 1, "nbytes_fetched": len(value)}
+        if array in self._uncompressed_chunk_nbytes:
+            values["nbytes_decoded"] = self._uncompressed_chunk_nbytes[array] or len(value)
+        _record(self._profile_id, array, **values)
+        return value
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("The instrumented store is read-only.")
+
+    def __delitem__(self, key):
+        raise PermissionError("The instrumented store is read-only.")
+
+
+####--------------------------------------------------------------------------.
+#### Dask tasks timing
+def _get_task_timer():
+    """Return a dask callback timing the tasks executed by the local schedulers."""
+    from dask.callbacks import Callback
+
+    class _TaskTimer(Callback):
+        def __init__(self):
+            super().__init__()
+            self.task_time = 0
+            self.n_tasks = 0
+            self._starts = {}
+
+        def _pretask(self, key, dsk, state):
+            self._starts[key] = time.perf_counter_ns()
+
+        def _posttask(self, key, result, dsk, state, worker_id):
+            self.task_time += (time.perf_counter_ns() - self._starts.pop(key)) / 1e9
+            self.n_tasks += 1
+
+    return _TaskTimer()
+
+
+####--------------------------------------------------------------------------.
+#### Profiler
+def _summarize_variable_profile(counters, wall_time, task_time, n_tasks):
+    """Summarize the read profile of a variable."""
+    store_time = counters.get("store_time", 0)
+    decode_time = counters.get("decode_time", 0)
+    nbytes_fetched = counters.get("nbytes_fetched", 0)
+    nbytes_decoded = counters.get("nbytes_decoded", 0)
+    return {
+        "wall_time": wall_time,
+        "store_time": store_time,
+        "decode_time": decode_time,
+        "other_task_time": max(task_time - store_time - decode_time, 0),
+        "dask_overhead_time": max(wall_time - task_time, 0),
+        "n_tasks": n_tasks,
+        "n_chunks": int(counters.get("n_chunks", 0)),
+        "nbytes_fetched": int(nbytes_fetched),
+        "nbytes_decoded": int(nbytes_decoded),
+        "store_MBs": nbytes_fetched / 1024 / 1024 / store_time if store_time > 0 else None,
+        "decode_MBs": nbytes_decoded / 1024 / 1024 / decode_time if decode_time > 0 else None,
+    }
+
+
+def profile_zarr_reading(fpath, isel_dict={}, variables=None, scheduler="synchronous"):
+    """Profile the reading of each variable of a zarr store (subset).
+
+    The zarr store and codecs are instrumented to count the chunks and bytes fetched and
+    to time the store reads and the codec decoding. The dask tasks are timed with a callback.
+    Each variable is loaded separately.
+
+    The breakdown of each variable includes:
+    - 'wall_time': the time to load the variable.
+    - 'store_time': the time spent reading the chunks from the store.
+    - 'decode_time': the time spent decoding the chunks with the compressor and filters.
+    - 'other_task_time': the time spent in the dask tasks outside store reads and decoding
+      (i.e. indexing, CF decoding, assembling the chunks).
+    - 'dask_overhead_time': the time spent outside the dask tasks (graph and scheduling).
+    - the number of dask tasks, the number of chunks, the bytes fetched and decoded
+      and the store and decoding throughputs (in MB/s).
+
+    Store, decode and task times are summed across the threads. With the default
+    synchronous scheduler, the times add up to the wall time.
+
+    Parameters
+    ----------
+    fpath : (str, zarr.Store)
+        Filepath of the zarr store (or zarr.Store object).
+    isel_dict : dict, optional
+        Selection of the Dataset subset to read. The default is {}.
+    variables : list, optional
+        Variables to profile. If None (the default), all Dataset variables backed by dask.
+    scheduler : str, optional
+        Dask local scheduler ('synchronous' or 'threads'). The default is 'synchronous'.
+
+    Returns
+    -------
+    profile : dict
+        Dictionary with the 'open' profile (time and metadata reads) and
+        the breakdown of each variable in 'variables'.
+
+    """
+    if scheduler not in ["synchronous", "threads"]:
+        raise ValueError("'scheduler' must be 'synchronous' or 'threads'.")
+    store = zarr.DirectoryStore(fpath) if isinstance(fpath, str) else fpath
+    with _running_profile() as (profile_id, profile_counters):
+        store = _InstrumentedStore(store, profile_id=profile_id)
+        t_i = time.perf_counter_ns()
+        ds = xr.open_zarr(store)
+        open_time = (time.perf_counter_ns() - t_i) / 1e9
+        ds = ds.isel(isel_dict)
+        if variables is None:
+            variables = [var for var in list(ds.variables) if ds[var].chunks is not None]
+        wall_times = {}
+        task_timers = {}
+        for var in variables:
+            task_timer = _get_task_timer()
+            t_i = time.perf_counter_ns()
+            with task_timer:
+                ds[var].variable.compute(scheduler=scheduler)
+            wall_times[var] = (time.perf_counter_ns() - t_i) / 1e9
+            task_timers[var] = task_timer
+        counters = profile_counters.counters
+
+    metadata = counters.get("metadata", {})
+    profile = {
+        "open": {
+            "wall_time": open_time,
+            "metadata_time": metadata.get("store_time", 0),
+            "metadata_reads": int(metadata.get("n_reads", 0)),
+            "metadata_nbytes": int(metadata.get("nbytes", 0)),
+        },
+        "variables": {},
+    }
+    for var in variables:
+        profile["variables"][var] = _summarize_variable_profile(
+            counters.get(var, {}),
+            wall_time=wall_times[var],
+            task_time=task_timers[var].task_time,
+            n_tasks=task_timers[var].n_tasks,
+        )
+    return profile
+
+
+def get_profile_bottleneck(variable_profile):
+    """Return the dominant component of the read profile of a variable.
+
+    'store' --> Consider larger chunks, a faster storage or a store with fewer objects.
+    'decode' --> Consider a faster codec or a lower compression level.
+    'other' --> Consider chunks aligned with the selection or avoiding CF decoding.
+    'dask' --> Consider larger chunks (fewer tasks) or another scheduler.
+    """
+    components = {
+        "store": variable_profile["store_time"],
+        "decode": variable_profile["decode_time"],
+        "other": variable_profile["other_task_time"],
+        "dask": variable_profile["dask_overhead_time"],
+    }
+    return max(components, key=components.get)
@@ -4,12 +4,359 @@ Created on Thu Aug  3 09:05:13 2023
 
 @author: ghiggi
 """
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+import dask.array
+import numpy as np
+import zarr
+
 from xencoding.checks.chunks import check_chunks
-from xencoding.checks.zarr_store import _check_zarr_store
+from xencoding.checks.zarr_store import _check_zarr_store, _get_store_path
+from xencoding.utils.manifest import read_manifest, write_manifest
+
+MANIFEST_FILENAME = ".xencoding_rechunk.json"
+
+
+def _is_chunks_per_dims(ds, target_chunks):
+    """Return True if the chunks dictionary is defined per dimension."""
+    return all(key in ds.dims for key in target_chunks.keys())
+
+
+def _parse_target_chunks(ds, target_chunks):
+    """Return a 'per variable' target chunks dictionary including the coordinates.
+
+    Data variables chunks are checked with check_chunks (unspecified dimensions are not chunked).
+    If target_chunks is defined per dimension, coordinates are chunked accordingly.
+    Otherwise, coordinates are not chunked.
+    """
+    if not isinstance(target_chunks, dict):
+        raise TypeError("'target_chunks' must be a dictionary.")
+    dims_chunks = dict(target_chunks) if _is_chunks_per_dims(ds, target_chunks) else {}
+    chunks = check_chunks(ds=ds, chunks=target_chunks, default_chunks=None)
+    for coord in list(ds.coords):
+        coord_chunks = {}
+        for dim in ds[coord].dims:
+            chunk = dims_chunks.get(dim, -1)
+            if chunk is None or chunk == -1 or chunk > ds.sizes[dim]:
+                chunk = ds.sizes[dim]
+            coord_chunks[dim] = chunk
+        chunks[coord] = coord_chunks
+    return chunks
+
+
+####-------------------------------------------------------------------------.
+#### Checkpointed rechunking
+def _get_executor(executor, n_workers):
+    """Return a concurrent.futures executor.
+
+    executor = "threads" --> ThreadPoolExecutor
+    executor = "processes" --> ProcessPoolExecutor
+    executor = "distributed" --> dask.distributed executor on a LocalCluster
+    """
+    if executor == "threads":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    if executor == "processes":
+        return ProcessPoolExecutor(max_workers=n_workers)
+    if executor == "distributed":
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError:
+            raise ImportError("The 'distributed' executor requires the 'distributed' package.")
+        cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1)
+        return Client(cluster).get_executor()
+    raise ValueError("'executor' must be 'threads', 'processes' or 'distributed'.")
+
+
+def _close_executor(executor):
+    """Shutdown an executor (and the dask.distributed client and cluster)."""
+    executor.shutdown(wait=True)
+    client = getattr(executor, "_client", None)
+    if client is not None:
+        cluster = client.cluster
+        client.close()
+        cluster.close()
+
+
+def _get_blocks_slices(shape, chunks):
+    """Return the slices of the blocks with the given chunks covering an array."""
+    ranges = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    blocks = []
+    for starts in itertools.product(*ranges):
+        slices = tuple(
+            slice(start, min(start + chunk, size))
+            for start, chunk, size in zip(starts, chunks, shape)
+        )
+        blocks.append(slices)
+    return blocks
+
 
+def _copy_block(source, target, slices):
+    """Copy a block of a source array to a zarr array.
 
-def rechunk_dataset(ds, target_chunks, target_store, temp_store, max_mem, 
-                    force=False, **to_zarr_kwargs):
+    The source is either the dask array of the block or the source zarr array.
+    """
+    if isinstance(source, dask.array.Array):
+        data = source.compute(scheduler="synchronous")
+    else:
+        data = source[slices]
+    data = np.asarray(data)
+    target[slices] = data
+    return data.nbytes
+
+
+def _get_encoded_variables(ds):
+    """Return the dask-backed variables encoded as they are stored in zarr."""
+    from xarray.backends.zarr import encode_zarr_variable
+    from xarray.conventions import encode_dataset_coordinates
+
+    variables, _ = encode_dataset_coordinates(ds)
+    encoded = {}
+    for name, variable in variables.items():
+        if variable.chunks is None:
+            continue
+        encoded[name] = encode_zarr_variable(variable.copy()).data
+    return encoded
+
+
+def _get_largest_divisor(size, max_divisor):
+    """Return the largest divisor of size not larger than max_divisor."""
+    return max(d for d in range(1, min(size, max_divisor) + 1) if size % d == 0)
+
+
+def _get_intermediate_chunks(read_chunks, int_chunks):
+    """Return the chunks of the intermediate array, dividing the read chunks.
+
+    Each read block is then split into whole intermediate chunks, so that the blocks
+    copied concurrently never write to the same intermediate chunk.
+    """
+    return tuple(
+        _get_largest_divisor(read_chunk, int_chunk)
+        for read_chunk, int_chunk in zip(read_chunks, int_chunks)
+    )
+
+
+def _define_rechunk_plan(source, target_chunks, max_mem):
+    """Define the rechunking stages of an array.
+
+    Returns a list of (stage, block chunks, array chunks) tuples.
+    If the array fits in max_mem, it is copied in a single block.
+    If the read chunks are the write chunks, only the 'target' stage is defined.
+    Otherwise, an 'intermediate' stage is defined first: as in rechunker, the source is
+    read once in blocks of read chunks, which are split into the intermediate array chunks.
+    The array chunks of the 'target' stage are defined by the target store (None).
+    """
+    from rechunker.algorithm import rechunking_plan
+
+    # Arrays fitting in memory are copied directly in a single block
+    if source.nbytes <= max_mem:
+        return [("target", tuple(int(size) for size in source.shape), None)]
+    read_chunks, int_chunks, write_chunks = rechunking_plan(
+        source.shape,
+        source.chunksize,
+        target_chunks,
+        source.dtype.itemsize,
+        max_mem,
+        consolidate_reads=False,
+    )
+    read_chunks = tuple(int(c) for c in read_chunks)
+    int_chunks = tuple(int(c) for c in int_chunks)
+    write_chunks = tuple(int(c) for c in write_chunks)
+    if read_chunks == write_chunks:
+        return [("target", write_chunks, None)]
+    int_chunks = _get_intermediate_chunks(read_chunks, int_chunks)
+    return [("intermediate", read_chunks, int_chunks), ("target", write_chunks, None)]
+
+
+def _get_rechunk_template(ds, target_chunks, in_memory=False):
+    """Return the Dataset with the target chunks, without the source encoding chunks.
+
+    If in_memory=True, the source data are loaded in memory before being rechunked.
+    """
+    ds_template = ds.compute() if in_memory else ds.copy()
+    for var in list(ds_template.variables):
+        ds_template[var].encoding.pop("chunks", None)
+        ds_template[var].encoding.pop("preferred_chunks", None)
+    for var, chunks in target_chunks.items():
+        if ds[var].chunks is not None:
+            ds_template[var] = ds_template[var].chunk(chunks)
+    return ds_template
+
+
+def _get_dask_nbytes(ds):
+    """Return the size in bytes of the dask-backed variables of a Dataset."""
+    return sum(ds[var].nbytes for var in list(ds.variables) if ds[var].chunks is not None)
+
+
+def _initialize_rechunk(ds, target_chunks, target_store, temp_store, max_mem, to_zarr_kwargs):
+    """Create the target store and return the checkpoint manifest."""
+    # Create the target store metadata (and write the variables not backed by dask)
+    ds_template = _get_rechunk_template(ds, target_chunks)
+    ds_template.to_zarr(target_store, mode="w", compute=False, **to_zarr_kwargs)
+    # Define the rechunking plan of each variable
+    encoded = _get_encoded_variables(ds)
+    manifest = {"variables": {}}
+    for var, source in encoded.items():
+        var_target_chunks = tuple(target_chunks[var][dim] for dim in ds[var].dims)
+        stages = _define_rechunk_plan(source, var_target_chunks, max_mem=max_mem)
+        manifest["variables"][var] = {
+            "target_chunks": list(var_target_chunks),
+            "stages": {
+                stage: {
+                    "chunks": list(chunks),
+                    "array_chunks": list(array_chunks) if array_chunks is not None else None,
+                    "completed": [],
+                }
+                for stage, chunks, array_chunks in stages
+            },
+        }
+    write_manifest(os.path.join(temp_store, MANIFEST_FILENAME), manifest)
+    return manifest
+
+
+def _run_rechunk_stage(
+    executor, source, target, chunks, completed, checkpoint, checkpoint_interval
+):
+    """Copy the missing blocks of a rechunking stage and return its throughput in MB/s."""
+    blocks = _get_blocks_slices(source.shape, chunks)
+    completed_set = set(completed)
+    t_i = time.time()
+    t_checkpoint = t_i
+    nbytes = 0
+    # Dask sources are sliced before submission to send only the graph of the block
+    is_dask = isinstance(source, dask.array.Array)
+    futures = {
+        executor.submit(_copy_block, source[slices] if is_dask else source, target, slices): i
+        for i, slices in enumerate(blocks)
+        if i not in completed_set
+    }
+    try:
+        for future in as_completed(futures):
+            nbytes += future.result()
+            completed.append(futures[future])
+            if time.time() - t_checkpoint > checkpoint_interval:
+                checkpoint()
+                t_checkpoint = time.time()
+    except Exception:
+        # Cancel the pending blocks and checkpoint all blocks completed before the failure
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        recorded = set(completed)
+        for future, i in futures.items():
+            if i not in recorded and not future.cancelled() and future.exception() is None:
+                completed.append(i)
+        checkpoint()
+        raise
+    checkpoint()
+    elapsed = time.time() - t_i
+    if nbytes == 0:
+        return None
+    return round(nbytes / 1024 / 1024 / max(elapsed, 1e-9), 3)
+
+
+def _rechunk_dataset_checkpointed(
+    ds,
+    target_chunks,
+    target_store,
+    temp_store,
+    max_mem,
+    force,
+    executor,
+    n_workers,
+    resume,
+    checkpoint_interval,
+    to_zarr_kwargs,
+):
+    """Rechunk a Dataset with checkpoints of the completed intermediate and target blocks."""
+    target_path = _get_store_path(target_store)
+    temp_path = _get_store_path(temp_store)
+    manifest_path = os.path.join(temp_path, MANIFEST_FILENAME)
+
+    # Initialize or resume the rechunking
+    manifest = read_manifest(manifest_path) if resume else {}
+    if len(manifest) == 0 or not os.path.exists(target_path):
+        _check_zarr_store(target_store, force=force)
+        _check_zarr_store(temp_store, force=True)
+        os.makedirs(temp_path)
+        manifest = _initialize_rechunk(
+            ds,
+            target_chunks=target_chunks,
+            target_store=target_store,
+            temp_store=temp_path,
+            max_mem=max_mem,
+            to_zarr_kwargs=to_zarr_kwargs,
+        )
+    for var, var_manifest in manifest["variables"].items():
+        expected_chunks = [target_chunks[var][dim] for dim in ds[var].dims]
+        if var_manifest["target_chunks"] != expected_chunks:
+            raise ValueError(
+                f"The checkpoint in {temp_path} refers to different target chunks for {var}. "
+                "Specify resume=False to restart the rechunking."
+            )
+
+    # Rechunk each variable
+    encoded = _get_encoded_variables(ds)
+    target_group = zarr.open_group(target_path, mode="r+")
+    temp_group = zarr.open_group(temp_path, mode="a")
+    report = {}
+
+    def checkpoint():
+        write_manifest(manifest_path, manifest)
+
+    pool = _get_executor(executor, n_workers=n_workers)
+    try:
+        for var, var_manifest in manifest["variables"].items():
+            source = encoded[var]
+            target = target_group[var]
+            report[var] = {}
+            for stage, stage_manifest in var_manifest["stages"].items():
+                if stage == "intermediate":
+                    # - Blocks of read chunks are split into the intermediate array chunks
+                    array_chunks = stage_manifest.get("array_chunks") or stage_manifest["chunks"]
+                    stage_target = temp_group.require_dataset(
+                        var,
+                        shape=source.shape,
+                        chunks=tuple(array_chunks),
+                        dtype=source.dtype,
+                    )
+                else:
+                    stage_target = target
+                report[var][stage] = _run_rechunk_stage(
+                    pool,
+                    source=source,
+                    target=stage_target,
+                    chunks=stage_manifest["chunks"],
+                    completed=stage_manifest["completed"],
+                    checkpoint=checkpoint,
+                    checkpoint_interval=checkpoint_interval,
+                )
+                source = stage_target
+    finally:
+        _close_executor(pool)
+
+    # Consolidate metadata and remove the temporary store
+    zarr.consolidate_metadata(target_path)
+    _check_zarr_store(temp_store, force=True)
+    return report
+
+
+####-------------------------------------------------------------------------.
+def rechunk_dataset(
+    ds,
+    target_chunks,
+    target_store,
+    temp_store,
+    max_mem,
+    force=False,
+    executor=None,
+    n_workers=None,
+    resume=False,
+    checkpoint_interval=5,
+    **to_zarr_kwargs,
+):
     """
     Rechunk on disk a xarray Dataset read lazily from a zarr store.
 
@@ -18,8 +365,9 @@ def rechunk_dataset(ds, target_chunks, target_store, temp_store, max_mem,
     ds : xarray.Dataset
         A Dataset opened with open_zarr().
     target_chunks : dict
-        Custom chunks of the new Dataset.
-        If not specified for each Dataset variable, implicitly assumed.
+        Custom chunks of the new Dataset. See check_chunks().
+        If specified per dimension, unspecified dimensions are not chunked.
+        If specified per variable, the coordinates are not chunked.
     target_store : str, zarr.Store
         Filepath of the zarr store (or zarr.Store object) where to save the new Dataset.
     temp_store : str
@@ -28,18 +376,78 @@ def rechunk_dataset(ds, target_chunks, target_store, temp_store, max_mem,
     max_mem : str, optional
         The amount of memory (in bytes) that each workers is allowed to use.
         A string (e.g. 100MB) can also be used.
-    force : bool 
-        If the target_store already exists, if force=True it is removed, otherwise 
-        an error is raised. 
+        If the Dataset fits in max_mem, it is rechunked in memory in a single pass
+        without temporary data. Otherwise, each variable fitting in max_mem is copied
+        directly, and the others are rechunked with at most one intermediate stage.
+    force : bool
+        If the target_store already exists, if force=True it is removed, otherwise
+        an error is raised.
+    executor : str, optional
+        If None (the default), the rechunking is performed by rechunker with dask.
+        If 'threads', 'processes' or 'distributed' (dask LocalCluster), the rechunking
+        stages are executed with the specified executor and the completed blocks are
+        checkpointed in temp_store, which is kept in case of failure.
+    n_workers : int, optional
+        Number of workers of the executor. If None, it defaults to the number of CPUs.
+    resume : bool, optional
+        If True, resume a checkpointed rechunking that previously failed. The default is False.
+        Only used if executor is specified.
+    checkpoint_interval : float, optional
+        Minimum time interval in seconds between two checkpoints. The default is 5.
     to_zarr_kwargs: dict
         Arguments to pass to the ds.to_zarr() functions.
-        This includes the encoding dictionary ! 
-    
+        This includes the encoding dictionary !
+
     Returns
     -------
-    None.
+    report : dict
+        If executor is specified, the throughput (MB/s) of each rechunking stage
+        of each variable, with format {<var>: {<stage>: <MB/s>}}.
+        Stages are 'intermediate' (if required) and 'target'.
+        If the Dataset is rechunked in memory, the variables are written together and
+        a single throughput of the whole Dataset is reported: {'dataset': {'target': <MB/s>}}.
+        Otherwise None.
 
     """
+    from dask.utils import parse_bytes
+
+    ##------------------------------------------------------------------------.
+    # Check chunks
+    # - Coordinates chunks are added to the data variables chunks
+    target_chunks = _parse_target_chunks(ds, target_chunks)
+    if isinstance(max_mem, str):
+        max_mem = parse_bytes(max_mem)
+
+    # In-memory rechunking
+    # - If the data fit in memory, the source chunks are read and the target chunks written
+    #   in a single pass, without temporary data.
+    if _get_dask_nbytes(ds) <= max_mem:
+        _check_zarr_store(target_store, force=force)
+        t_i = time.time()
+        ds_target = _get_rechunk_template(ds, target_chunks, in_memory=True)
+        ds_target.to_zarr(target_store, mode="w", **to_zarr_kwargs)
+        elapsed = max(time.time() - t_i, 1e-9)
+        if executor is None:
+            return None
+        # - The variables are written together: a single Dataset throughput is reported
+        return {"dataset": {"target": round(_get_dask_nbytes(ds) / 1024 / 1024 / elapsed, 3)}}
+
+    # Checkpointed rechunking
+    if executor is not None:
+        return _rechunk_dataset_checkpointed(
+            ds,
+            target_chunks=target_chunks,
+            target_store=target_store,
+            temp_store=temp_store,
+            max_mem=max_mem,
+            force=force,
+            executor=executor,
+            n_workers=n_workers if n_workers is not None else os.cpu_count(),
+            resume=resume,
+            checkpoint_interval=checkpoint_interval,
+            to_zarr_kwargs=to_zarr_kwargs,
+        )
+
     ##------------------------------------------------------------------------.
     from dask.diagnostics import ProgressBar
     from rechunker import rechunk
@@ -48,20 +456,8 @@ def rechunk_dataset(ds, target_chunks, target_store, temp_store, max_mem,
     _check_zarr_store(target_store, force=force)
     _check_zarr_store(temp_store, force=True)  # remove if exists
 
-    # Check chunks
-    # - If target chunk is a dictionary, should also include the dimensions chunks !  
-    # - currently check_chunks does not include dimensions ! 
-    # --> SOLVE THE BUG. Can inspire from parse_target_chunks_from_dim_chunks
-    
-    # --> rechunker.parse_target_chunks_from_dim_chunks
-    # from rechunker.api import parse_target_chunks_from_dim_chunks
-    # target_chunks = parse_target_chunks_from_dim_chunks(ds, target_chunks)
-    
-    # target_chunks = check_chunks(ds=ds, chunks=target_chunks, default_chunks=None)
-    # print(target_chunks)
-    
     # Plan rechunking
-    try: 
+    try:
         r = rechunk(
             ds,
             target_chunks=target_chunks,
@@ -70,11 +466,11 @@ def rechunk_dataset(ds, target_chunks, target_store, temp_store, max_mem,
             temp_store=temp_store,
             target_options=to_zarr_kwargs,
         )
-    
+
         # Execute rechunking
         with ProgressBar():
             r.execute()
-    except Exception:
+    except Exception as err:
         # Remove temporary store
         _check_zarr_store(temp_store, force=True)  # remove if exists
-        raise ValueError("Rechunking failed!")
+        raise ValueError("Rechunking failed!") from err
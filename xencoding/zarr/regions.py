@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Created on Thu Oct 17 10:21:54 2024
+
+@author: ghiggi
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+
+def _get_stream_variables(ds, stream_dim):
+    """Return the dask-backed variables with and without the stream dimension."""
+    stream_vars = []
+    static_vars = []
+    for var in list(ds.variables):
+        if ds[var].chunks is None:
+            continue
+        if stream_dim in ds[var].dims:
+            stream_vars.append(var)
+        else:
+            static_vars.append(var)
+    return stream_vars, static_vars
+
+
+def _get_stream_block_size(ds, stream_dim, stream_vars, chunk_sizes, max_mem=None, n_workers=1):
+    """Return the number of stream_dim indices written by each region write.
+
+    The block size is a multiple of the chunk sizes of the variables along stream_dim,
+    so that every region write covers whole chunks.
+    If max_mem is specified, the blocks written concurrently by the n_workers must fit in max_mem.
+    """
+    from dask.utils import parse_bytes
+
+    block_size = int(np.lcm.reduce(chunk_sizes))
+    if max_mem is None:
+        return block_size
+    if isinstance(max_mem, str):
+        max_mem = parse_bytes(max_mem)
+    index_nbytes = sum(ds[var].nbytes / ds.sizes[stream_dim] for var in stream_vars)
+    n_blocks = int(max_mem / n_workers // (block_size * index_nbytes))
+    if n_blocks == 0:
+        raise ValueError(
+            f"A block of {block_size} '{stream_dim}' indices requires "
+            f"{block_size * index_nbytes / 1024 / 1024:.1f} MB per worker, "
+            "which exceeds 'max_mem'. Decrease the chunk size along 'stream_dim' or increase 'max_mem'."
+        )
+    return block_size * n_blocks
+
+
+def _get_region_slices(size, block_size, start=0):
+    """Return the slices of the blocks covering the range [start, size).
+
+    The blocks boundaries are multiples of block_size, so the first block
+    is shorter if start is not a multiple of block_size.
+    """
+    boundaries = list(range((start // block_size + 1) * block_size, size, block_size))
+    boundaries = [start] + boundaries + [size]
+    return [slice(i, j) for i, j in zip(boundaries[:-1], boundaries[1:])]
+
+
+def _get_variables_subset(ds, variables):
+    """Return the Dataset with only the specified variables (data variables or coordinates)."""
+    return ds.drop_vars([var for var in list(ds.variables) if var not in variables])
+
+
+def _get_region_num_workers(n_workers):
+    """Return the number of dask threads of each of the n_workers concurrent region writes."""
+    import dask
+    from dask.system import CPU_COUNT
+
+    num_workers = dask.config.get("num_workers", None) or CPU_COUNT
+    return max(num_workers // n_workers, 1)
+
+
+def _write_zarr_region(ds, zarr_store, region, mode="r+", num_workers=None):
+    """Write the dask-backed variables of a Dataset subset into a region of an existing zarr store.
+
+    Variables not backed by dask are already written when the store is initialized.
+    With mode="a", the region can start or end within a chunk.
+    If specified, num_workers bounds the number of dask threads of the writing.
+    """
+    non_dask_vars = [var for var in list(ds.variables) if ds[var].chunks is None]
+    ds = ds.drop_vars(non_dask_vars)
+    r = ds.to_zarr(store=zarr_store, region=region, mode=mode, consolidated=False, compute=False)
+    r.compute(num_workers=num_workers)
+
+
+def _write_zarr_regions(
+    ds,
+    zarr_store,
+    stream_dim,
+    slices,
+    offset=0,
+    n_workers=1,
+    mode="r+",
+    callback=None,
+):
+    """Write the Dataset by blocks along stream_dim using region writes.
+
+    The slices refer to the store indices, and offset is the store index
+    of the first Dataset index along stream_dim.
+    If specified, callback(slc) is called (in the calling thread) once a block is written.
+    The dask threads are shared among the n_workers blocks written concurrently.
+    """
+    stream_vars, _ = _get_stream_variables(ds, stream_dim)
+    ds_stream = _get_variables_subset(ds, stream_vars)
+    num_workers = _get_region_num_workers(n_workers)
+
+    def _write_block(slc):
+        ds_block = ds_stream.isel({stream_dim: slice(slc.start - offset, slc.stop - offset)})
+        _write_zarr_region(
+            ds_block, zarr_store, region={stream_dim: slc}, mode=mode, num_workers=num_workers
+        )
+        return slc
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_write_block, slc) for slc in slices]
+        for future in as_completed(futures):
+            slc = future.result()
+            if callback is not None:
+                callback(slc)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Created on Tue Oct 15 14:40:08 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+from xencoding.zarr.estimation import estimate_compression
+from xencoding.zarr.filters import CodecPipeline
+
+OBJECTIVES = {
+    "size": {"compression_ratio": 1},
+    "read": {"decode_MBs": 1},
+    "write": {"encode_MBs": 1},
+    "balanced": {"compression_ratio": 1, "decode_MBs": 1, "encode_MBs": 1},
+}
+
+
+def get_candidate_compressors(clevels=[1, 5, 9], max_slow_clevel=3):
+    """Get the compressors evaluated when compressor='optimize'.
+
+    The levels of the slow zip (GZip, BZ2) and LZMA compressors are capped to max_slow_clevel,
+    to keep the sample benchmark fast.
+    """
+    from xencoding.zarr.benchmarking import (
+        _get_blosc_compressors,
+        _get_lmza_compressors,
+        _get_zip_compressors,
+    )
+
+    slow_clevels = sorted({min(clevel, max_slow_clevel) for clevel in clevels})
+    compressors = _get_blosc_compressors(clevels=clevels)
+    compressors.update(_get_zip_compressors(clevels=slow_clevels))
+    compressors.update(_get_lmza_compressors(clevels=slow_clevels))
+    return compressors
+
+
+def check_objective(objective):
+    """Check objective validity and return the weights of each metric.
+
+    objective = "size" --> Maximize the compression ratio.
+    objective = "read" --> Maximize the decoding throughput.
+    objective = "write" --> Maximize the encoding throughput.
+    objective = "balanced" --> Equal weights to compression ratio and encoding/decoding throughput.
+    objective = {..} --> A dictionary with the weight of 'compression_ratio', 'decode_MBs' and 'encode_MBs'.
+    """
+    if isinstance(objective, str):
+        if objective not in OBJECTIVES:
+            raise ValueError(f"Invalid 'objective'. Valid objectives are {list(OBJECTIVES)}.")
+        return OBJECTIVES[objective]
+    if not isinstance(objective, dict):
+        raise TypeError("'objective' must be a string or a dictionary of metric weights.")
+    valid_metrics = ["compression_ratio", "decode_MBs", "encode_MBs"]
+    if not np.all(np.isin(list(objective.keys()), valid_metrics)):
+        raise ValueError(f"The 'objective' dictionary keys must be within {valid_metrics}.")
+    if any(not isinstance(w, (int, float)) or w < 0 for w in objective.values()):
+        raise ValueError("The 'objective' weights must be positive numbers.")
+    if sum(objective.values()) == 0:
+        raise ValueError("At least one 'objective' weight must be larger than 0.")
+    return objective
+
+
+def _get_best_compressor(estimates, weights):
+    """Return the name of the compressor with the highest weighted score.
+
+    Each metric is normalized by its maximum across the compressors.
+    """
+    names = list(estimates.keys())
+    scores = np.zeros(len(names))
+    for metric, weight in weights.items():
+        values = np.array([estimates[name][metric] for name in names], dtype=float)
+        scores += weight * values / values.max()
+    return names[int(np.argmax(scores))]
+
+
+def select_compressors(
+    ds,
+    objective="size",
+    compressors=None,
+    chunks=None,
+    variables=None,
+    n_samples=3,
+    seed=0,
+    cache=None,
+    filters=None,
+):
+    """Select the best compressor of each Dataset variable from a sample benchmark.
+
+    The compressors are ranked with estimate_compression() on a sample of chunks.
+    If filters are specified, the chunks are encoded with the filters of each
+    variable before the compressors.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    objective : (str, dict), optional
+        Selection objective. See check_objective(). The default is "size".
+    compressors : dict, optional
+        Candidate compressors with format {<compressor_name>: <numcodecs compressor>}.
+        If None (the default), it uses get_candidate_compressors().
+    chunks : (None, dict), optional
+        Chunks used to sample the Dataset. See check_chunks().
+        If None (the default), the current Dataset chunks are used.
+    variables : list, optional
+        Dataset variables for which to select a compressor.
+        If None (the default), all numeric data variables.
+    n_samples : int, optional
+        Number of chunks sampled for each variable. The default is 3.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+    cache : (None, bool, str, ResultCache), optional
+        Cache of the sample benchmark results. See estimate_compression().
+        The default is None (no cache).
+    filters : dict, optional
+        Filters chain of the variables with format {<variable>: <list of numcodecs filters>}.
+        See check_filters(). The default is None.
+
+    Returns
+    -------
+    compressor : dict
+        A dictionary with format {<variable>: <numcodecs compressor>}.
+
+    """
+    weights = check_objective(objective)
+    if compressors is None:
+        compressors = get_candidate_compressors()
+    if variables is None:
+        variables = [var for var in ds.data_vars if np.issubdtype(ds[var].dtype, np.number)]
+    filters = {} if filters is None else filters
+    estimates = {}
+    for var in variables:
+        if filters.get(var) is not None:
+            var_compressors = {
+                name: CodecPipeline(filters[var], compressor)
+                for name, compressor in compressors.items()
+            }
+        else:
+            var_compressors = compressors
+        estimates.update(
+            estimate_compression(
+                ds,
+                compressors=var_compressors,
+                chunks=chunks,
+                variables=[var],
+                n_samples=n_samples,
+                n_bootstrap=1,
+                seed=seed,
+                cache=cache,
+            )
+        )
+    compressor = {}
+    for var in variables:
+        compressor[var] = compressors[_get_best_compressor(estimates[var], weights)]
+    return compressor
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Created on Wed Oct 23 09:34:11 2024
+
+@author: ghiggi
+"""
+import numpy as np
+
+# Sharding planning helpers.
+# Sharded (zarr v3) arrays are not written by write_zarr: the package relies on zarr v2
+# stores and APIs (i.e. zarr.DirectoryStore), which zarr v3 removed.
+
+
+def _get_variable_shards(shape, chunks, itemsize, target_size):
+    """Return the shard shape of a variable with uncompressed shards of ~target_size bytes.
+
+    The number of chunks per shard is doubled along the dimension with the smallest
+    fraction of the dimension covered by the shard, until the shard reaches the
+    target size or spans the entire array.
+    """
+    n_chunks_grid = [int(np.ceil(size / chunk)) for size, chunk in zip(shape, chunks)]
+    n_chunks_shard = [1] * len(shape)
+    chunk_nbytes = int(np.prod(chunks)) * itemsize
+    while chunk_nbytes * int(np.prod(n_chunks_shard)) * 2 <= target_size:
+        candidates = [i for i, n in enumerate(n_chunks_shard) if n < n_chunks_grid[i]]
+        if len(candidates) == 0:
+            break
+        i = min(candidates, key=lambda i: n_chunks_shard[i] / n_chunks_grid[i])
+        n_chunks_shard[i] = min(2 * n_chunks_shard[i], n_chunks_grid[i])
+    return [n * chunk for n, chunk in zip(n_chunks_shard, chunks)]
+
+
+def get_shards(ds, chunks, target_size="256MB", storage_ratio=1):
+    """Return the shard shape of each Dataset variable for a target storage object size.
+
+    Shards are multiples of the inner chunks, so that reads keep the chunks granularity
+    while the number of stored objects is divided by the number of chunks per shard.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset.
+    chunks : dict
+        'Per variable' chunks dictionary of the inner chunks. See check_chunks().
+    target_size : (int, str), optional
+        Target size (in bytes) of the stored shards. A string (e.g. 256MB) can also be used.
+        The default is "256MB".
+    storage_ratio : (float, dict), optional
+        Expected compression ratio (uncompressed/compressed) of the variables.
+        A dictionary {<variable>: <ratio>} can be used to specify it per variable.
+        See get_zarr_storage_stats(). The default is 1 (no compression).
+
+    Returns
+    -------
+    shards : dict
+        'Per variable' shards dictionary with format {<var>: {<dim>: <shard_size>}}.
+
+    """
+    from dask.utils import parse_bytes
+
+    if isinstance(target_size, str):
+        target_size = parse_bytes(target_size)
+    shards = {}
+    for var, var_chunks in chunks.items():
+        if var_chunks is None:
+            shards[var] = None
+            continue
+        da = ds[var]
+        ratio = storage_ratio[var] if isinstance(storage_ratio, dict) else storage_ratio
+        var_shards = _get_variable_shards(
+            shape=da.shape,
+            chunks=[var_chunks[dim] for dim in da.dims],
+            itemsize=da.dtype.itemsize,
+            target_size=target_size * ratio,
+        )
+        shards[var] = dict(zip(da.dims, var_shards))
+    return shards
+
+
+def get_number_of_objects(ds, chunks, shards=None):
+    """Return the number of storage objects of each Dataset variable.
+
+    If shards=None, each chunk is stored as a separate object.
+    """
+    blocks = chunks if shards is None else shards
+    n_objects = {}
+    for var, var_blocks in blocks.items():
+        if var_blocks is None:
+            n_objects[var] = 1
+            continue
+        n_objects[var] = int(
+            np.prod([np.ceil(ds[var].sizes[dim] / var_blocks[dim]) for dim in ds[var].dims])
+        )
+    return n_objects
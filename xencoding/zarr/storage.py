@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Created on Fri Oct 18 09:34:20 2024
+
+@author: ghiggi
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import zarr
+
+
+def _get_zarr_store(store):
+    """Return a zarr store (a DirectoryStore if a path is given)."""
+    if isinstance(store, str):
+        return zarr.DirectoryStore(store)
+    return store
+
+
+def _open_zarr_group(store):
+    """Open a zarr group in read mode, using the consolidated metadata if available."""
+    store = _get_zarr_store(store)
+    if ".zmetadata" in store:
+        return zarr.open_consolidated(store, mode="r")
+    return zarr.open_group(store, mode="r")
+
+
+def _scan_chunk_files(dir_path, prefix=""):
+    """Return the size of the chunk files in an array directory.
+
+    Metadata files (starting with '.') are skipped.
+    Nested directories (dimension_separator='/') are scanned recursively.
+    Returns a dictionary with format {<chunk key>: <size>}.
+    """
+    sizes = {}
+    if not os.path.isdir(dir_path):
+        return sizes
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                sizes.update(_scan_chunk_files(entry.path, prefix=prefix + entry.name + "/"))
+            else:
+                sizes[prefix + entry.name] = entry.stat(follow_symlinks=False).st_size
+    return sizes
+
+
+def _get_chunk_files_sizes(store, arr):
+    """Return the size of the stored chunks of a zarr array.
+
+    For a DirectoryStore, the chunk files are listed with os.scandir.
+    For other stores, the chunk sizes are retrieved from the store
+    (without reading the chunks if the store implements getsize).
+    Returns a dictionary with format {<chunk key>: <size>}.
+    """
+    if isinstance(store, zarr.DirectoryStore):
+        return _scan_chunk_files(os.path.join(store.path, arr.path))
+    prefix = arr.path + "/" if arr.path else ""
+    sizes = {}
+    for key in store.keys():
+        if not key.startswith(prefix):
+            continue
+        chunk_key = key[len(prefix) :]
+        if chunk_key.split("/")[-1].startswith("."):
+            continue
+        # Skip the keys of other arrays
+        if "/" in chunk_key and arr._dimension_separator != "/":
+            continue
+        sizes[chunk_key] = zarr.storage.getsize(store, key)
+    return sizes
+
+
+def _get_zarr_array_stats(arr, store=None):
+    """Return the storage statistics of a zarr array.
+
+    Sizes are in bytes. The storage ratio and the mean chunk size
+    refer to the stored chunks only.
+    If the array has been opened from consolidated metadata, the underlying store must be given.
+    """
+    store = arr.chunk_store if store is None else store
+    sizes = list(_get_chunk_files_sizes(store, arr).values())
+    n_chunks = len(sizes)
+    nbytes_stored = int(sum(sizes))
+    nbytes = int(arr.nbytes)
+    return {
+        "nbytes": nbytes,
+        "nbytes_stored": nbytes_stored,
+        "storage_ratio": round(nbytes / nbytes_stored, 3) if nbytes_stored > 0 else None,
+        "n_chunks": n_chunks,
+        "n_chunks_grid": int(arr.nchunks),
+        "mean_chunk_size": round(nbytes_stored / n_chunks, 1) if n_chunks > 0 else None,
+    }
+
+
+def get_zarr_storage_stats(store, n_workers=8):
+    """Return the storage statistics of each array of a zarr store.
+
+    The store metadata are read once (from the consolidated metadata if available)
+    and only the size of the chunk objects is retrieved, without reading their content.
+    The chunk files of the arrays are listed concurrently.
+
+    Parameters
+    ----------
+    store : (str, zarr.Store)
+        Filepath of the zarr store (or zarr.Store object).
+    n_workers : int, optional
+        Number of arrays listed concurrently. The default is 8.
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with format {<array>: <stats>}.
+        Each stats dictionary includes the uncompressed size 'nbytes', the stored size
+        'nbytes_stored' (in bytes), the 'storage_ratio', the number of stored chunks 'n_chunks',
+        the number of chunks of the chunk grid 'n_chunks_grid' and
+        the 'mean_chunk_size' (in bytes) of the stored chunks.
+
+    """
+    store = _get_zarr_store(store)
+    group = _open_zarr_group(store)
+    arrays = dict(group.arrays())
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list_stats = executor.map(
+            lambda arr: _get_zarr_array_stats(arr, store=store), arrays.values()
+        )
+        stats = dict(zip(arrays.keys(), list_stats))
+    return stats
+
+
+def get_zarr_storage_summary(stats):
+    """Summarize the storage statistics of a zarr store across all arrays."""
+    nbytes = sum(arr_stats["nbytes"] for arr_stats in stats.values())
+    nbytes_stored = sum(arr_stats["nbytes_stored"] for arr_stats in stats.values())
+    n_chunks = sum(arr_stats["n_chunks"] for arr_stats in stats.values())
+    return {
+        "nbytes": nbytes,
+        "nbytes_stored": nbytes_stored,
+        "storage_ratio": round(nbytes / nbytes_stored, 3) if nbytes_stored > 0 else None,
+        "n_chunks": n_chunks,
+        "mean_chunk_size": round(nbytes_stored / n_chunks, 1) if n_chunks > 0 else None,
+    }
+
+
+####-------------------------------------------------------------------------.
+#### Chunks storage
+def _get_chunk_index(chunk_key, dimension_separator):
+    """Return the chunk grid index of a chunk key."""
+    return tuple(int(i) for i in chunk_key.split(dimension_separator or "."))
+
+
+def get_zarr_chunks_storage(store, variable):
+    """Return the stored size and the compression ratio of each chunk of a zarr array.
+
+    Only the size of the chunk objects is retrieved, without reading their content.
+    Chunks not written in the store (i.e. filled with the fill_value) are set to NaN.
+
+    Parameters
+    ----------
+    store : (str, zarr.Store)
+        Filepath of the zarr store (or zarr.Store object).
+    variable : str
+        Name of the array.
+
+    Returns
+    -------
+    ds_chunks : xarray.Dataset
+        Dataset on the chunk grid with the 'nbytes_stored' (in bytes) and 'storage_ratio'
+        of each chunk. The coordinates are the indices of the first element of each chunk.
+
+    """
+    import xarray as xr
+
+    store = _get_zarr_store(store)
+    arr = _open_zarr_group(store)[variable]
+    dims = arr.attrs.get("_ARRAY_DIMENSIONS", [f"dim_{i}" for i in range(arr.ndim)])
+    grid_shape = arr.cdata_shape
+    nbytes_stored = np.full(grid_shape, np.nan)
+    for chunk_key, size in _get_chunk_files_sizes(store, arr).items():
+        nbytes_stored[_get_chunk_index(chunk_key, arr._dimension_separator)] = size
+    # Edge chunks are stored with the full chunk shape
+    chunk_nbytes = np.prod(arr.chunks) * arr.dtype.itemsize
+    coords = {
+        dim: np.arange(n_chunks) * chunk
+        for dim, n_chunks, chunk in zip(dims, grid_shape, arr.chunks)
+    }
+    ds_chunks = xr.Dataset(
+        {
+            "nbytes_stored": (dims, nbytes_stored),
+            "storage_ratio": (dims, chunk_nbytes / nbytes_stored),
+        },
+        coords=coords,
+    )
+    ds_chunks.attrs["variable"] = variable
+    ds_chunks.attrs["chunks"] = list(arr.chunks)
+    ds_chunks.attrs["chunk_nbytes"] = int(chunk_nbytes)
+    return ds_chunks
+
+
+def flag_chunks_outliers(ds_chunks, threshold=3.5):
+    """Flag the chunks with an outlying compression ratio.
+
+    Outliers are detected with the robust z-score of the log compression ratio
+    (based on the median absolute deviation). Chunks not written in the store are ignored.
+    Chunks with a negative robust z-score are badly compressible (e.g. noisy edges),
+    while chunks with a positive robust z-score are highly compressible (e.g. NaN-filled regions).
+
+    Parameters
+    ----------
+    ds_chunks : xarray.Dataset
+        Chunks storage Dataset returned by get_zarr_chunks_storage().
+    threshold : float, optional
+        Absolute robust z-score above which a chunk is an outlier. The default is 3.5.
+
+    Returns
+    -------
+    ds_chunks : xarray.Dataset
+        Chunks storage Dataset with the 'robust_zscore' and 'is_outlier' variables.
+
+    """
+    log_ratio = np.log(ds_chunks["storage_ratio"])
+    median = float(log_ratio.median())
+    abs_deviation = np.abs(log_ratio - median)
+    ds_chunks = ds_chunks.copy()
+    mad = float(abs_deviation.median())
+    # If more than half of the chunks have the same ratio, the mean absolute deviation is used
+    if mad > 0:
+        ds_chunks["robust_zscore"] = 0.6745 * (log_ratio - median) / mad
+    elif float(abs_deviation.mean()) > 0:
+        ds_chunks["robust_zscore"] = (log_ratio - median) / (1.253314 * float(abs_deviation.mean()))
+    else:
+        ds_chunks["robust_zscore"] = log_ratio * 0
+    ds_chunks["is_outlier"] = np.abs(ds_chunks["robust_zscore"]) > threshold
+    return ds_chunks
+
+
+def get_zarr_chunks_outliers(store, variable, threshold=3.5):
+    """Return the report of the chunks of a zarr array with an outlying compression ratio.
+
+    See get_zarr_chunks_storage() and flag_chunks_outliers().
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Outlier chunks sorted by increasing compression ratio, with their 'nbytes_stored',
+        'storage_ratio' and 'robust_zscore'. The index refers to the first element of each chunk.
+
+    """
+    ds_chunks = flag_chunks_outliers(
+        get_zarr_chunks_storage(store, variable=variable), threshold=threshold
+    )
+    df = ds_chunks.to_dataframe()
+    df = df[df["is_outlier"]].drop(columns="is_outlier")
+    return df.sort_values("storage_ratio")
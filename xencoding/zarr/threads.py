@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Created on Wed Oct 30 09:52:27 2024
+
+@author: ghiggi
+"""
+import os
+import shutil
+from contextlib import contextmanager, nullcontext
+
+import numcodecs
+import numpy as np
+import xarray as xr
+
+from xencoding.utils.timing import time_function
+from xencoding.zarr.numcodecs import blosc_threads
+
+DEFAULT_BLOCKSIZES = [0, 2**16, 2**18, 2**20]
+
+
+def _get_powers_of_two(n):
+    """Return the powers of two smaller than n, and n."""
+    values = [2**i for i in range(int(np.log2(n)) + 1)]
+    if values[-1] != n:
+        values.append(n)
+    return values
+
+
+def get_threads_configurations(n_cores=None, oversubscription=1):
+    """Return the candidate (dask_threads, blosc_nthreads) configurations of a host.
+
+    When blosc_nthreads > 1, blosc uses a single global pool of blosc_nthreads threads,
+    shared (under a mutex) by all the dask threads. When blosc_nthreads = 1, each dask thread
+    compresses with its own single-threaded blosc context. See threads_context().
+    Hence dask_threads and blosc_nthreads do not multiply: each of them does not exceed
+    n_cores * oversubscription, to avoid the oversubscription of the cores.
+
+    Parameters
+    ----------
+    n_cores : int, optional
+        Number of cores of the host. If None (the default), os.cpu_count().
+    oversubscription : float, optional
+        Maximum ratio between the number of (dask or blosc) threads and the number of cores.
+        The default is 1.
+
+    Returns
+    -------
+    configurations : list
+        List of (dask_threads, blosc_nthreads) tuples.
+
+    """
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    max_threads = int(n_cores * oversubscription)
+    max_blosc_nthreads = min(max_threads, numcodecs.blosc.MAX_THREADS)
+    return [
+        (dask_threads, blosc_nthreads)
+        for dask_threads in _get_powers_of_two(max_threads)
+        for blosc_nthreads in _get_powers_of_two(max_blosc_nthreads)
+    ]
+
+
+def check_threads(threads):
+    """Check threads validity.
+
+    threads = None --> Use the dask and blosc defaults.
+    threads = dict --> A dictionary with the number of 'dask_threads' and 'blosc_nthreads'
+      (i.e. as returned by get_recommended_threads()). Unspecified keys use the defaults.
+    """
+    if threads is None:
+        return None
+    if not isinstance(threads, dict):
+        raise TypeError("'threads' must be a dictionary or None.")
+    threads = {key: threads.get(key) for key in ["dask_threads", "blosc_nthreads"]}
+    for key, value in threads.items():
+        if value is not None and (not isinstance(value, (int, np.integer)) or value < 1):
+            raise ValueError(f"'{key}' must be a positive integer or None.")
+        if value is not None:
+            threads[key] = int(value)
+    return threads
+
+
+@contextmanager
+def threads_context(dask_threads=None, blosc_nthreads=None):
+    """Context manager setting the number of dask threads and of blosc threads.
+
+    If blosc_nthreads > 1, blosc threads are enabled also within dask threads: blosc then uses
+    a single global pool of blosc_nthreads threads, and the dask threads compress one at a time.
+    If blosc_nthreads = 1, each dask thread compresses concurrently with its own blosc context.
+    """
+    import dask
+
+    dask_config = {} if dask_threads is None else {"num_workers": dask_threads}
+    use_threads = None if blosc_nthreads is None else blosc_nthreads > 1
+    with dask.config.set(**dask_config), blosc_threads(blosc_nthreads, use_threads=use_threads):
+        yield
+
+
+def _set_blosc_blocksize(compressor, blocksize):
+    """Return a copy of a Blosc compressor with the specified blocksize."""
+    if not isinstance(compressor, numcodecs.Blosc):
+        raise TypeError("The blocksize can only be tuned for Blosc compressors.")
+    config = compressor.get_config()
+    config["blocksize"] = blocksize
+    return numcodecs.get_codec(config)
+
+
+def _get_candidate_acronym(dask_threads, blosc_nthreads, blocksize):
+    return f"dask{dask_threads}_blosc{blosc_nthreads}_bs{blocksize}"
+
+
+def _time_threads_configuration(ds, store_path, n_repetitions):
+    """Return the median writing and reading times (in seconds) of a Dataset to/from a zarr store."""
+
+    def _remove_store():
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+
+    def _write():
+        ds.to_zarr(store_path, mode="w")
+
+    def _read():
+        xr.open_zarr(store_path).load()
+
+    writing = time_function(_write, n_repetitions=n_repetitions, setup=_remove_store)
+    reading = time_function(_read, n_repetitions=n_repetitions)
+    return float(np.median(writing)), float(np.median(reading))
+
+
+def benchmark_threads(
+    ds,
+    compressor=None,
+    blocksizes=DEFAULT_BLOCKSIZES,
+    configurations=None,
+    n_cores=None,
+    dst_dir="/tmp/",
+    n_repetitions=3,
+    show_progress=False,
+):
+    """Benchmark the zarr writing and reading throughput with various thread and blocksize settings.
+
+    Each candidate combines a number of dask threads, a number of blosc threads
+    and a blosc blocksize. See threads_context() for the interplay of dask and blosc threads.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        xarray Dataset (chunked with the chunks to benchmark).
+    compressor : numcodecs.Blosc, optional
+        Blosc compressor. If None (the default), Blosc(cname="zstd", clevel=3, shuffle=SHUFFLE).
+    blocksizes : list, optional
+        Blosc blocksizes (in bytes) to benchmark. 0 means automatic blocksize.
+        The default is [0, 2**16, 2**18, 2**20].
+    configurations : list, optional
+        List of (dask_threads, blosc_nthreads) tuples.
+        If None (the default), it uses get_threads_configurations(n_cores).
+    n_cores : int, optional
+        Number of cores of the host. If None (the default), os.cpu_count().
+    dst_dir : str, optional
+        Directory where to write the zarr stores. The default is "/tmp/".
+    n_repetitions : int, optional
+        Number of timed writings and readings of each candidate. The default is 3.
+    show_progress : bool, optional
+        Whether to display the progress bar of the dask writings and readings. The default is False.
+
+    Returns
+    -------
+    results : xarray.Dataset
+        Results Dataset along the 'candidate' dimension, with the median 'writing' and
+        'reading' times, the 'compression_ratio', 'encode_MBs' and 'decode_MBs' metrics
+        and the 'dask_threads', 'blosc_nthreads' and 'blocksize' coordinates.
+        See get_recommended_threads() and get_pareto_front().
+
+    """
+    from dask.diagnostics import ProgressBar
+
+    from xencoding.zarr.benchmarking import get_memory_size_dataset
+    from xencoding.zarr.storage import get_zarr_storage_stats, get_zarr_storage_summary
+    from xencoding.zarr.writer import set_compressor
+
+    if compressor is None:
+        compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=numcodecs.Blosc.SHUFFLE)
+    if configurations is None:
+        configurations = get_threads_configurations(n_cores=n_cores)
+    nbytes_mb = sum(get_memory_size_dataset(ds).values())
+    records = {}
+    for blocksize in blocksizes:
+        compressor_dict = {var: _set_blosc_blocksize(compressor, blocksize) for var in ds.variables}
+        ds_blocksize = set_compressor(ds.copy(), compressor_dict=compressor_dict)
+        for dask_threads, blosc_nthreads in configurations:
+            acronym = _get_candidate_acronym(dask_threads, blosc_nthreads, blocksize)
+            store_path = os.path.join(dst_dir, f"threads_{acronym}.zarr")
+            with threads_context(dask_threads=dask_threads, blosc_nthreads=blosc_nthreads):
+                with ProgressBar() if show_progress else nullcontext():
+                    writing, reading = _time_threads_configuration(
+                        ds_blocksize, store_path=store_path, n_repetitions=n_repetitions
+                    )
+            storage_ratio = get_zarr_storage_summary(get_zarr_storage_stats(store_path))[
+                "storage_ratio"
+            ]
+            shutil.rmtree(store_path)
+            records[acronym] = (
+                dask_threads,
+                blosc_nthreads,
+                blocksize,
+                writing,
+                reading,
+                storage_ratio,
+            )
+    candidates = list(records)
+    values = np.array(list(records.values()), dtype=float)
+    results = xr.Dataset(
+        {
+            "writing": ("candidate", values[:, 3]),
+            "reading": ("candidate", values[:, 4]),
+            "compression_ratio": ("candidate", values[:, 5]),
+            "encode_MBs": ("candidate", nbytes_mb / values[:, 3]),
+            "decode_MBs": ("candidate", nbytes_mb / values[:, 4]),
+        },
+        coords={
+            "candidate": candidates,
+            "dask_threads": ("candidate", values[:, 0].astype(int)),
+            "blosc_nthreads": ("candidate", values[:, 1].astype(int)),
+            "blocksize": ("candidate", values[:, 2].astype(int)),
+        },
+    )
+    results.attrs["n_cores"] = os.cpu_count() if n_cores is None else n_cores
+    return results
+
+
+def get_recommended_threads(results, objective="balanced"):
+    """Return the recommended thread and blocksize configuration from benchmark_threads() results.
+
+    Parameters
+    ----------
+    results : xarray.Dataset
+        Results of benchmark_threads().
+    objective : (str, dict), optional
+        "read" maximizes the decoding throughput, "write" the encoding throughput
+        and "balanced" (the default) both with equal weights.
+        A dictionary with the weights of 'encode_MBs', 'decode_MBs' (and 'compression_ratio')
+        can also be used. See check_objective().
+
+    Returns
+    -------
+    config : dict
+        Dictionary with the recommended 'dask_threads', 'blosc_nthreads' and 'blocksize'.
+        The 'threads' subset can be passed to write_zarr(). The blocksize can be set
+        with the blosc compressor (see get_compressor()).
+
+    """
+    from xencoding.zarr.selection import check_objective
+
+    if objective == "balanced":
+        objective = {"encode_MBs": 1, "decode_MBs": 1}
+    weights = check_objective(objective)
+    score = sum(
+        weight * results[metric] / results[metric].max() for metric, weight in weights.items()
+    )
+    best = results.isel(candidate=int(score.argmax("candidate")))
+    return {
+        "dask_threads": int(best["dask_threads"]),
+        "blosc_nthreads": int(best["blosc_nthreads"]),
+        "blocksize": int(best["blocksize"]),
+        "n_cores": results.attrs.get("n_cores"),
+    }
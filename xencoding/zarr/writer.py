@@ -5,12 +5,29 @@ Created on Thu Jul 29 16:11:33 2021.
 @author: ghiggi
 """
 import os
+from contextlib import nullcontext
 
 import zarr
 
 from xencoding.checks.chunks import check_chunks
+from xencoding.checks.keepbits import check_keepbits
+from xencoding.checks.packing import check_packing
 from xencoding.checks.rounding import check_rounding
 from xencoding.checks.zarr_compressor import check_compressor
+from xencoding.checks.zarr_filters import check_filters
+from xencoding.precision.bitround import bitround_dataarray
+from xencoding.precision.packing import get_packing_encoding
+from xencoding.zarr.append import append_zarr, commit_initial_write, record_initial_write
+from xencoding.zarr.coordinates import get_coordinates_encoding
+from xencoding.zarr.regions import (
+    _get_region_slices,
+    _get_stream_block_size,
+    _get_stream_variables,
+    _get_variables_subset,
+    _write_zarr_region,
+    _write_zarr_regions,
+)
+from xencoding.zarr.threads import check_threads, threads_context
 
 
 def set_rounding(ds, rounding):
@@ -27,13 +44,35 @@ def set_rounding(ds, rounding):
     return ds
 
 
+def set_keepbits(ds, keepbits):
+    # - Bit-rounding (if required)
+    if keepbits is not None:
+        for var, var_keepbits in keepbits.items():
+            ds[var] = bitround_dataarray(ds[var], keepbits=var_keepbits)
+    return ds
+
+
+def set_packing(ds, packing_encoding):
+    # - CF packing to integer dtypes (if required)
+    for var, encoding in packing_encoding.items():
+        ds[var].encoding.update(encoding)
+    return ds
+
+
 def remove_unsupported_filters(ds):
-    # - Remove previous encoding filters
+    # - Remove previous encoding filters of string dimension coordinates
     # - https://github.com/pydata/xarray/issues/3476
-    # for var in ds.data_vars.keys():
-    #     ds[var].encoding['filters'] = None
-    for dim in list(ds.dims.keys()):
-        ds[dim].encoding["filters"] = None  # Without this, bug when coords are str objects
+    # - Filters of numeric variables and coordinates are preserved
+    for dim in list(ds.sizes):
+        if dim in ds.coords and ds[dim].dtype.kind in ["O", "U", "S"]:
+            ds[dim].encoding["filters"] = None  # Without this, bug when coords are str objects
+    return ds
+
+
+def set_filters(ds, filters_dict):
+    # - Filters chains are applied before the compressor
+    for var, filters in filters_dict.items():
+        ds[var].encoding["filters"] = filters
     return ds
 
 
@@ -50,6 +89,66 @@ def set_compressor(ds, compressor_dict):
     return ds
 
 
+def set_coordinates_encoding(ds, coords_encoding):
+    # - Encoded coordinates are stored in a single chunk
+    # - The previous encodings (i.e. read from another store) are replaced
+    for coord, encoding in coords_encoding.items():
+        if ds[coord].chunks is not None:
+            ds = ds.assign_coords({coord: ds[coord].chunk(-1)})
+        ds[coord].encoding = encoding
+    return ds
+
+
+def _write_zarr_streaming(
+    ds,
+    zarr_store,
+    stream_dim,
+    max_mem=None,
+    n_workers=1,
+    consolidated=True,
+):
+    """Write a Dataset to a new zarr store by blocks of whole chunks along stream_dim.
+
+    The store metadata are created first, then the data are written with region writes.
+    """
+    if stream_dim not in ds.dims:
+        raise ValueError(f"'stream_dim' {stream_dim} is not a Dataset dimension.")
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("'n_workers' must be a positive integer.")
+    stream_vars, static_vars = _get_stream_variables(ds, stream_dim)
+    # Create store metadata (and write variables not backed by dask)
+    ds.to_zarr(
+        store=zarr_store,
+        mode="w",
+        synchronizer=None,
+        group=None,
+        consolidated=False,
+        compute=False,
+    )
+    # Write dask-backed variables (and coordinates) without stream_dim
+    for var in static_vars:
+        region = {dim: slice(0, size) for dim, size in ds[var].sizes.items()}
+        _write_zarr_region(_get_variables_subset(ds, [var]), zarr_store, region=region)
+    # Write variables with stream_dim by blocks
+    if len(stream_vars) > 0:
+        chunk_sizes = [ds[var].chunksizes[stream_dim][0] for var in stream_vars]
+        block_size = _get_stream_block_size(
+            ds,
+            stream_dim=stream_dim,
+            stream_vars=stream_vars,
+            chunk_sizes=chunk_sizes,
+            max_mem=max_mem,
+            n_workers=n_workers,
+        )
+        slices = _get_region_slices(ds.sizes[stream_dim], block_size=block_size)
+        _write_zarr_regions(
+            ds, zarr_store, stream_dim=stream_dim, slices=slices, n_workers=n_workers
+        )
+    # Consolidate metadata
+    if consolidated:
+        zarr.consolidate_metadata(zarr_store)
+
+
 def write_zarr(
     zarr_fpath,
     ds,
@@ -57,13 +156,67 @@ def write_zarr(
     default_chunks=None,
     compressor="auto",
     default_compressor=None,
+    objective="size",
+    cache=None,
+    filters=None,
     rounding=None,
+    keepbits=None,
+    packing=None,
+    encode_coords=False,
     consolidated=True,
     append=False,
     append_dim=None,
+    stream_dim=None,
+    max_mem=None,
+    n_workers=1,
+    threads=None,
     show_progress=True,
 ):
-    """Write Xarray Dataset to zarr with custom chunks and compressor per Dataset variable."""
+    """Write Xarray Dataset to zarr with custom chunks and compressor per Dataset variable.
+
+    If keepbits is specified, the mantissa of the float variables is bit-rounded to
+    the specified number of bits. If keepbits is a float (i.e. 0.99), the number of bits
+    preserving this fraction of information is estimated on a sample of chunks.
+    See check_keepbits() and get_keepbits().
+
+    If packing is specified, the float variables are stored as integers with CF
+    scale_factor/add_offset/_FillValue encodings, so that the packing error is within
+    the specified precision (a float, or a dictionary of precision per variable).
+    The smallest suitable integer dtype is selected from the variables min/max
+    and the round-trip error is validated. See get_packing_encoding().
+    When appending, the packing of the existing store is used, and an error is raised
+    if the appended values exceed the range representable by the store packing.
+
+    If compressor="optimize", the compressor of each variable is selected according to
+    the objective with a sample benchmark of the chunked Dataset. See check_compressor().
+    The sample benchmark results can be reused across calls with a persistent cache.
+    See check_cache().
+
+    If filters is specified, the numcodecs filters (i.e. Delta, Shuffle, FixedScaleOffset, Quantize)
+    are applied before the compressor. filters can be a filters chain applied to all
+    data variables, or a dictionary with the filters chain of specific variables and coordinates.
+    When compressor="optimize", the compressors are selected given the filters.
+    See check_filters() and get_candidate_filters().
+
+    If encode_coords=True, the regular or monotonic 1D coordinates (i.e. time, lat, lon)
+    are stored in a single chunk with a compact encoding (Delta filter, smallest integer
+    dtype, CF time units or scale_factor/add_offset for regular float axes) and a fast
+    decoding compressor, so that opening the store and building the indexes is faster.
+    The encodings are lossless. With consolidated=True, the coordinates metadata are read
+    with the other store metadata in a single request. See get_coordinates_encoding().
+    When appending, the coordinates along the append dimension are not encoded.
+
+    If stream_dim is specified, a new store is written in streaming mode: the store metadata
+    are created first, then the data are written by blocks of whole chunks along stream_dim
+    using region writes. n_workers blocks are written concurrently, and the size of the
+    blocks is defined so that the blocks in flight fit in max_mem (in bytes or a string like 1GB).
+    If max_mem=None, each block spans a single chunk along stream_dim.
+    stream_dim is not supported when appending.
+
+    If threads is specified, the number of dask threads and of blosc threads are set during
+    the writing, i.e. {"dask_threads": 8, "blosc_nthreads": 1}. See threads_context().
+    See benchmark_threads() and get_recommended_threads().
+    """
     # Good to know: chunks=None: keeps current chunks, chunks='auto' rely on xarray defaults
     # append=True: if zarr_fpath do not exists, set to False (for the first write)
     ##-------------------------------------------------------------------------.
@@ -77,11 +230,18 @@ def write_zarr(
     ZARR_EXIST = os.path.exists(zarr_fpath)
     if not isinstance(append, bool):
         raise TypeError("'append' must be either True or False'.")
+    if append and stream_dim is not None:
+        raise ValueError(
+            "'stream_dim' is not supported when appending. "
+            "The appended blocks are bounded with 'max_mem' and 'n_workers'."
+        )
     # If append = False and a Zarr store already exist --> Raise Error
     if not append and ZARR_EXIST:
         raise ValueError(zarr_fpath + " already exists!")
     # If the Zarr store do not exist yet but append = True, append is turned to False
     # --> Useful when calling this function to write data subset by subset
+    # --> The first write is recorded to later skip repeated appends of the same data
+    initial_append_dim = append_dim if append and not ZARR_EXIST else None
     if append and not ZARR_EXIST:
         append = False
     if append:
@@ -93,49 +253,92 @@ def write_zarr(
     ##------------------------------------------------------------------------.
     # Checks
     chunks = check_chunks(ds, chunks=chunks, default_chunks=default_chunks)
-    compressor = check_compressor(
-        ds,
-        compressor=compressor,
-        default_compressor=default_compressor,
-    )
     rounding = check_rounding(rounding=rounding, variable_names=list(ds.data_vars.keys()))
+    keepbits = check_keepbits(keepbits=keepbits, ds=ds, chunks=chunks)
+    packing = check_packing(packing=packing, variable_names=list(ds.data_vars.keys()))
+    filters = check_filters(ds, filters=filters)
 
     # Preprocessing
     ds = remove_unsupported_filters(ds)
     ds = set_rounding(ds, rounding=rounding)
+    ds = set_keepbits(ds, keepbits=keepbits)
     ds = set_chunks(ds, chunks_dict=chunks)
+    # - When appending, the store packing is used (and its range checked by append_zarr)
+    if packing is not None and not append:
+        packing_encoding = get_packing_encoding(ds, precision=packing, chunks=chunks)
+        ds = set_packing(ds, packing_encoding=packing_encoding)
+    # - Compressor is checked on the preprocessed Dataset (benchmarked if compressor='optimize')
+    compressor = check_compressor(
+        ds,
+        compressor=compressor,
+        default_compressor=default_compressor,
+        objective=objective,
+        chunks=chunks,
+        cache=cache,
+        filters=filters,
+    )
+    # - Coordinates encoding overrides the compressor and filters of the encoded coordinates
+    if encode_coords and not append:
+        exclude_dims = [initial_append_dim] if isinstance(initial_append_dim, str) else None
+        coords_encoding = get_coordinates_encoding(ds, exclude_dims=exclude_dims)
+        for coord, encoding in coords_encoding.items():
+            compressor[coord] = encoding.pop("compressor")
+            filters[coord] = encoding.pop("filters")
+        ds = set_coordinates_encoding(ds, coords_encoding=coords_encoding)
     ds = set_compressor(ds, compressor_dict=compressor)
+    ds = set_filters(ds, filters_dict=filters)
 
     ##------------------------------------------------------------------------.
     ### - Write zarr files
-    compute = not show_progress
-    # - Write data to new zarr store
-    if not append:
-        # - Define zarr store
-        zarr_store = zarr.DirectoryStore(zarr_fpath)
-        r = ds.to_zarr(
-            store=zarr_store,
-            mode="w",  # overwrite if exists already
-            synchronizer=None,
-            group=None,
-            consolidated=consolidated,
-            compute=compute,
-        )
-        if show_progress:
-            with ProgressBar():
-                r.compute()
-    # - Append data to existing zarr store
-    # ---> !!! Attention: It do not check if data are repeated !!!
-    else:
-        r = ds.to_zarr(
-            store=zarr_fpath,
-            mode="a",
-            append_dim=append_dim,
-            synchronizer=None,
-            group=None,
-            consolidated=consolidated,
-            compute=compute,
-        )
-        if show_progress:
-            with ProgressBar():
-                r.compute()
+    # - Set the number of dask and blosc threads (if specified)
+    threads = check_threads(threads)
+    with threads_context(**threads) if threads is not None else nullcontext():
+        compute = not show_progress
+        # - Write data to new zarr store
+        if not append and stream_dim is not None:
+            zarr_store = zarr.DirectoryStore(zarr_fpath)
+            # - Dask progress bars are not displayed when blocks are written concurrently
+            with ProgressBar() if show_progress and n_workers == 1 else nullcontext():
+                _write_zarr_streaming(
+                    ds,
+                    zarr_store=zarr_store,
+                    stream_dim=stream_dim,
+                    max_mem=max_mem,
+                    n_workers=n_workers,
+                    consolidated=consolidated,
+                )
+        elif not append:
+            # - Define zarr store
+            zarr_store = zarr.DirectoryStore(zarr_fpath)
+            # - The first write of a store created by appending is recorded as pending
+            #   once the metadata are created, so that an interrupted write is resumed
+            is_initial_append = isinstance(initial_append_dim, str)
+            r = ds.to_zarr(
+                store=zarr_store,
+                mode="w",  # overwrite if exists already
+                synchronizer=None,
+                group=None,
+                consolidated=consolidated,
+                compute=compute and not is_initial_append,
+            )
+            if is_initial_append:
+                record_initial_write(zarr_fpath, ds=ds, append_dim=initial_append_dim)
+            if show_progress or is_initial_append:
+                with ProgressBar() if show_progress else nullcontext():
+                    r.compute()
+            if is_initial_append:
+                commit_initial_write(zarr_fpath)
+        # - Append data to existing zarr store
+        # --> Appended ranges are tracked in a manifest inside the store:
+        #     repeated data are skipped, overlapping data raise an error and
+        #     interrupted appends are resumed.
+        else:
+            with ProgressBar() if show_progress and n_workers == 1 else nullcontext():
+                append_zarr(
+                    zarr_fpath,
+                    ds=ds,
+                    append_dim=append_dim,
+                    max_mem=max_mem,
+                    n_workers=n_workers,
+                    consolidated=consolidated,
+                )